@@ -1,28 +1,49 @@
-from flask import Flask, current_app, request, jsonify, send_from_directory
+from flask import Flask, current_app, request, jsonify, send_file, Response, g
 import os
 from os.path import join
 from werkzeug.utils import secure_filename
 from flask_cors import CORS
 from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.exceptions import RequestEntityTooLarge
+import io
+import time
 import uuid
+import threading
+import zipfile
 from pathlib import Path
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from utils.Exceptions import ScoreQualityError, ScoreStructureError, ScoreTooLargeImageError, MidiNotFound, AudiverisTimeoutError
+from utils.Exceptions import ScoreQualityError, ScoreStructureError, ScoreTooLargeImageError, MidiNotFound, AudiverisTimeoutError, JobQueueFullError, RasterizationError, AdmissionRejectedError
 from utils.validation import validate_file
 from utils.config import configure_logging
 from utils.email import send_email_notification
-from utils.validation import ALLOWED_EXTENSIONS
+from utils.validation import ALLOWED_EXTENSIONS, MAX_FILE_SIZE
+from utils.jobs import submit_job, read_job, QUEUED
+from utils import result_cache
+from utils import fingerprint
+from utils import metrics
+from utils import artifacts
+from utils import uploads
+from utils import batch
+from utils import admission
+from utils import progress
+from utils import score_cache
+from utils import profiling
 import json
 
 # SCRIPTS
 from scripts.image_to_midi import image_to_midi
-from scripts.cleanup_data import cleanup_directory
+from scripts.cleanup_data import cleanup_job
+from scripts.export_score import EXPORT_FORMATS, export_path, export_score
+from scripts.render_midi import parse_options, render_midi
 
 # Load environment variables
 load_dotenv()
 
 app = Flask(__name__)
-app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1) # Configure https
+app.request_class = uploads.UploadRequest # Stream uploaded files to disk while validating and hashing them
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1) # Configure https (and the client address, for admission control)
 
 # Check if FLASK_ENV is set to "development"
 if os.environ.get("FLASK_ENV") == "development":
@@ -39,6 +60,152 @@ app.config['MXL_FOLDER'] = join(app.root_path, os.getenv('MXL_FOLDER'))
 app.config['AUDIVERIS_PATH'] = join(app.root_path, os.getenv('AUDIVERIS_PATH'))
 app.config['AUDIVERIS_OUTPUT'] = join(app.root_path, os.getenv('AUDIVERIS_OUTPUT'))
 
+# Uploads are streamed here, then moved into UPLOAD_FOLDER (keep both on the same filesystem)
+app.config['UPLOAD_STAGING_FOLDER'] = join(app.root_path, os.getenv('UPLOAD_STAGING_FOLDER', 'data/incoming'))
+# Requests whose Content-Length is larger are rejected before reading the body
+app.config['MAX_CONTENT_LENGTH'] = uploads.MAX_CONTENT_LENGTH
+
+# Audiveris workers (AUDIVERIS_POOL_SIZE=0 runs a one-shot process per upload)
+app.config['AUDIVERIS_TIMEOUT'] = int(os.getenv('AUDIVERIS_TIMEOUT', 180))
+app.config['AUDIVERIS_POOL_SIZE'] = int(os.getenv('AUDIVERIS_POOL_SIZE', 1))
+app.config['AUDIVERIS_POOL_MAX_JOBS'] = int(os.getenv('AUDIVERIS_POOL_MAX_JOBS', 50))
+app.config['AUDIVERIS_WORKERS_DIR'] = join(app.root_path, os.getenv('AUDIVERIS_WORKERS_DIR', 'data/audiveris-workers'))
+
+# Audiveris governor: caps the JVMs running on the host at AUDIVERIS_SLOTS (0 = derived from the CPUs and memory),
+# sizes each one's heap and threads to its share, and runs it pinned to its CPUs, at AUDIVERIS_NICE
+app.config['AUDIVERIS_GOVERNOR'] = os.getenv('AUDIVERIS_GOVERNOR', 'true').lower() == 'true'
+app.config['AUDIVERIS_SLOTS'] = int(os.getenv('AUDIVERIS_SLOTS', 0))
+app.config['AUDIVERIS_SLOTS_DIR'] = join(app.root_path, os.getenv('AUDIVERIS_SLOTS_DIR', 'data/audiveris-slots'))
+app.config['AUDIVERIS_MEMORY_FRACTION'] = float(os.getenv('AUDIVERIS_MEMORY_FRACTION', 0.75))
+app.config['AUDIVERIS_MAX_HEAP_MB'] = int(os.getenv('AUDIVERIS_MAX_HEAP_MB', 4096))
+app.config['AUDIVERIS_NICE'] = int(os.getenv('AUDIVERIS_NICE', 5))
+app.config['AUDIVERIS_PIN_CPUS'] = os.getenv('AUDIVERIS_PIN_CPUS', 'true').lower() == 'true'
+
+# Micro-batching: images queued within AUDIVERIS_BATCH_WINDOW_MS of each other (up to AUDIVERIS_BATCH_MAX_SIZE)
+# are transcribed by one Audiveris process (0 = one process per image)
+app.config['AUDIVERIS_BATCH_WINDOW_MS'] = int(os.getenv('AUDIVERIS_BATCH_WINDOW_MS', 0))
+app.config['AUDIVERIS_BATCH_MAX_SIZE'] = int(os.getenv('AUDIVERIS_BATCH_MAX_SIZE', 4))
+
+# Async uploads (POST /api/upload returns 202 and a job id to poll, or follow on /api/jobs/<id>/events)
+app.config['ASYNC_UPLOADS'] = os.getenv('ASYNC_UPLOADS', 'false').lower() == 'true'
+app.config['JOBS_FOLDER'] = join(app.root_path, os.getenv('JOBS_FOLDER', 'data/jobs'))
+app.config['JOB_WORKERS'] = int(os.getenv('JOB_WORKERS', 2))
+app.config['JOB_QUEUE_SIZE'] = int(os.getenv('JOB_QUEUE_SIZE', 10))
+# Progress streams end after this many seconds, then the client reconnects where it left off
+app.config['PROGRESS_STREAM_MAX_DURATION'] = int(os.getenv('PROGRESS_STREAM_MAX_DURATION', 300))
+# Synchronous conversions a gunicorn worker runs at a time; its other threads keep serving progress streams and polls
+app.config['SYNC_CONVERSIONS'] = int(os.getenv('SYNC_CONVERSIONS', 1))
+
+# MXL -> MIDI engine: "music21", or "fast" (streaming, falls back to music21)
+app.config['MIDI_ENGINE'] = os.getenv('MIDI_ENGINE', 'music21')
+
+# SVG uploads are rendered at SVG_DPI in SVG_RENDER_WORKERS processes (0 = in the request worker)
+app.config['SVG_DPI'] = int(os.getenv('SVG_DPI', 300))
+app.config['SVG_RENDER_WORKERS'] = int(os.getenv('SVG_RENDER_WORKERS', 1))
+app.config['SVG_RENDER_TIMEOUT'] = int(os.getenv('SVG_RENDER_TIMEOUT', 60))
+app.config['RASTER_CACHE_FOLDER'] = join(app.root_path, os.getenv('RASTER_CACHE_FOLDER', 'data/rasters'))
+app.config['RASTER_CACHE_MAX_ENTRIES'] = int(os.getenv('RASTER_CACHE_MAX_ENTRIES', 200))
+
+# Image preprocessing before Audiveris: binarize, crop, deskew and resample to the interline (pixels)
+app.config['PREPROCESS_IMAGES'] = os.getenv('PREPROCESS_IMAGES', 'false').lower() == 'true'
+app.config['PREPROCESS_INTERLINE'] = int(os.getenv('PREPROCESS_INTERLINE', 20))
+app.config['PREPROCESS_MAX_SKEW'] = float(os.getenv('PREPROCESS_MAX_SKEW', 5))
+
+# Multi-page PDFs are transcribed page by page (0 = one thread per CPU)
+app.config['PDF_PAGE_WORKERS'] = int(os.getenv('PDF_PAGE_WORKERS', 0))
+
+# Result cache (identical uploads reuse the first conversion)
+app.config['RESULT_CACHE'] = os.getenv('RESULT_CACHE', 'true').lower() == 'true'
+app.config['RESULT_CACHE_FOLDER'] = join(app.root_path, os.getenv('RESULT_CACHE_FOLDER', 'data/cache'))
+app.config['RESULT_CACHE_MAX_AGE'] = int(os.getenv('RESULT_CACHE_MAX_AGE', 7 * 24 * 3600))
+app.config['RESULT_CACHE_MAX_ENTRIES'] = int(os.getenv('RESULT_CACHE_MAX_ENTRIES', 1000))
+# Uploads of an image that looks like an earlier one (perceptual fingerprints at least NEAR_DUPLICATE_SIMILARITY
+# alike, from 0 to 1) are answered with that conversion as a suggestion instead of being converted; the client
+# posts again with near_duplicates=false to have its upload converted anyway
+app.config['NEAR_DUPLICATES'] = os.getenv('NEAR_DUPLICATES', 'false').lower() == 'true'
+app.config['NEAR_DUPLICATE_SIMILARITY'] = float(os.getenv('NEAR_DUPLICATE_SIMILARITY', 0.9))
+
+# Uploads and MIDI files are kept for ARTIFACT_TTL seconds and within ARTIFACT_MAX_BYTES (0 = no limit)
+app.config['ARTIFACT_INDEX'] = join(app.root_path, os.getenv('ARTIFACT_INDEX', 'data/artifacts.sqlite3'))
+app.config['ARTIFACT_TTL'] = int(os.getenv('ARTIFACT_TTL', 7 * 24 * 3600))
+app.config['ARTIFACT_MAX_BYTES'] = int(os.getenv('ARTIFACT_MAX_BYTES', 5 * 1024 ** 3))
+app.config['JANITOR_INTERVAL'] = int(os.getenv('JANITOR_INTERVAL', 600))
+
+# Cache-Control max-age (seconds) of the MIDI and score downloads, which never change
+app.config['DOWNLOAD_MAX_AGE'] = int(os.getenv('DOWNLOAD_MAX_AGE', 365 * 24 * 3600))
+
+# Batch uploads (POST /api/batch): scores per batch, conversions at a time, and request size (bytes)
+app.config['BATCH_MAX_FILES'] = int(os.getenv('BATCH_MAX_FILES', 50))
+app.config['BATCH_PARALLELISM'] = int(os.getenv('BATCH_PARALLELISM', 2))
+app.config['BATCH_MAX_CONTENT_LENGTH'] = int(os.getenv('BATCH_MAX_CONTENT_LENGTH', 100 * 1024 * 1024))
+
+# Admission control: uploads are rejected with 429 when the estimated seconds of conversion work in flight would exceed
+# ADMISSION_MAX_BACKLOG, or the client's fair share of it. ADMISSION_CAPACITY is the number of conversions run at a time
+app.config['ADMISSION_CONTROL'] = os.getenv('ADMISSION_CONTROL', 'true').lower() == 'true'
+app.config['ADMISSION_LEDGER'] = join(app.root_path, os.getenv('ADMISSION_LEDGER', 'data/admission.json'))
+app.config['ADMISSION_MAX_BACKLOG'] = int(os.getenv('ADMISSION_MAX_BACKLOG', 900))
+app.config['ADMISSION_CAPACITY'] = int(os.getenv('ADMISSION_CAPACITY', 3))
+app.config['ADMISSION_SECONDS_PER_JOB'] = float(os.getenv('ADMISSION_SECONDS_PER_JOB', 10))
+app.config['ADMISSION_SECONDS_PER_MPIXEL'] = float(os.getenv('ADMISSION_SECONDS_PER_MPIXEL', 4))
+app.config['ADMISSION_SECONDS_PER_PAGE'] = float(os.getenv('ADMISSION_SECONDS_PER_PAGE', 45))
+
+# Email notifications: queued per gunicorn process, sent by one thread (digest interval in seconds, 0 = one email each)
+app.config['EMAIL_QUEUE_SIZE'] = int(os.getenv('EMAIL_QUEUE_SIZE', 100))
+app.config['EMAIL_OVERFLOW'] = os.getenv('EMAIL_OVERFLOW', 'drop_oldest')
+app.config['EMAIL_DIGEST_INTERVAL'] = int(os.getenv('EMAIL_DIGEST_INTERVAL', 0))
+app.config['EMAIL_MAX_ATTACHMENT_BYTES'] = int(os.getenv('EMAIL_MAX_ATTACHMENT_BYTES', 5 * 1024 * 1024))
+
+# Parsed scores for /api/render: pickled in a per-worker LRU of SCORE_CACHE_MAX_BYTES, then on disk
+app.config['SCORE_CACHE_FOLDER'] = join(app.root_path, os.getenv('SCORE_CACHE_FOLDER', 'data/scores'))
+app.config['SCORE_CACHE_MAX_BYTES'] = int(os.getenv('SCORE_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+app.config['SCORE_CACHE_MAX_DISK_ENTRIES'] = int(os.getenv('SCORE_CACHE_MAX_DISK_ENTRIES', 500))
+
+# Profiling: conversions (every one with PROFILE_CONVERSIONS, or uploads sent with profile=true) are sampled every
+# PROFILE_INTERVAL_MS and their Audiveris JVM runs under Java Flight Recorder. Profiles of conversions slower than
+# PROFILE_SLOW_SECONDS are kept in PROFILE_FOLDER, at most PROFILE_MAX_ENTRIES of them, and expire like the uploads
+app.config['PROFILE_CONVERSIONS'] = os.getenv('PROFILE_CONVERSIONS', 'false').lower() == 'true'
+app.config['PROFILE_SLOW_SECONDS'] = float(os.getenv('PROFILE_SLOW_SECONDS', 60))
+app.config['PROFILE_INTERVAL_MS'] = int(os.getenv('PROFILE_INTERVAL_MS', 10))
+app.config['PROFILE_JFR_SETTINGS'] = os.getenv('PROFILE_JFR_SETTINGS', 'profile')
+app.config['PROFILE_FOLDER'] = join(app.root_path, os.getenv('PROFILE_FOLDER', 'data/profiles'))
+app.config['PROFILE_MAX_ENTRIES'] = int(os.getenv('PROFILE_MAX_ENTRIES', 50))
+
+# Stage timings and exception counters, one file per gunicorn worker (served on /metrics)
+app.config['METRICS_FOLDER'] = join(app.root_path, os.getenv('METRICS_FOLDER', 'data/metrics'))
+
+
+_sync_conversions = threading.BoundedSemaphore(app.config['SYNC_CONVERSIONS'])
+
+
+@contextmanager
+def sync_conversion():
+    """Holds one of this worker's synchronous conversion slots. The wait for it is timed as the "queue" stage."""
+    with metrics.timed("queue"):
+        _sync_conversions.acquire()
+    try:
+        yield
+    finally:
+        _sync_conversions.release()
+
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def add_server_timing(response):
+    # Lets clients (and benchmarks/load_test.py) see where the server spent the request's time.
+    if "request_started" in g:
+        response.headers['Server-Timing'] = metrics.server_timing(time.perf_counter() - g.request_started)
+    return response
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    current_app.logger.warning("Upload rejected: the request body is too large.")
+    return jsonify({'error': f"File size exceeds maximum allowed size ({MAX_FILE_SIZE//1024//1024}MB)"}), 413
+
 
 # API Routes
 @app.route('/health')
@@ -47,6 +214,44 @@ def health():
     return {'status': 'healthy!'}, 200
 
 
+# Message returned to the client for each known conversion error.
+CONVERSION_ERRORS = {
+    MidiNotFound: "The server could not find the generated MIDI. Please, try again.",
+    ScoreQualityError: "Could not read the score. Please, upload the image with higher quality.",
+    ScoreStructureError: "Could not parse the score. Please, check if the structure of the score is correct.",
+    ScoreTooLargeImageError: "The uploaded image was too large. Please, upload a smaller image.",
+    AudiverisTimeoutError: "Audiveris took too long to process your file. Please try with a simpler or smaller score, or try again later.",
+    RasterizationError: "Could not read the SVG file. Please, check that it is a valid SVG or upload a PNG or PDF.",
+}
+UNEXPECTED_ERROR = "There has been an unexpected error in the conversion. Please, try again."
+
+
+def page_result(page):
+    """Adds the client message of a failed PDF page's error to its result."""
+    if page["status"] == "failed":
+        messages = {error.__name__: message for error, message in CONVERSION_ERRORS.items()}
+        page = {**page, "error": messages.get(page["error_type"], UNEXPECTED_ERROR)}
+    return page
+
+
+def is_async_request():
+    """Async mode is enabled for every upload by ASYNC_UPLOADS, or per request with async=true."""
+    requested = request.args.get('async', request.form.get('async', ''))
+    return app.config['ASYNC_UPLOADS'] or requested.lower() in ('1', 'true', 'yes')
+
+
+def is_profile_request():
+    """Uploads sent with profile=true are profiled (see utils.profiling), even when PROFILE_CONVERSIONS is off."""
+    requested = request.args.get('profile', request.form.get('profile', ''))
+    return requested.lower() in ('1', 'true', 'yes')
+
+
+def is_near_duplicates_request():
+    """Uploads look for a near-duplicate to suggest unless the request sets near_duplicates=false (convert anyway)."""
+    requested = request.args.get('near_duplicates', request.form.get('near_duplicates', ''))
+    return requested.lower() not in ('0', 'false', 'no')
+
+
 @app.route("/api/upload", methods = ["POST"])
 def upload_file():
   
@@ -59,23 +264,106 @@ def upload_file():
 
     if secure_filename(file.filename) == '':
         return jsonify({'error': 'No file found in the request. Please, try again.'}), 400
-    
+
+    host_url = request.host_url.rstrip('/')
+    response_dict, status, job = store_upload(file, host_url)
+    if status == 429:
+        return jsonify(response_dict), status, {'Retry-After': str(response_dict['retry_after'])}
+    if job is None:
+        return jsonify(response_dict), status
+    _, _, filename, _uuid, _, _ = job
+
+    if is_async_request():
+        try:
+            submit_job(_uuid, convert_upload_once, *job)
+        except JobQueueFullError as e:
+            metrics.count_exception(e)
+            admission.release(_uuid)
+            current_app.logger.warning("Job queue is full, rejecting upload.")
+            return jsonify({'error': 'The server is busy. Please, try again later.'}), 503
+
+        current_app.logger.info(f"Queued conversion job: {_uuid}")
+        return jsonify({
+            "job_id": _uuid,
+            "state": QUEUED,
+            "status_url": f"{host_url}/api/jobs/{_uuid}",
+            "events_url": f"{host_url}/api/jobs/{_uuid}/events",
+            "original_filename": filename
+        }), 202
+
+    with sync_conversion():
+        response_dict, status = convert_upload_once(*job)
+    return jsonify(response_dict), status
+
+
+def store_upload(file, host_url):
+
+    """
+    Validates an uploaded file and saves it in a new job directory.
+
+    Returns:
+        tuple: (response_dict, status_code, job). When the file is invalid,
+        its conversion is cached, it looks like an earlier upload (the
+        suggestion is in near_duplicate) or it is not admitted (429, with
+        the seconds to wait in retry_after), the response is final and job
+        is None. Otherwise job holds the convert_upload_once arguments.
+    """
+
     # Validate the file
-    is_valid, error_message = validate_file(file)
+    report = {}
+    # Every upload is fingerprinted, so the ones converted anyway can be suggested later.
+    near_duplicates = app.config['RESULT_CACHE'] and app.config['NEAR_DUPLICATES']
+    with metrics.timed("validate"):
+        is_valid, error_message = validate_file(file, report, fingerprint=near_duplicates)
     if not is_valid:
         current_app.logger.warning(f"File validation failed: {error_message}")
-        return jsonify({'error': error_message}), 400
+        return {'error': error_message}, 400, None
 
     current_app.logger.info(f"The file passed all the validations.")
 
-    if not file:
-        return jsonify({'error': 'No file found in the request. Please, try again.'}), 400
-
-    filepath = None
+    filename = secure_filename(file.filename)
+
+    # Return the previous conversion if the same content was already uploaded.
+    sha256 = uploads.digest(file)
+    digest = None
+    if app.config['RESULT_CACHE']:
+        digest = sha256
+        cached = result_cache.lookup(digest)
+        if cached:
+            result_cache.record("hits")
+            current_app.logger.info(f"Result cache hit for {digest}: {cached['file_uuid']}")
+            return cached_response(cached, filename, host_url), 200, None
+
+    # Or suggest, without converting, the conversion of an upload that looks the same. Fingerprints of
+    # different scores on the same template can match too, so the client decides whether to use it.
+    if near_duplicates and report.get("fingerprint") and is_near_duplicates_request():
+        suggestion = near_duplicate(digest, report["fingerprint"], host_url)
+        if suggestion:
+            result_cache.record("near_duplicates")
+            return {
+                "original_filename": filename,
+                "near_duplicate": suggestion,
+                "message": "This score looks like one already converted. Send it again with near_duplicates=false to convert it anyway."
+            }, 200, None
+
+    # Create a UUID to distuinguish the directory.
+    _uuid = str(uuid.uuid4())
+
+    # Reject the upload early if the server cannot take its estimated cost now.
+    if app.config['ADMISSION_CONTROL']:
+        cost = admission.estimate_cost(file, report)
+        try:
+            admission.admit(_uuid, request.remote_addr, cost)
+        except AdmissionRejectedError as e:
+            metrics.count_exception(e)
+            retry_after = e.args[0]
+            current_app.logger.warning(f"Upload not admitted ({cost}s estimated), retry after {retry_after}s")
+            return {'error': 'The server is busy. Please, try again later.', 'retry_after': retry_after}, 429, None
+
+    # From here on, a failure (e.g. a full disk) must not leave the job in the admission backlog.
     try:
-               
-        # Create a UUID to distuinguish the directory.
-        _uuid = str(uuid.uuid4())
+        if is_profile_request():
+            profiling.request(_uuid)
 
         # Create the directory to store the image
         file_dir = join(app.config['UPLOAD_FOLDER'], _uuid)
@@ -84,25 +372,225 @@ def upload_file():
             os.makedirs(file_dir)
 
         # Get the file attributes
-        filename = secure_filename(file.filename)
         filepath = join(file_dir, filename)
-        
-        # Save the file in its corresponding directory.
-        file.save(filepath)
+    
+        # Move the streamed file into its corresponding directory.
+        with metrics.timed("save"):
+            uploads.save(file, filepath)
+        artifacts.register("UPLOAD_FOLDER", _uuid)
+        artifacts.record_file("UPLOAD_FOLDER", _uuid, filepath, sha256=sha256)
+        # Only async jobs (uploads and batch items) can be followed on /api/jobs/<id>/events.
+        if is_async_request():
+            progress.start(_uuid)
+        progress.emit(_uuid, progress.SAVED, original_filename=filename)
         current_app.logger.info(f"File saved: {filepath}")
+    except BaseException:
+        admission.release(_uuid)
+        raise
+
+    image_fingerprint = report.get("fingerprint") if near_duplicates else None
+    return None, None, (digest, filepath, filename, _uuid, host_url, image_fingerprint)
+
+
+@app.route("/api/batch", methods=["POST"])
+def batch_upload():
+
+    """
+    Converts many scores in one request: several "file" fields, zip archives
+    of scores, or both.
+
+    Every score is validated and converted like an /api/upload, up to
+    BATCH_PARALLELISM at a time, and gets its own result (the /api/upload
+    response plus its "status" code) in "results", in upload order. With
+    async=true the conversions are queued as jobs instead, and with zip=true
+    the response is a zip of the MIDI files and a results.json.
+    """
+
+    current_app.logger.info("/api/batch:")
+
+    # Archives and many files need more than a single upload's limits.
+    request.max_content_length = app.config['BATCH_MAX_CONTENT_LENGTH']
+    request.max_file_size = app.config['BATCH_MAX_CONTENT_LENGTH']
+
+    files = [file for file in request.files.getlist('file') if secure_filename(file.filename)]
+    if not files:
+        return jsonify({'error': 'No file found in the request. Please, try again.'}), 400
 
+    try:
+        count = batch.count_files(files)
+    except zipfile.BadZipFile:
+        return jsonify({'error': 'Could not read the zip archive. Please, try again.'}), 400
+
+    max_files = app.config['BATCH_MAX_FILES']
+    if count > max_files:
+        return jsonify({'error': f"Too many files in the batch. The maximum is {max_files}."}), 400
+
+    host_url = request.host_url.rstrip('/')
+    results = []
+    jobs = {}
+
+    try:
+        for item in batch.expand(files):
+            if isinstance(item, tuple):
+                filename, error_message = item
+                results.append({'error': error_message, 'original_filename': filename, 'status': 400})
+                continue
+
+            try:
+                response_dict, status, job = store_upload(item, host_url)
+            finally:
+                item.close()
+            if job is None:
+                results.append({'original_filename': secure_filename(item.filename), **response_dict, 'status': status})
+            else:
+                jobs[len(results)] = job
+                results.append(None)
+    except BaseException:
+        # None of the stored files will be converted: their estimated cost leaves the admission backlog.
+        for _, _, _, _uuid, _, _ in jobs.values():
+            admission.release(_uuid)
+        raise
+
+    current_app.logger.info(f"Batch of {len(results)} files, {len(jobs)} to convert")
+
+    if is_async_request():
+        for index, job in jobs.items():
+            results[index] = queue_batch_job(job)
+        return jsonify({'results': results}), 202 if jobs else 200
+
+    app_object = current_app._get_current_object()
+
+    def convert(job):
+        with app_object.app_context():
+            return convert_upload_once(*job)
+
+    with sync_conversion(), ThreadPoolExecutor(max_workers=app.config['BATCH_PARALLELISM']) as executor:
+        futures = {index: executor.submit(convert, job) for index, job in jobs.items()}
+
+    for index, future in futures.items():
+        response_dict, status = future.result()
+        results[index] = {'original_filename': jobs[index][2], **response_dict, 'status': status}
+
+    if request.args.get('zip', '').lower() in ('1', 'true', 'yes'):
+        return send_file(batch.zip_results(results), mimetype="application/zip",
+                         as_attachment=True, download_name="midi_files.zip")
+
+    return jsonify({'results': results}), 200
+
+
+def queue_batch_job(job):
+    """Queues the conversion of a batch file as an async job. Returns its result entry."""
+    _, _, filename, _uuid, host_url, _ = job
+    try:
+        submit_job(_uuid, convert_upload_once, *job)
+    except JobQueueFullError as e:
+        metrics.count_exception(e)
+        admission.release(_uuid)
+        current_app.logger.warning("Job queue is full, rejecting batch file.")
+        return {'error': 'The server is busy. Please, try again later.', 'original_filename': filename, 'status': 503}
+
+    return {
+        "job_id": _uuid,
+        "state": QUEUED,
+        "status_url": f"{host_url}/api/jobs/{_uuid}",
+        "events_url": f"{host_url}/api/jobs/{_uuid}/events",
+        "original_filename": filename,
+        "status": 202
+    }
+
+
+def cached_response(cached, filename, host_url):
+    """Builds the upload response for a result found in the cache."""
+    return {
+        "file_uuid": cached["file_uuid"],
+        "midi_url": f"{host_url}/api/download/{cached['file_uuid']}",
+        "score_url": f"{host_url}/api/score/{cached['file_uuid']}",
+        "mxl_url": f"{host_url}/api/export/{cached['file_uuid']}/mxl",
+        "original_filename": filename,
+        "midi_filename": cached["midi_filename"],
+        "cached": True
+    }
+
+
+def near_duplicate(digest, image_fingerprint, host_url):
+    """
+    Returns the URLs and similarity of the converted upload that looks the
+    most like an upload (the page exported or photographed again), or None.
+    """
+    for near_digest, similarity in fingerprint.lookup(image_fingerprint, app.config['NEAR_DUPLICATE_SIMILARITY']):
+        cached = result_cache.lookup(near_digest) if near_digest != digest else None
+        if cached:
+            current_app.logger.info(f"Near-duplicate of {near_digest} ({similarity:.1%} similar): {cached['file_uuid']}")
+            suggestion = cached_response(cached, cached["original_filename"], host_url)
+            del suggestion["cached"]
+            return {**suggestion, "similarity": round(similarity, 3)}
+    return None
+
+
+def convert_upload_once(digest, filepath, filename, _uuid, host_url, image_fingerprint=None):
+    """
+    Converts an upload, unless an upload with the same content is already
+    being converted. In that case it waits for that conversion and returns
+    its result instead of starting another one.
+
+    Given the upload's perceptual fingerprint, a successful conversion is
+    indexed to be suggested for the uploads that look like it.
+    """
+
+    try:
+        with profiling.profiled(_uuid):
+            response_dict, status = convert_or_reuse(digest, filepath, filename, _uuid, host_url)
+    finally:
+        # Its estimated cost leaves the admission backlog.
+        admission.release(_uuid)
+
+    # Only converted uploads are ever suggested.
+    if image_fingerprint and status == 200:
+        fingerprint.add(digest, image_fingerprint)
+
+    progress.emit(_uuid, progress.DONE if status == 200 else progress.FAILED, status=status, **response_dict)
+    return response_dict, status
+
+
+def convert_or_reuse(digest, filepath, filename, _uuid, host_url):
+    if digest is None:
+        return convert_upload(filepath, filename, _uuid, host_url)
+
+    with result_cache.single_flight(digest):
+        cached = result_cache.lookup(digest)
+        if cached:
+            result_cache.record("hits")
+            current_app.logger.info(f"Reusing in-flight conversion of {digest}: {cached['file_uuid']}")
+            artifacts.remove("UPLOAD_FOLDER", _uuid)
+            return cached_response(cached, filename, host_url), 200
+
+        result_cache.record("misses")
+        response_dict, status = convert_upload(filepath, filename, _uuid, host_url)
+        if status == 200:
+            result_cache.store(digest, response_dict)
+        return response_dict, status
+
+
+def convert_upload(filepath, filename, _uuid, host_url):
+    """
+    Runs the conversion pipeline on a saved upload.
+
+    Returns:
+        tuple: (response_dict, status_code). Conversion errors are mapped to
+        their client message and never raised.
+    """
+
+    converted = False
+    try:
         # Convert image into MIDI
-        midi_path = image_to_midi(filepath, _uuid)
+        report = {}
+        midi_path = image_to_midi(filepath, _uuid, report)
         midi_file = Path(midi_path)
 
         # Validate if the MIDI exists
         if not midi_file.exists():
-            raise 
+            raise MidiNotFound()
 
-        # Get the midi files path MIDI
-        midi_folder = app.config.get("MIDI_FOLDER")
-        midi_dir = join(midi_folder, _uuid)
-    
         # Send success email notification
         send_email_notification(
             subject="[🎵 NEW] File Upload Successful",
@@ -111,8 +599,9 @@ def upload_file():
         )
 
         # Build the download URL for the MIDI file
-        midi_url = f"{request.host_url.rstrip('/')}/api/download/{_uuid}"
-        score_url = f"{request.host_url.rstrip('/')}/api/score/{_uuid}"
+        midi_url = f"{host_url}/api/download/{_uuid}"
+        score_url = f"{host_url}/api/score/{_uuid}"
+        mxl_url = f"{host_url}/api/export/{_uuid}/mxl"
 
         current_app.logger.info("midi_url: %s", midi_url)
         current_app.logger.info("score_url: %s", score_url)
@@ -121,109 +610,301 @@ def upload_file():
             "file_uuid": _uuid,
             "midi_url": midi_url,
             "score_url": score_url,
+            "mxl_url": mxl_url,
             "original_filename": filename,
             "midi_filename": midi_file.name
         }
 
+        # Multi-page PDFs report which pages made it into the MIDI.
+        if "pages" in report:
+            response_dict["pages"] = [page_result(page) for page in report["pages"]]
+
         current_app.logger.info("Returning response: \n%s", json.dumps(response_dict, indent=4))
+        artifacts.register("MIDI_FOLDER", _uuid)
+        artifacts.record_file("MIDI_FOLDER", _uuid, midi_path)
+        # The MXL is kept for /api/export, so other formats never need Audiveris again.
+        artifacts.register("MXL_FOLDER", _uuid)
+        artifacts.record_file("MXL_FOLDER", _uuid, report["mxl"])
+        converted = True
+
+        return response_dict, 200
+
+    except tuple(CONVERSION_ERRORS) as exception:
+        error_type = type(exception).__name__
+        error_msg = CONVERSION_ERRORS[type(exception)]
+        metrics.count_exception(exception)
+        current_app.logger.error(f"{error_type} exception")
+        send_email_notification("[🎵 ERROR] File Upload Failed", error_msg, filepath)
+        return {'error': error_msg, 'error_type': error_type}, 400
 
-        # Vaciar carpetas data/audiveris y data/mxl
-        audiveris_dir = current_app.config.get("AUDIVERIS_OUTPUT")
-        mxl_dir = current_app.config.get("MXL_FOLDER")
-        cleanup_directory(audiveris_dir)
-        cleanup_directory(mxl_dir)
+    except Exception as exception:
+        error_msg = f"There has been an unexpected error in the conversion: {exception}"
+        metrics.count_exception(exception)
+        current_app.logger.error(f"General exception: {exception}")
+        send_email_notification("[🎵 ERROR] File Upload Failed", error_msg, filepath)
+        return {'error': UNEXPECTED_ERROR, 'error_type': type(exception).__name__}, 500
 
-        return jsonify(response_dict), 200
+    finally:
+        # Only this job's intermediate files; the upload, MIDI and MXL are left to the janitor.
+        with metrics.timed("cleanup"):
+            cleanup_job(_uuid, keep_mxl=converted)
+        artifacts.register("UPLOAD_FOLDER", _uuid)
 
-    except MidiNotFound:
-        error_msg = "The server could not find the generated MIDI. Please, try again."
-        current_app.logger.error("MidiNotFound exception")
-        send_email_notification("[🎵 ERROR] File Upload Failed", error_msg, filepath)
-        return jsonify({'error': error_msg}), 400
 
-    except ScoreQualityError:
-        error_msg = "Could not read the score. Please, upload the image with higher quality."
-        current_app.logger.error("ScoreQualityError exception")
-        send_email_notification("[🎵 ERROR] File Upload Failed", error_msg, filepath)
-        return jsonify({'error': error_msg}), 400
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    """
+    Returns the state of an async conversion job (queued, running, done or failed).
+    Done jobs include the midi_url/score_url of the synchronous response,
+    failed jobs the mapped error.
+    """
+    try:
+        job_id = str(uuid.UUID(job_id))
+    except ValueError:
+        return jsonify({'error': 'Job not found.'}), 404
 
-    except ScoreStructureError:
-        error_msg = "Could not parse the score. Please, check if the structure of the score is correct."
-        current_app.logger.error("ScoreStructureError exception")
-        send_email_notification("[🎵 ERROR] File Upload Failed", error_msg, filepath)
-        return jsonify({'error': error_msg}), 400
+    record = read_job(job_id)
+    if record is None:
+        return jsonify({'error': 'Job not found.'}), 404
 
-    except ScoreTooLargeImageError:
-        error_msg = "The uploaded image was too large. Please, upload a smaller image."
-        current_app.logger.error("ScoreTooLargeImageError exception")
-        send_email_notification("[🎵 ERROR] File Upload Failed", error_msg, filepath)
-        return jsonify({'error': error_msg}), 400
+    return jsonify(record), 200
 
-    except AudiverisTimeoutError:
-        error_msg = "Audiveris took too long to process your file. Please try with a simpler or smaller score, or try again later."
-        current_app.logger.error("AudiverisTimeoutError exception")
-        send_email_notification("[🎵 ERROR] File Upload Failed", error_msg, filepath)
-        return jsonify({'error': error_msg}), 400
 
-    except Exception as exception:
-        error_msg = f"There has been an unexpected error in the conversion: {exception}"
-        current_app.logger.error(f"General exception: {exception}")
-        send_email_notification("[🎵 ERROR] File Upload Failed", error_msg, filepath)
-        return jsonify({'error': "There has been an unexpected error in the conversion. Please, try again."}), 500
+@app.route("/api/jobs/<job_id>/events", methods=["GET"])
+def job_events(job_id):
+    """
+    Streams the stages of a conversion as Server-Sent Events: saved,
+    rasterized (SVG), preprocessed, omr (once per Audiveris step), mxl,
+    midi, and finally done (with the upload response) or failed (with the
+    error). Each event carries its timestamp in "at".
+
+    The stream runs on one thread of a gunicorn worker (gthread), not a
+    whole sync worker. Reconnecting clients send Last-Event-ID and get the
+    events they missed.
+    """
+    try:
+        job_id = str(uuid.UUID(job_id))
+    except ValueError:
+        return jsonify({'error': 'Job not found.'}), 404
+
+    if read_job(job_id) is None and not progress.has_events(job_id):
+        return jsonify({'error': 'Job not found.'}), 404
+
+    try:
+        last_event_id = int(request.headers.get('Last-Event-ID', request.args.get('last_event_id', 0)))
+    except ValueError:
+        last_event_id = 0
+
+    events = progress.stream(job_id, last_event_id, max_duration=app.config['PROGRESS_STREAM_MAX_DURATION'])
+    return Response(events, mimetype="text/event-stream", headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no' # nginx sends each event as it comes instead of buffering the response
+    })
 
 
-@app.route("/api/download/<uuid>", methods=["GET"])
-def download_midi(uuid):
+@app.route("/api/cache/stats", methods=["GET"])
+def cache_stats():
+    """Returns the result cache hit/miss counters, and those of the parsed score cache under "scores"."""
+    return jsonify({**result_cache.stats(), "fingerprints": fingerprint.count(), "scores": score_cache.stats()}), 200
+
+
+@app.route("/api/admission/stats", methods=["GET"])
+def admission_stats():
+    """Returns the estimated conversion backlog, in total and per client."""
+    return jsonify(admission.stats()), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """Returns the pipeline metrics of every worker in the Prometheus text format."""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/api/download/<_uuid>", methods=["GET"])
+def download_midi(_uuid):
     """
     Download the MIDI file for a given UUID as an attachment.
     """
 
-    current_app.logger.info("Downloading MIDI file for UUID: %s", uuid)
-    midi_folder = app.config.get("MIDI_FOLDER")
-    midi_dir = join(midi_folder, uuid)
+    current_app.logger.info("Downloading MIDI file for UUID: %s", _uuid)
+    response = send_artifact("MIDI_FOLDER", _uuid, ('.mid', '.midi'), as_attachment=True)
 
-    # Find the MIDI file in the directory
-    if not os.path.exists(midi_dir):
-        current_app.logger.warning("MIDI directory not found for UUID: %s", uuid)
+    if response is None:
+        current_app.logger.warning("MIDI file not found for UUID: %s", _uuid)
         return jsonify({'error': 'MIDI file not found.'}), 404
 
-    midi_files = [f for f in os.listdir(midi_dir) if f.lower().endswith('.mid') or f.lower().endswith('.midi')]
+    return response
 
-    if not midi_files:
-        current_app.logger.warning("No MIDI files found in directory: %s (UUID: %s)", midi_dir, uuid)
-        return jsonify({'error': 'MIDI file not found.'}), 404
-    
-    midi_file = midi_files[0]  # Assume only one MIDI per upload
+@app.route('/api/score/<_uuid>', methods=['GET'])
+def download_score(_uuid):
+    """
+    Download the score file for a given UUID to be displayed inline (not as attachment).
+    """
+    # Mostrar en navegador, no descargar
+    response = send_artifact("UPLOAD_FOLDER", _uuid, tuple(ALLOWED_EXTENSIONS), as_attachment=False)
+    if response is None:
+        return jsonify({'error': 'Score file not found.'}), 404
+    return response
 
-    current_app.logger.info("Returning MIDI file: %s from directory: %s", midi_file, midi_dir)
-    
-    return send_from_directory(
-        directory=midi_dir,
-        path=midi_file,
+
+@app.route('/api/export/<_uuid>/<fmt>', methods=['GET'])
+def export(_uuid, fmt):
+    """
+    Download the score of a converted upload in another format: "mxl" (the
+    MusicXML that Audiveris produced), "midi", or one of EXPORT_FORMATS,
+    derived from the MXL on the first request and cached.
+    """
+    if fmt == "mxl":
+        response = send_artifact("MXL_FOLDER", _uuid, ('.mxl',), as_attachment=True)
+    elif fmt == "midi":
+        response = send_artifact("MIDI_FOLDER", _uuid, ('.mid', '.midi'), as_attachment=True)
+    elif fmt in EXPORT_FORMATS:
+        response = send_export(_uuid, fmt)
+    else:
+        formats = ", ".join(["mxl", "midi", *EXPORT_FORMATS])
+        return jsonify({'error': f"Unknown format '{fmt}'. The formats are: {formats}."}), 400
+
+    if response is None:
+        return jsonify({'error': 'Score not found.'}), 404
+    return response
+
+
+@app.route('/api/render/<_uuid>', methods=['GET'])
+def render(_uuid):
+    """
+    Renders the MIDI of a converted upload again with other options, e.g.
+    ?tempo=90&program=0&transpose=-2&drop=2 (see parse_options). The parsed
+    score is cached, so only the MIDI is written: neither Audiveris nor the
+    MXL parse run again.
+    """
+    try:
+        _uuid = str(uuid.UUID(_uuid))
+    except ValueError:
+        return jsonify({'error': 'Score not found.'}), 404
+
+    try:
+        options = parse_options(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    entry = artifacts.manifest("MXL_FOLDER", _uuid)
+    if entry is None:
+        return jsonify({'error': 'Score not found.'}), 404
+    mxl_path = join(app.config.get("MXL_FOLDER"), _uuid, entry["name"])
+
+    try:
+        with metrics.timed("render.load_score"):
+            score = score_cache.load(mxl_path, entry["sha256"])
+        midi_data = render_midi(score, options)
+    except FileNotFoundError:
+        # Removed by the janitor since the manifest was read.
+        artifacts.forget_file("MXL_FOLDER", _uuid)
+        return jsonify({'error': 'Score not found.'}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as exception:
+        metrics.count_exception(exception)
+        current_app.logger.error(f"Could not render {mxl_path} with {options}: {exception}")
+        return jsonify({'error': 'The score could not be rendered with these options.'}), 422
+
+    download_name = f"{os.path.splitext(entry['name'])[0]}.midi"
+    return send_file(io.BytesIO(midi_data), mimetype="audio/midi", as_attachment=True, download_name=download_name)
+
+
+def send_export(_uuid, fmt):
+
+    """
+    Sends the export of a job's MXL to `fmt`, creating it first if it is
+    not cached, or None if the job has no MXL. Exports never change for a
+    given MXL, so they are cached by clients like the other downloads.
+    """
+
+    try:
+        _uuid = str(uuid.UUID(_uuid))
+    except ValueError:
+        return None
+
+    entry = artifacts.manifest("MXL_FOLDER", _uuid)
+    if entry is None:
+        return None
+    mxl_path = join(app.config.get("MXL_FOLDER"), _uuid, entry["name"])
+
+    created = not os.path.exists(export_path(mxl_path, fmt))
+    try:
+        path = export_score(mxl_path, fmt)
+    except FileNotFoundError:
+        # Removed by the janitor since the manifest was read.
+        artifacts.forget_file("MXL_FOLDER", _uuid)
+        return None
+    except Exception as exception:
+        metrics.count_exception(exception)
+        current_app.logger.error(f"Could not export {mxl_path} to {fmt}: {exception}")
+        return jsonify({'error': f"The score could not be exported to {fmt}."}), 422
+
+    if created:
+        # The export counts towards the job's size.
+        artifacts.register("MXL_FOLDER", _uuid)
+
+    _, mimetype = EXPORT_FORMATS[fmt]
+    response = send_file(
+        path,
+        mimetype=mimetype,
         as_attachment=True,
-        download_name=midi_file
+        download_name=os.path.basename(path),
+        conditional=True,
+        etag=f"{entry['sha256']}-{fmt}",
+        last_modified=entry["mtime"],
+        max_age=app.config['DOWNLOAD_MAX_AGE'],
     )
+    response.cache_control.immutable = True
+    return response
+
+
+def send_artifact(folder, _uuid, extensions, as_attachment):
 
-@app.route('/api/score/<uuid>', methods=['GET'])
-def download_score(uuid):
     """
-    Download the score file for a given UUID to be displayed inline (not as attachment).
+    Sends the file of a job from its manifest entry, or None if there is none.
+
+    Results never change once written, so they are served with their
+    SHA-256 as ETag, Last-Modified and a long-lived immutable Cache-Control.
+    Conditional (If-None-Match / If-Modified-Since) and Range requests are
+    answered with 304 and 206.
     """
-    score_folder = app.config.get("UPLOAD_FOLDER")
-    score_dir = join(score_folder, uuid)
-    # Find the score file in the directory
-    if not os.path.exists(score_dir):
-        return jsonify({'error': 'Score file not found.'}), 404
-    score_files = [f for f in os.listdir(score_dir) if f.lower().endswith(tuple(ALLOWED_EXTENSIONS))]
-    if not score_files:
-        return jsonify({'error': 'Score file not found.'}), 404
-    score_file = score_files[0]  # Assume only one score per upload
-    return send_from_directory(
-        directory=score_dir,
-        path=score_file,
-        as_attachment=False,  # Mostrar en navegador, no descargar
-        download_name=score_file
-    )
+
+    try:
+        _uuid = str(uuid.UUID(_uuid))
+    except ValueError:
+        return None
+
+    entry = artifacts.manifest(folder, _uuid)
+    directory = join(app.config.get(folder), _uuid)
+
+    if entry is None:
+        # Jobs converted before manifests existed: look the file up once and record it.
+        if not os.path.isdir(directory):
+            return None
+        files = sorted(f for f in os.listdir(directory) if f.lower().endswith(extensions))
+        if not files:
+            return None
+        entry = artifacts.record_file(folder, _uuid, join(directory, files[0]))
+
+    try:
+        response = send_file(
+            join(directory, entry["name"]),
+            as_attachment=as_attachment,
+            download_name=entry["name"],
+            conditional=True,
+            etag=entry["sha256"],
+            last_modified=entry["mtime"],
+            max_age=app.config['DOWNLOAD_MAX_AGE'],
+        )
+    except FileNotFoundError:
+        # Removed by the janitor since the manifest was read.
+        artifacts.forget_file(folder, _uuid)
+        return None
+
+    response.cache_control.immutable = True
+    return response
 
 if __name__ == '__main__':
     # Solo para desarrollo
@@ -0,0 +1,19 @@
+import os
+from os.path import join
+
+# Data directories and files of the app (and its log directory), pointed at a benchmark's scratch directory.
+DATA_FOLDERS = ("UPLOAD_FOLDER", "MIDI_FOLDER", "MXL_FOLDER", "AUDIVERIS_OUTPUT", "AUDIVERIS_WORKERS_DIR",
+                "AUDIVERIS_SLOTS_DIR", "JOBS_FOLDER", "RESULT_CACHE_FOLDER", "METRICS_FOLDER", "RASTER_CACHE_FOLDER",
+                "UPLOAD_STAGING_FOLDER", "SCORE_CACHE_FOLDER", "PROFILE_FOLDER", "LOG_FOLDER")
+DATA_FILES = {"ARTIFACT_INDEX": "artifacts.sqlite3", "ADMISSION_LEDGER": "admission.json"}
+
+
+def data_environment(data_dir):
+    """Environment variables that keep the app's data, locks and logs in `data_dir`, out of the checkout."""
+    env = {}
+    for name in DATA_FOLDERS:
+        env[name] = join(data_dir, name.lower())
+        os.makedirs(env[name], exist_ok=True)
+    for name, filename in DATA_FILES.items():
+        env[name] = join(data_dir, filename)
+    return env
@@ -0,0 +1,110 @@
+"""
+Checks the fast MIDI engine against music21, note for note.
+
+Every MXL file is converted with both engines and the notes of the two MIDI
+files are compared per track: pitch, start tick and end tick. Scores the
+fast engine does not support are reported as fallbacks (music21 handles
+them in production), and scores music21 itself cannot convert as music21
+failures: there is nothing to compare them with.
+
+Usage:
+    python -m benchmarks.compare_midi_engines [MXL files or directories...]
+
+Without arguments the bundled corpus (benchmarks/corpus) is checked. The
+exit code is 1 if any score differs.
+"""
+import sys
+import glob
+import tempfile
+from os.path import join, isdir, dirname, basename
+from music21 import converter, midi
+from scripts.mxl_fast_midi import mxl_to_midi_fast
+from utils.Exceptions import UnsupportedMusicXMLError
+
+CORPUS_DIR = join(dirname(__file__), "corpus")
+
+
+def read_notes(midi_path):
+    """Returns the notes of a MIDI file as one sorted list of (pitch, start, end) per track."""
+    midi_file = midi.MidiFile()
+    midi_file.open(midi_path)
+    midi_file.read()
+    midi_file.close()
+
+    tracks = []
+    for track in midi_file.tracks:
+        tick = 0
+        sounding = {}
+        notes = []
+        for event in track.events:
+            if isinstance(event, midi.DeltaTime):
+                tick += event.time
+            elif event.type == midi.ChannelVoiceMessages.NOTE_ON and event.velocity > 0:
+                sounding.setdefault(event.pitch, []).append(tick)
+            elif event.type in (midi.ChannelVoiceMessages.NOTE_OFF, midi.ChannelVoiceMessages.NOTE_ON):
+                if sounding.get(event.pitch):
+                    start = sounding[event.pitch].pop(0)
+                    if tick > start:
+                        notes.append((event.pitch, start, tick))
+        if notes:
+            tracks.append(sorted(notes))
+    return tracks
+
+
+def compare(mxl_path, work_dir):
+    """Returns "equal", "fallback", "music21 failed" or a description of the first difference."""
+    music21_path = join(work_dir, "music21.midi")
+    fast_path = join(work_dir, "fast.midi")
+
+    try:
+        converter.parse(mxl_path).write("midi", fp=music21_path)
+    except Exception as e:
+        return f"music21 failed ({type(e).__name__}: {e})"
+    try:
+        mxl_to_midi_fast(mxl_path, fast_path)
+    except UnsupportedMusicXMLError as e:
+        return f"fallback ({e})"
+
+    expected = read_notes(music21_path)
+    actual = read_notes(fast_path)
+
+    if len(expected) != len(actual):
+        return f"different track count: music21 {len(expected)}, fast {len(actual)}"
+    for index, (expected_notes, actual_notes) in enumerate(zip(expected, actual)):
+        if expected_notes != actual_notes:
+            missing = sorted(set(expected_notes) - set(actual_notes))[:3]
+            extra = sorted(set(actual_notes) - set(expected_notes))[:3]
+            return f"track {index}: {len(expected_notes)} vs {len(actual_notes)} notes, missing {missing}, extra {extra}"
+    return "equal"
+
+
+def collect(paths):
+    files = []
+    for path in paths:
+        if isdir(path):
+            files += sorted(glob.glob(join(path, "**", "*.mxl"), recursive=True))
+        else:
+            files.append(path)
+    return files
+
+
+def main(argv):
+    files = collect(argv or [CORPUS_DIR])
+    failures = 0
+    music21_failures = 0
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        for mxl_path in files:
+            result = compare(mxl_path, work_dir)
+            if result.startswith("music21 failed"):
+                music21_failures += 1
+            elif not (result == "equal" or result.startswith("fallback")):
+                failures += 1
+            print(f"{basename(mxl_path)}: {result}")
+
+    print(f"\n{len(files)} scores, {failures} different, {music21_failures} music21 failures")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Deterministic stand-in for the Audiveris launcher, for benchmarks.
+
+Takes the same arguments the app passes to Audiveris
+(-batch -export -output DIR -- FILE...), prints a line per OMR step while
+it waits, and "exports" a fixed MXL for every input file as
+DIR/<input stem>.mxl.
+
+Environment:
+    FAKE_AUDIVERIS_DELAY: Seconds to wait per input file (default 0).
+    FAKE_AUDIVERIS_DELAY_PER_MPIXEL: Extra seconds to wait per megapixel of
+        an input image (default 0), as Audiveris runtime grows with the
+        image size.
+    FAKE_AUDIVERIS_SCORE: MXL copied as the result (default the medium corpus score).
+    FAKE_AUDIVERIS_LOG: Extra text printed to stdout after the LOAD step,
+        e.g. "try 300 DPI" to make the app stop the run and raise
+        ScoreQualityError.
+    FAKE_AUDIVERIS_FAILURE_RATE: Share of the input files (0 to 1, default 0)
+        that are not exported, after printing FAILURE_LOG. Which files fail
+        depends only on their name and FAKE_AUDIVERIS_SEED (default 0), so
+        a rerun with the same seed fails the same files.
+
+Usage:
+    AUDIVERIS_PATH=benchmarks/fake_audiveris.py
+"""
+import os
+import sys
+import time
+import shutil
+import hashlib
+from os.path import join, dirname, basename, splitext
+
+DEFAULT_SCORE = join(dirname(os.path.abspath(__file__)), "corpus", "sizes", "medium.mxl")
+FAILURE_LOG = "Too low interline value, try 300 DPI"
+STEPS = ("LOAD", "BINARY", "SCALE", "GRID", "HEADS", "STEMS", "SYMBOLS", "RHYTHMS", "PAGE")
+
+
+def megapixels(path):
+    try:
+        from PIL import Image
+        with Image.open(path) as image:
+            return image.width * image.height / 1e6
+    except Exception:
+        return 0
+
+
+def fails(stem, seed, failure_rate):
+    """Whether the input file `stem` is not exported."""
+    digest = hashlib.sha256(f"{seed}:{stem}".encode()).hexdigest()
+    return int(digest, 16) % 10**6 < failure_rate * 10**6
+
+
+def main(argv):
+    separator = argv.index("--")
+    options, inputs = argv[:separator], argv[separator + 1:]
+    output_dir = options[options.index("-output") + 1]
+    delay = float(os.getenv("FAKE_AUDIVERIS_DELAY", 0))
+    delay_per_mpixel = float(os.getenv("FAKE_AUDIVERIS_DELAY_PER_MPIXEL", 0))
+    score = os.getenv("FAKE_AUDIVERIS_SCORE", DEFAULT_SCORE)
+    failure_rate = float(os.getenv("FAKE_AUDIVERIS_FAILURE_RATE", 0))
+    seed = os.getenv("FAKE_AUDIVERIS_SEED", "0")
+
+    for input_path in inputs:
+        stem = splitext(basename(input_path))[0]
+        print(f"INFO  [{stem}] Loading {input_path}", flush=True)
+        step_delay = (delay + delay_per_mpixel * megapixels(input_path)) / len(STEPS)
+        for step in STEPS:
+            print(f"INFO  [{stem}] Step {step} starting", flush=True)
+            if step == "LOAD" and os.getenv("FAKE_AUDIVERIS_LOG"):
+                print(os.getenv("FAKE_AUDIVERIS_LOG"), flush=True)
+            time.sleep(step_delay)
+        if fails(stem, seed, failure_rate):
+            print(f"WARN  [{stem}] {FAILURE_LOG}", flush=True)
+            continue
+        shutil.copy(score, join(output_dir, f"{stem}.mxl"))
+        print(f"INFO  [{stem}] Score {stem} exported", flush=True)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Brevo transactional email API, to exercise the email
+dispatcher without sending real emails.
+
+Answers POST /smtp/email like Brevo (201 and a messageId) and prints one
+line per email: subject, recipients and attachment names and sizes.
+
+Environment:
+    FAKE_BREVO_DELAY: Seconds to wait before answering (default 0).
+    FAKE_BREVO_STATUS: Status code to answer with (default 201), e.g. 500.
+
+Usage:
+    python benchmarks/fake_brevo.py [port]
+    BREVO_API_HOST=http://127.0.0.1:8025/v3 BREVO_API_KEY=fake ...
+"""
+import os
+import sys
+import json
+import time
+import base64
+import itertools
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+_message_ids = itertools.count(1)
+
+
+class FakeBrevoHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        time.sleep(float(os.getenv("FAKE_BREVO_DELAY", 0)))
+        status = int(os.getenv("FAKE_BREVO_STATUS", 201))
+
+        if self.path.endswith("/smtp/email") and status == 201:
+            attachments = [f"{a['name']} ({len(base64.b64decode(a['content']))} bytes)" for a in body.get("attachment") or []]
+            recipients = [to["email"] for to in body.get("to", [])]
+            print(f"{body.get('subject')!r} to {recipients}, attachments: {attachments or 'none'}", flush=True)
+            response = {"messageId": f"<fake-{next(_message_ids)}@brevo.local>"}
+        else:
+            response = {"code": "fake_error", "message": f"fake status {status}"}
+
+        data = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main(argv):
+    port = int(argv[0]) if argv else 8025
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeBrevoHandler)
+    print(f"Fake Brevo API on http://127.0.0.1:{port}/v3", flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,429 @@
+"""
+Load-tests the HTTP API of a gunicorn server started on a scratch data
+directory, with benchmarks/fake_audiveris.py as Audiveris.
+
+Every session uploads a score (POST /api/upload, synchronous) picked from
+--mix, then downloads its MIDI and its score --downloads times. Sessions
+arrive at --rate per second (Poisson arrivals, open loop) and run at most
+--concurrency at a time; arrivals that find every client busy wait, and
+that wait is reported as the client queueing delay. With --rate 0 the
+clients send back to back (closed loop). The server reports the time an
+upload waited for a conversion slot, and the time of every stage, in its
+Server-Timing header.
+
+The report (JSON) has the throughput, the p50/p95/p99 latency, the status
+codes and the errors by exception type of every endpoint, the queueing
+delays, the mean Server-Timing of the uploads, and the server settings,
+so runs against different gunicorn configurations (--workers, --threads,
+--timeout, --env SYNC_CONVERSIONS=4, ...) can be compared with
+--baseline. With --slo-p95 or --slo-error-rate, the exit code is 1 if the
+uploads miss them.
+
+Usage:
+    python -m benchmarks.load_test [--duration 60 | --requests 100] [--rate 1] [--concurrency 8]
+        [--mix small.png=3,medium.png=1,medium.svg=1] [--downloads 1]
+        [--workers 3] [--threads 16] [--timeout 600] [--env NAME=VALUE ...] [--result-cache]
+        [--audiveris-delay 2] [--audiveris-delay-per-mpixel 0.5] [--audiveris-failure-rate 0.05]
+        [--url http://127.0.0.1:5000] [--slo-p95 30] [--slo-error-rate 0.01]
+        [--output results.json] [--baseline previous.json]
+"""
+import os
+import sys
+import json
+import time
+import queue
+import random
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from os.path import join, dirname, abspath, basename, splitext
+from datetime import datetime, timezone
+
+import requests
+
+from benchmarks import data_environment
+
+BENCHMARKS_DIR = dirname(abspath(__file__))
+ROOT_DIR = dirname(BENCHMARKS_DIR)
+SIZES_DIR = join(BENCHMARKS_DIR, "corpus", "sizes")
+RESULTS_DIR = join(BENCHMARKS_DIR, "results")
+FAKE_AUDIVERIS = join(BENCHMARKS_DIR, "fake_audiveris.py")
+
+ENDPOINTS = ("upload", "download", "score")
+PERCENTILES = (50, 95, 99)
+SERVER_START_TIMEOUT = 60
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(data_dir, args):
+    """Starts gunicorn with the repository's config and the given overrides. Returns (process, url)."""
+    env = {**os.environ, **data_environment(data_dir)}
+    env.update({
+        "AUDIVERIS_PATH": FAKE_AUDIVERIS,
+        "FAKE_AUDIVERIS_DELAY": str(args.audiveris_delay),
+        "FAKE_AUDIVERIS_DELAY_PER_MPIXEL": str(args.audiveris_delay_per_mpixel),
+        "FAKE_AUDIVERIS_FAILURE_RATE": str(args.audiveris_failure_rate),
+        "FAKE_AUDIVERIS_SEED": str(args.seed),
+        # Every upload of the same corpus file would be a cache hit.
+        "RESULT_CACHE": "true" if args.result_cache else "false",
+    })
+    env.update(args.env)
+
+    port = free_port()
+    log_path = join(data_dir, "server.log")
+    command = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "--bind", f"127.0.0.1:{port}",
+               "--workers", str(args.workers), "--threads", str(args.threads), "--timeout", str(args.timeout), "app:app"]
+    with open(log_path, "w") as log:
+        process = subprocess.Popen(command, cwd=ROOT_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            break
+        try:
+            requests.get(f"{url}/health", timeout=1)
+            return process, url
+        except requests.RequestException:
+            time.sleep(0.2)
+
+    process.kill()
+    with open(log_path) as log:
+        print(log.read()[-5000:], file=sys.stderr)
+    raise RuntimeError("The server did not start.")
+
+
+def parse_mix(spec):
+    """Reads "file=weight,..." (corpus file names or paths). Returns [(filename, data, weight)]."""
+    mix = []
+    for item in spec.split(","):
+        name, _, weight = item.partition("=")
+        path = name if os.path.exists(name) else join(SIZES_DIR, name)
+        with open(path, "rb") as f:
+            mix.append((basename(path), f.read(), float(weight or 1)))
+    return mix
+
+
+def parse_server_timing(header):
+    """Returns the durations (seconds) of a Server-Timing header, by name."""
+    timings = {}
+    for entry in filter(None, (part.strip() for part in (header or "").split(","))):
+        name, *params = entry.split(";")
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if key == "dur":
+                timings[name] = float(value) / 1000
+    return timings
+
+
+def percentile(values, p):
+    """The p-th percentile of values, interpolated between the closest ranks."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = (len(values) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def distribution(values):
+    summary = {f"p{p}": percentile(values, p) for p in PERCENTILES}
+    summary.update(mean=sum(values) / len(values) if values else None, max=max(values, default=None))
+    return summary
+
+
+class LoadTest:
+    """Sends sessions (an upload, then its downloads) and records every request."""
+
+    def __init__(self, url, mix, downloads, request_timeout, seed):
+        self.url = url
+        self.mix = mix
+        self.downloads = downloads
+        self.request_timeout = request_timeout
+        self.random = random.Random(seed)
+        self.arrivals_random = random.Random(seed + 1)
+        self.records = []
+        self.uploads = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def request(self, endpoint, method, path, delay=None, **kwargs):
+        """Sends one request and records it. Returns the response, or None if it could not be sent."""
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+
+        record = {"endpoint": endpoint, "status": None, "error_type": None, "delay": delay}
+        started = time.perf_counter()
+        try:
+            response = session.request(method, f"{self.url}{path}", timeout=self.request_timeout, **kwargs)
+        except requests.RequestException as e:
+            response = None
+            record["error_type"] = type(e).__name__
+        record["seconds"] = time.perf_counter() - started
+
+        if response is not None:
+            record["status"] = response.status_code
+            record["server_timing"] = parse_server_timing(response.headers.get("Server-Timing"))
+            if response.status_code >= 400:
+                try:
+                    body = response.json()
+                except ValueError:
+                    body = {}
+                record["error_type"] = body.get("error_type") or f"HTTP {response.status_code}"
+
+        with self._lock:
+            self.records.append(record)
+        return response
+
+    def session(self, delay=0.0):
+        with self._lock:
+            filename, data, _ = self.random.choices(self.mix, weights=[weight for *_, weight in self.mix])[0]
+            self.uploads += 1
+            # Numbered, so the fake Audiveris decides whether to fail each session, not each corpus file.
+            stem, extension = splitext(filename)
+            filename = f"{stem}-{self.uploads}{extension}"
+        response = self.request("upload", "POST", "/api/upload", delay=delay, files={"file": (filename, data)})
+        if response is None or response.status_code != 200:
+            return
+        file_uuid = response.json()["file_uuid"]
+        for _ in range(self.downloads):
+            self.request("download", "GET", f"/api/download/{file_uuid}")
+            self.request("score", "GET", f"/api/score/{file_uuid}")
+
+    def run(self, concurrency, rate, duration, sessions):
+        """
+        Runs sessions for `duration` seconds, or until `sessions` were
+        started. Returns the elapsed seconds.
+        """
+        started = time.monotonic()
+        arrivals = queue.Queue()
+
+        def due(count, at):
+            return (not sessions or count < sessions) and (not duration or at - started < duration)
+
+        def open_client():
+            while True:
+                scheduled = arrivals.get()
+                if scheduled is None:
+                    return
+                self.session(delay=max(time.monotonic() - scheduled, 0.0))
+
+        def closed_client():
+            # Closed loop: a client starts its next session as soon as its last one ends.
+            while True:
+                with self._lock:
+                    count = self.started_sessions
+                    self.started_sessions += 1
+                if not due(count, time.monotonic()):
+                    return
+                self.session()
+
+        self.started_sessions = 0
+        clients = [threading.Thread(target=open_client if rate > 0 else closed_client, daemon=True)
+                   for _ in range(concurrency)]
+        for thread in clients:
+            thread.start()
+
+        if rate > 0:
+            count = 0
+            next_arrival = started
+            while due(count, next_arrival):
+                time.sleep(max(next_arrival - time.monotonic(), 0))
+                arrivals.put(next_arrival)
+                next_arrival += self.arrivals_random.expovariate(rate)
+                count += 1
+            for _ in clients:
+                arrivals.put(None)
+
+        for thread in clients:
+            thread.join()
+        return time.monotonic() - started
+
+    def report(self, elapsed):
+        endpoints = {}
+        for endpoint in ENDPOINTS:
+            records = [record for record in self.records if record["endpoint"] == endpoint]
+            if not records:
+                continue
+            errors = {}
+            statuses = {}
+            for record in records:
+                statuses[str(record["status"])] = statuses.get(str(record["status"]), 0) + 1
+                if record["error_type"]:
+                    errors[record["error_type"]] = errors.get(record["error_type"], 0) + 1
+            ok = [record for record in records if record["status"] is not None and record["status"] < 400]
+            endpoints[endpoint] = {
+                "requests": len(records),
+                "throughput": len(ok) / elapsed,
+                "latency": distribution([record["seconds"] for record in ok]),
+                "error_rate": (len(records) - len(ok)) / len(records),
+                "status": statuses,
+                "errors": errors,
+            }
+
+        uploads = [record for record in self.records if record["endpoint"] == "upload"]
+        timings = [record["server_timing"] for record in uploads if record.get("server_timing")]
+        stages = sorted({stage for timing in timings for stage in timing})
+        return {
+            "elapsed": elapsed,
+            "endpoints": endpoints,
+            "queueing": {
+                "client": distribution([record["delay"] for record in uploads]),
+                "server": distribution([timing.get("queue", 0.0) for timing in timings]),
+            },
+            "server_timing": {stage: sum(timing.get(stage, 0.0) for timing in timings) / len(timings) for stage in stages},
+        }
+
+
+def check_slo(results, p95, error_rate):
+    """Returns the SLOs of the uploads and whether each was met."""
+    upload = results["endpoints"].get("upload", {})
+    slo = {}
+    if p95 is not None:
+        value = upload.get("latency", {}).get("p95")
+        slo["upload_p95"] = {"target": p95, "value": value, "met": value is not None and value <= p95}
+    if error_rate is not None:
+        value = upload.get("error_rate")
+        slo["upload_error_rate"] = {"target": error_rate, "value": value, "met": value is not None and value <= error_rate}
+    return slo
+
+
+def format_seconds(value):
+    return "-" if value is None else f"{value * 1000:.0f} ms"
+
+
+def print_results(results):
+    print(f"\n{'endpoint':10} {'requests':>8} {'req/s':>7} {'p50':>10} {'p95':>10} {'p99':>10} {'errors':>7}")
+    for endpoint, result in results["endpoints"].items():
+        latency = result["latency"]
+        print(f"{endpoint:10} {result['requests']:8} {result['throughput']:7.2f} {format_seconds(latency['p50']):>10} "
+              f"{format_seconds(latency['p95']):>10} {format_seconds(latency['p99']):>10} {result['error_rate']:7.1%}")
+        for error_type, count in sorted(result["errors"].items()):
+            print(f"{'':10} {count:8} {error_type}")
+    for side, queueing in results["queueing"].items():
+        print(f"queueing ({side}): p50 {format_seconds(queueing['p50'])}, p95 {format_seconds(queueing['p95'])}, "
+              f"p99 {format_seconds(queueing['p99'])}")
+    if results["server_timing"]:
+        print("server timing of the uploads (mean): "
+              + ", ".join(f"{stage} {format_seconds(seconds)}" for stage, seconds in results["server_timing"].items()))
+
+
+def compare(results, baseline):
+    """Prints the throughput, latency and error rate of every endpoint next to the baseline's."""
+    for endpoint, result in results["endpoints"].items():
+        before = baseline.get("results", {}).get("endpoints", {}).get(endpoint)
+        if not before:
+            continue
+        print(f"{endpoint:10} req/s {before['throughput']:7.2f} -> {result['throughput']:7.2f}  "
+              + "  ".join(f"p{p} {format_seconds(before['latency'][f'p{p}'])} -> {format_seconds(result['latency'][f'p{p}'])}"
+                          for p in PERCENTILES)
+              + f"  errors {before['error_rate']:.1%} -> {result['error_rate']:.1%}")
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Load-test the HTTP API.")
+    parser.add_argument("--duration", type=float, default=60, help="seconds to send sessions for (0 = until --requests)")
+    parser.add_argument("--requests", type=int, default=0, help="sessions to send (0 = for --duration)")
+    parser.add_argument("--rate", type=float, default=1.0, help="sessions per second (0 = back to back)")
+    parser.add_argument("--concurrency", type=int, default=8, help="sessions at a time")
+    parser.add_argument("--mix", default="small.png=3,medium.png=1,medium.svg=1",
+                        help="files to upload and their weights (corpus file names or paths)")
+    parser.add_argument("--downloads", type=int, default=1, help="MIDI and score downloads after each upload")
+    parser.add_argument("--request-timeout", type=float, default=600, help="seconds before a request is abandoned")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the arrivals, the file mix and the fake Audiveris failures")
+    parser.add_argument("--url", help="server to test, instead of starting one")
+    parser.add_argument("--workers", type=int, default=3, help="gunicorn workers")
+    parser.add_argument("--threads", type=int, default=16, help="gunicorn threads per worker")
+    parser.add_argument("--timeout", type=int, default=600, help="gunicorn worker timeout")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE", help="setting of the server")
+    parser.add_argument("--result-cache", action="store_true", help="keep the result cache on")
+    parser.add_argument("--audiveris-delay", type=float, default=2.0, help="seconds the fake Audiveris takes per file")
+    parser.add_argument("--audiveris-delay-per-mpixel", type=float, default=0.5,
+                        help="extra seconds the fake Audiveris takes per megapixel of the image")
+    parser.add_argument("--audiveris-failure-rate", type=float, default=0.0,
+                        help="share of the files the fake Audiveris cannot read")
+    parser.add_argument("--slo-p95", type=float, help="upload p95 latency target (seconds)")
+    parser.add_argument("--slo-error-rate", type=float, help="upload error rate target, 0.01 = 1%%")
+    parser.add_argument("--output", help="results file (default benchmarks/results/load-<timestamp>.json)")
+    parser.add_argument("--baseline", help="previous results file to compare with")
+    args = parser.parse_args(argv)
+    if not args.duration and not args.requests:
+        parser.error("set --duration or --requests")
+    args.env = dict(item.split("=", 1) for item in args.env)
+
+    mix = parse_mix(args.mix)
+    with tempfile.TemporaryDirectory() as data_dir:
+        process = None
+        url = args.url
+        if url is None:
+            process, url = start_server(data_dir, args)
+            print(f"Server started on {url} ({args.workers} workers, {args.threads} threads)")
+        try:
+            load_test = LoadTest(url.rstrip("/"), mix, args.downloads, args.request_timeout, args.seed)
+            elapsed = load_test.run(args.concurrency, args.rate, args.duration, args.requests)
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait(timeout=30)
+
+    results = load_test.report(elapsed)
+    results["slo"] = check_slo(results, args.slo_p95, args.slo_error_rate)
+    print_results(results)
+
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "server": {
+            "url": args.url or "local",
+            "workers": args.workers,
+            "threads": args.threads,
+            "timeout": args.timeout,
+            "env": args.env,
+            "result_cache": args.result_cache,
+            "audiveris_delay": args.audiveris_delay,
+            "audiveris_delay_per_mpixel": args.audiveris_delay_per_mpixel,
+            "audiveris_failure_rate": args.audiveris_failure_rate,
+        },
+        "load": {
+            "duration": args.duration,
+            "requests": args.requests,
+            "rate": args.rate,
+            "concurrency": args.concurrency,
+            "mix": {filename: weight for filename, _, weight in mix},
+            "downloads": args.downloads,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    output = args.output or join(RESULTS_DIR, f"load-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(dirname(abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults saved in {output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"\nComparing with {args.baseline}:")
+        compare(results, baseline)
+
+    missed = [name for name, slo in results["slo"].items() if not slo["met"]]
+    for name, slo in results["slo"].items():
+        print(f"SLO {name}: {slo['value']} (target {slo['target']}) {'met' if slo['met'] else 'MISSED'}")
+    return 1 if missed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,232 @@
+"""
+Regenerates the bundled MusicXML corpus in benchmarks/corpus.
+
+Each score exercises one construct the MIDI engines have to agree on.
+corpus/sizes holds small, medium and large inputs for the pipeline
+benchmarks: a generated score (MXL) and a page image of matching size
+(PNG and SVG), generated from fixed seeds.
+
+Usage:
+    python -m benchmarks.make_corpus
+"""
+import random
+from os.path import join
+from pathlib import Path
+from PIL import Image, ImageDraw
+from music21 import stream, note, chord, tie, meter, tempo, dynamics, duration, instrument, bar, layout
+
+from benchmarks.compare_midi_engines import CORPUS_DIR
+
+SIZES_DIR = join(CORPUS_DIR, "sizes")
+
+# name: (measures, parts, image width, image height, staves on the image)
+SIZES = {
+    "small": (8, 1, 1000, 400, 2),
+    "medium": (64, 2, 1654, 2339, 10),
+    "large": (400, 4, 2480, 3508, 14),
+}
+
+
+def melody(pitches, lengths):
+    part = stream.Part()
+    for pitch, length in zip(pitches, lengths):
+        part.append(note.Note(pitch, quarterLength=length) if pitch else note.Rest(quarterLength=length))
+    return part
+
+
+def two_parts():
+    upper = melody(["C5", "D5", "E5", None, "G5", "E5", "C5", "D5"], [1, 1, 1, 1, 2, 1, 1, 4])
+    lower = melody(["C3", "G3", "E3", "G3", "C3", None, "F3", "G3"], [2, 2, 2, 2, 2, 2, 2, 2])
+    return stream.Score([upper, lower])
+
+
+def chords_and_ties():
+    part = stream.Part()
+    part.append(meter.TimeSignature("3/4"))
+    tied = chord.Chord(["C4", "E4", "G4"], quarterLength=3)
+    tied.tie = tie.Tie("start")
+    part.append(tied)
+    held = chord.Chord(["C4", "E4", "G4"], quarterLength=1)
+    held.tie = tie.Tie("stop")
+    part.append(held)
+    part.append(chord.Chord(["D4", "F4", "A4"], quarterLength=2))
+    return stream.Score([part])
+
+
+def two_voices():
+    measure = stream.Measure(number=1)
+    soprano = stream.Voice([note.Note(p, quarterLength=1) for p in ["E5", "D5", "C5", "D5"]])
+    alto = stream.Voice([note.Note("C4", quarterLength=2), note.Note("B3", quarterLength=2)])
+    measure.insert(0, soprano)
+    measure.insert(0, alto)
+    part = stream.Part([meter.TimeSignature("4/4"), measure])
+    return stream.Score([part])
+
+
+def piano():
+    right = stream.PartStaff(melody(["E5", "F5", "G5", "C6"], [1, 1, 1, 1]).elements)
+    left = stream.PartStaff(melody(["C3", "G2"], [2, 2]).elements)
+    score = stream.Score([right, left])
+    score.insert(0, layout.StaffGroup([right, left], symbol="brace"))
+    return score
+
+
+def triplets():
+    part = stream.Part()
+    for pitch in ["C4", "D4", "E4", "F4", "G4", "A4"]:
+        triplet = note.Note(pitch)
+        triplet.duration = duration.Duration(1 / 3)
+        part.append(triplet)
+    part.append(note.Note("C5", quarterLength=2))
+    return stream.Score([part])
+
+
+def pickup():
+    part = stream.Part()
+    anacrusis = stream.Measure(number=0)
+    anacrusis.append(meter.TimeSignature("4/4"))
+    anacrusis.append(note.Note("G4", quarterLength=1))
+    anacrusis.padAsAnacrusis()
+    part.append(anacrusis)
+    full = stream.Measure(number=1)
+    full.append([note.Note(p, quarterLength=1) for p in ["C5", "B4", "A4", "G4"]])
+    part.append(full)
+    return stream.Score([part])
+
+
+def tempo_and_dynamics():
+    part = stream.Part()
+    part.append(tempo.MetronomeMark(number=80))
+    part.append(dynamics.Dynamic("p"))
+    part.append([note.Note(p) for p in ["C4", "E4", "G4", "C5"]])
+    part.append(tempo.MetronomeMark(number=140))
+    part.append(dynamics.Dynamic("ff"))
+    part.append([note.Note(p) for p in ["C5", "G4", "E4", "C4"]])
+    return stream.Score([part])
+
+
+def instruments():
+    violin = melody(["A4", "B4", "C5", "D5"], [1, 1, 1, 1])
+    violin.insert(0, instrument.Violin())
+    cello = melody(["A2", "E3"], [2, 2])
+    cello.insert(0, instrument.Violoncello())
+    return stream.Score([violin, cello])
+
+
+def repeats():
+    part = stream.Part()
+    measure = stream.Measure(number=1)
+    measure.append([note.Note(p) for p in ["C4", "D4", "E4", "F4"]])
+    measure.leftBarline = bar.Repeat(direction="start")
+    measure.rightBarline = bar.Repeat(direction="end")
+    part.append(measure)
+    return stream.Score([part])
+
+
+def grace_notes():
+    part = stream.Part()
+    part.append(note.Note("D5").getGrace())
+    part.append(note.Note("C5", quarterLength=2))
+    part.append(note.Note("E5", quarterLength=2))
+    return stream.Score([part])
+
+
+SCORES = {
+    "two_parts": two_parts,
+    "chords_and_ties": chords_and_ties,
+    "two_voices": two_voices,
+    "piano": piano,
+    "triplets": triplets,
+    "pickup": pickup,
+    "tempo_and_dynamics": tempo_and_dynamics,
+    "instruments": instruments,
+    "repeats": repeats,
+    "grace_notes": grace_notes,
+}
+
+
+def generated_score(measures, parts, seed):
+    """A 4/4 score of random notes, rests and chords."""
+    rng = random.Random(seed)
+    score = stream.Score()
+    for index in range(parts):
+        part = stream.Part()
+        part.append(meter.TimeSignature("4/4"))
+        lowest = 60 - 12 * index
+        for number in range(1, measures + 1):
+            measure = stream.Measure(number=number)
+            remaining = 4.0
+            while remaining > 0:
+                length = min(rng.choice([0.5, 1.0, 1.0, 2.0]), remaining)
+                roll = rng.random()
+                if roll < 0.1:
+                    measure.append(note.Rest(quarterLength=length))
+                elif roll < 0.3:
+                    root = rng.randint(lowest, lowest + 12)
+                    measure.append(chord.Chord([root, root + 4, root + 7], quarterLength=length))
+                else:
+                    measure.append(note.Note(rng.randint(lowest, lowest + 19), quarterLength=length))
+                remaining -= length
+            part.append(measure)
+        score.insert(0, part)
+    return score
+
+
+def staff_shapes(width, height, staves, seed):
+    """Staff lines and note heads of a fake score page: (lines, heads) in pixels."""
+    rng = random.Random(seed)
+    lines, heads = [], []
+    margin = width // 12
+    spacing = max(6, height // (staves * 12))
+    for staff in range(staves):
+        top = (staff + 1) * height // (staves + 1) - 2 * spacing
+        for line in range(5):
+            y = top + line * spacing
+            lines.append((margin, y, width - margin, y))
+        for x in range(margin + 2 * spacing, width - margin - spacing, 3 * spacing):
+            y = top + rng.randint(-2, 10) * spacing // 2
+            heads.append((x, y, x + spacing + spacing // 3, y + spacing))
+    return lines, heads
+
+
+def write_png(path, width, height, staves, seed):
+    image = Image.new("L", (width, height), 255)
+    draw = ImageDraw.Draw(image)
+    lines, heads = staff_shapes(width, height, staves, seed)
+    for line in lines:
+        draw.line(line, fill=0, width=2)
+    for head in heads:
+        draw.ellipse(head, fill=0)
+    image.save(path, optimize=True)
+
+
+def write_svg(path, width, height, staves, seed):
+    lines, heads = staff_shapes(width, height, staves, seed)
+    shapes = [f'<line x1="{x1}" y1="{y1}" x2="{x2}" y2="{y2}" stroke="black" stroke-width="2"/>' for x1, y1, x2, y2 in lines]
+    shapes += [
+        f'<ellipse cx="{(x1 + x2) / 2}" cy="{(y1 + y2) / 2}" rx="{(x2 - x1) / 2}" ry="{(y2 - y1) / 2}"/>'
+        for x1, y1, x2, y2 in heads
+    ]
+    with open(path, "w") as f:
+        f.write(f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}">\n')
+        f.write(f'<rect width="{width}" height="{height}" fill="white"/>\n')
+        f.write("\n".join(shapes))
+        f.write("\n</svg>\n")
+
+
+def main():
+    Path(SIZES_DIR).mkdir(parents=True, exist_ok=True)
+    for name, build in SCORES.items():
+        path = join(CORPUS_DIR, f"{name}.mxl")
+        build().write("mxl", fp=path)
+        print(f"Wrote {path}")
+
+    for seed, (name, (measures, parts, width, height, staves)) in enumerate(SIZES.items()):
+        generated_score(measures, parts, seed).write("mxl", fp=join(SIZES_DIR, f"{name}.mxl"))
+        write_png(join(SIZES_DIR, f"{name}.png"), width, height, staves, seed)
+        write_svg(join(SIZES_DIR, f"{name}.svg"), width, height, staves, seed)
+        print(f"Wrote {SIZES_DIR}/{name}.mxl, .png and .svg")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+"""
+Times the stages of the conversion pipeline over the size corpus.
+
+Stages: validate_file, convert_svg_to_png (rendered and from the raster
+cache), preprocess_image, checkCorrectExport, mxl_to_midi (with each MIDI
+engine) and image_to_mxl (on the raw and on the preprocessed image, and
+one run stopped early by a fatal Audiveris message). image_to_mxl runs
+against benchmarks/fake_audiveris.py so no OMR engine is needed, unless
+--audiveris points to a real launcher: its "failures" then show whether
+preprocessing costs recognitions. Every case runs once to warm up and then --repeat times.
+The app runs on a temporary data directory.
+
+The raw and preprocessed image_to_mxl runs are then compared per size:
+whether preprocessing (its own time included) saves Audiveris more time
+than it takes.
+
+Results are written as JSON. With --baseline, the median of every case is
+compared with a previous run, and the exit code is 1 if any case got
+slower by more than --threshold (cases under a millisecond are ignored).
+
+Usage:
+    python -m benchmarks.run_pipeline [--repeat 5] [--audiveris-delay 0.5]
+        [--audiveris-delay-per-mpixel 0.2] [--audiveris /opt/audiveris/bin/Audiveris]
+        [--output results.json] [--baseline previous.json] [--threshold 0.25]
+"""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import uuid
+import logging
+import argparse
+import platform
+import tempfile
+import statistics
+from os.path import join, dirname, abspath
+from pathlib import Path
+from datetime import datetime, timezone
+from benchmarks import data_environment
+
+BENCHMARKS_DIR = dirname(abspath(__file__))
+SIZES_DIR = join(BENCHMARKS_DIR, "corpus", "sizes")
+RESULTS_DIR = join(BENCHMARKS_DIR, "results")
+FAKE_AUDIVERIS = join(BENCHMARKS_DIR, "fake_audiveris.py")
+SIZES = ("small", "medium", "large")
+
+# Lines of Audiveris output checkCorrectExport scans, per size.
+LOG_LINES = {"small": 50, "medium": 2000, "large": 50000}
+LOG_LINE = "INFO  [score] SheetStub 1  Step TEXTS done in 412 ms\n"
+
+# Differences below this many seconds are noise, not regressions.
+NOISE_FLOOR = 0.001
+
+
+def load_app(data_dir, audiveris_delay, audiveris_delay_per_mpixel=0.0, audiveris=None):
+    """Imports the app configured on a scratch data directory and the fake (or a real) Audiveris."""
+    os.environ.update(data_environment(data_dir))
+    os.environ["AUDIVERIS_PATH"] = audiveris or FAKE_AUDIVERIS
+    os.environ["AUDIVERIS_POOL_SIZE"] = "0"
+    os.environ["FAKE_AUDIVERIS_DELAY"] = str(audiveris_delay)
+    os.environ["FAKE_AUDIVERIS_DELAY_PER_MPIXEL"] = str(audiveris_delay_per_mpixel)
+
+    from app import app
+    app.logger.setLevel(logging.WARNING)
+    return app
+
+
+def cairosvg_available():
+    try:
+        import cairosvg
+        return True
+    except (ImportError, OSError):
+        return False
+
+
+def measure(run, repeat, allow_failures=False):
+    """
+    Runs a case once to warm up, then `repeat` times. Returns its timing summary.
+    With allow_failures, a run that raises is counted (by exception class) instead
+    of stopping the benchmark.
+    """
+    failures = {}
+
+    def attempt():
+        try:
+            run()
+        except Exception as e:
+            if not allow_failures:
+                raise
+            failures[type(e).__name__] = failures.get(type(e).__name__, 0) + 1
+
+    attempt()
+    failures.clear()
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        attempt()
+        timings.append(time.perf_counter() - started)
+
+    result = {
+        "runs": repeat,
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "mean": statistics.mean(timings),
+        "max": max(timings),
+    }
+    if allow_failures:
+        result["failures"] = failures
+    return result
+
+
+def cases(app, data_dir):
+    """Yields (name, run) for every benchmark case, or (name, reason) for skipped ones."""
+    from werkzeug.datastructures import FileStorage
+    from utils.validation import validate_file
+    from scripts.svg_to_png import convert_svg_to_png
+    from scripts.image_to_mxl import image_to_mxl, checkCorrectExport
+    from scripts.preprocess_image import preprocess_image
+    from scripts.mxl_to_midi import mxl_to_midi
+
+    for size in SIZES:
+        for extension in ("png", "svg"):
+            data = Path(join(SIZES_DIR, f"{size}.{extension}")).read_bytes()
+
+            def run(data=data, extension=extension):
+                is_valid, error = validate_file(FileStorage(io.BytesIO(data), filename=f"score.{extension}"))
+                if not is_valid:
+                    raise RuntimeError(error)
+
+            yield f"validate_file[{extension}]/{size}", run
+
+    svg_skip = None if cairosvg_available() else "cairosvg is not installed"
+    for cached in (False, True):
+        for size in SIZES:
+            name = f"convert_svg_to_png[{'cached' if cached else 'render'}]/{size}"
+            if svg_skip:
+                yield name, svg_skip
+                continue
+
+            def run(size=size, cached=cached):
+                if not cached:
+                    shutil.rmtree(app.config["RASTER_CACHE_FOLDER"], ignore_errors=True)
+                png_path = join(data_dir, f"{size}-{uuid.uuid4()}.png")
+                convert_svg_to_png(join(SIZES_DIR, f"{size}.svg"), png_path)
+                os.remove(png_path)
+
+            yield name, run
+
+    for size in SIZES:
+
+        def run(size=size):
+            output_path = join(data_dir, f"{size}-{uuid.uuid4()}.png")
+            preprocess_image(join(SIZES_DIR, f"{size}.png"), output_path)
+            os.remove(output_path)
+
+        yield f"preprocess_image/{size}", run
+
+    for size in SIZES:
+        stdout = LOG_LINE * LOG_LINES[size]
+        yield f"checkCorrectExport/{size}", lambda stdout=stdout: checkCorrectExport(stdout)
+
+    for engine in ("music21", "fast"):
+        for size in SIZES:
+
+            def run(size=size, engine=engine):
+                app.config["MIDI_ENGINE"] = engine
+                mxl_to_midi(join(SIZES_DIR, f"{size}.mxl"), str(uuid.uuid4()))
+
+            yield f"mxl_to_midi[{engine}]/{size}", run
+
+    for preprocess in (False, True):
+        for size in SIZES:
+            image_path = join(data_dir, f"{size}.png")
+            Path(image_path).write_bytes(Path(join(SIZES_DIR, f"{size}.png")).read_bytes())
+
+            def run(size=size, image_path=image_path, preprocess=preprocess):
+                app.config["PREPROCESS_IMAGES"] = preprocess
+                os.environ["FAKE_AUDIVERIS_SCORE"] = join(SIZES_DIR, f"{size}.mxl")
+                image_to_mxl(image_path, str(uuid.uuid4()))
+
+            yield f"image_to_mxl[{'preprocessed' if preprocess else 'raw'}]/{size}", run
+
+    # Audiveris reports a fatal problem early: the run is stopped instead of waiting for it to exit.
+    image_path = join(data_dir, "medium.png")
+
+    def run():
+        app.config["PREPROCESS_IMAGES"] = False
+        os.environ["FAKE_AUDIVERIS_LOG"] = "Too low interline value, try 300 DPI"
+        try:
+            image_to_mxl(image_path, str(uuid.uuid4()))
+        finally:
+            del os.environ["FAKE_AUDIVERIS_LOG"]
+
+    yield "image_to_mxl[fatal]/medium", run
+
+
+def preprocessing_deltas(results):
+    """
+    Compares the image_to_mxl runs on the preprocessed images with those on
+    the raw ones, per size. Returns {size: medians, their delta and change, failures}.
+    """
+    deltas = {}
+    for size in SIZES:
+        raw = results.get(f"image_to_mxl[raw]/{size}", {})
+        preprocessed = results.get(f"image_to_mxl[preprocessed]/{size}", {})
+        if "median" not in raw or "median" not in preprocessed:
+            continue
+        delta = preprocessed["median"] - raw["median"]
+        deltas[size] = {
+            "raw": raw["median"],
+            "preprocessed": preprocessed["median"],
+            "delta": delta,
+            "change": delta / raw["median"] if raw["median"] else 0,
+            "raw_failures": sum(raw.get("failures", {}).values()),
+            "preprocessed_failures": sum(preprocessed.get("failures", {}).values()),
+        }
+    return deltas
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints the median change of every case also in the baseline. Returns the
+    regressed case names: slower by more than the threshold, or failing more often.
+    """
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get("results", {}).get(name)
+        if "median" not in result or not before or "median" not in before:
+            continue
+        change = result["median"] / before["median"] - 1 if before["median"] else 0
+        regressed = change > threshold and result["median"] - before["median"] > NOISE_FLOOR
+        if sum(result.get("failures", {}).values()) > sum(before.get("failures", {}).values()):
+            regressed = True
+        print(f"{name:40} {before['median'] * 1000:10.2f} ms -> {result['median'] * 1000:10.2f} ms  {change:+7.1%}"
+              f"{'  REGRESSION' if regressed else ''}")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the conversion pipeline stages.")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per case")
+    parser.add_argument("--audiveris-delay", type=float, default=0.0, help="seconds the fake Audiveris takes per file")
+    parser.add_argument("--audiveris-delay-per-mpixel", type=float, default=0.0,
+                        help="extra seconds the fake Audiveris takes per megapixel of the image")
+    parser.add_argument("--audiveris", help="real Audiveris launcher to run image_to_mxl with, instead of the fake")
+    parser.add_argument("--output", help="results file (default benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--baseline", help="previous results file to compare with")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown of a median, 0.25 = 25%%")
+    args = parser.parse_args(argv)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as data_dir:
+        app = load_app(data_dir, args.audiveris_delay, args.audiveris_delay_per_mpixel, args.audiveris)
+        with app.app_context():
+            for name, run in cases(app, data_dir):
+                if isinstance(run, str):
+                    results[name] = {"skipped": run}
+                    print(f"{name:40} skipped: {run}")
+                    continue
+                results[name] = measure(run, args.repeat, allow_failures=name.startswith("image_to_mxl"))
+                failures = sum(results[name].get("failures", {}).values())
+                print(f"{name:40} median {results[name]['median'] * 1000:10.2f} ms"
+                      f"{f'  {failures}/{args.repeat} failed' if failures else ''}")
+
+    deltas = preprocessing_deltas(results)
+    if deltas:
+        print("\nPreprocessing (image_to_mxl on the preprocessed image vs the raw one):")
+        for size, delta in deltas.items():
+            verdict = "saves time" if delta["delta"] < -NOISE_FLOOR else "costs time" if delta["delta"] > NOISE_FLOOR else "no difference"
+            print(f"{size:8} {delta['raw'] * 1000:10.2f} ms -> {delta['preprocessed'] * 1000:10.2f} ms  "
+                  f"{delta['delta'] * 1000:+10.2f} ms {delta['change']:+7.1%}  {verdict}"
+                  f"  (failures {delta['raw_failures']} -> {delta['preprocessed_failures']})")
+
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "audiveris_delay": args.audiveris_delay,
+        "audiveris_delay_per_mpixel": args.audiveris_delay_per_mpixel,
+        "audiveris": args.audiveris or "fake",
+        "results": results,
+        "preprocessing": deltas,
+    }
+    output = args.output or join(RESULTS_DIR, f"{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(dirname(abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults saved in {output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"\nComparing with {args.baseline} (threshold {args.threshold:.0%}):")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s): {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,16 +1,30 @@
+import gc
+import os
+import time
 import logging
+from dotenv import load_dotenv
 # SysLogHandler and socket are no longer needed here
 # from logging.handlers import SysLogHandler 
 # import socket
 
+load_dotenv()
+config_loaded_at = time.perf_counter()
+
 # Basic Gunicorn configuration
 timeout = 600
 bind = "0.0.0.0:5000"
 workers = 3
-worker_class = "sync"
+# Threaded workers: progress streams (/api/jobs/<id>/events) and polls each hold
+# a thread, not a whole worker. Conversions per worker are still capped by SYNC_CONVERSIONS.
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", 16))
 loglevel = "info"
 secure_scheme_headers = {"X-Forwarded-Proto": "https"}
 
+# Import the app and warm it up once in the master; workers are forked from it
+# and share those pages copy-on-write instead of importing everything again.
+preload_app = os.getenv("PRELOAD_APP", "false").lower() == "true"
+
 # Configure logs to go to stdout/stderr for console output
 accesslog = "-"  # Send access log to stdout
 errorlog = "-"   # Send error log to stderr
@@ -50,4 +64,32 @@ logconfig_dict = {
     # 'handlers': ['console'],
     # 'level': 'INFO',
     # },
-}
\ No newline at end of file
+}
+
+
+def on_starting(server):
+    # Runs after the app is preloaded and before the signal handlers are set,
+    # so helper processes spawned by imports are not reaped as workers.
+    if preload_app:
+        from utils.startup import import_modules, warm_up
+        server.log.info(f"App loaded in the master in {time.perf_counter() - config_loaded_at:.2f}s")
+        import_modules(server.log)
+        warm_up(server.log)
+        # Objects created so far are never collected; the collector would
+        # otherwise write to them in every worker and un-share their pages.
+        gc.freeze()
+
+
+def when_ready(server):
+    from utils.startup import memory_usage, format_memory
+    server.log.info(f"Master ready: {format_memory(memory_usage())}")
+
+
+def post_fork(server, worker):
+    worker.forked_at = time.perf_counter()
+
+
+def post_worker_init(worker):
+    from utils.startup import memory_usage, format_memory
+    boot_time = time.perf_counter() - worker.forked_at
+    worker.log.info(f"Worker {worker.pid} booted in {boot_time:.2f}s: {format_memory(memory_usage())}")
@@ -0,0 +1,209 @@
+import os
+import time
+import queue
+import shutil
+import secrets
+import threading
+import subprocess
+from os.path import join
+from flask import current_app
+from scripts.audiveris_pool import OutputScanner, run_audiveris
+
+_batcher = None
+_batcher_pid = None
+_batcher_lock = threading.Lock()
+
+
+class BatchJob:
+    """An image waiting for, then transcribed in, a batch run."""
+
+    def __init__(self, image_path, output_dir, on_step):
+        self.image_path = image_path
+        self.output_dir = output_dir
+        self.stem, self.extension = os.path.splitext(os.path.basename(image_path))
+        # Audiveris names a book (and its log lines and output) after its input file.
+        self.key = f"{self.stem}-{secrets.token_hex(4)}"
+        self.scanner = OutputScanner(on_step)
+        self.last_line = self.scanner.started
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class BatchScanner:
+    """
+    Reads the output of a batch run and hands each line to the scanner of
+    the job it belongs to: the last job whose book name was printed (books
+    are transcribed one after the other). Lines printed before any book,
+    such as JVM errors, go to every job.
+
+    A fatal marker only concerns its job, so the run is never stopped early.
+    """
+
+    def __init__(self, jobs):
+        self.started = time.monotonic()
+        self.lines = []
+        self.fatal = None
+        self.jobs = jobs
+        self.current = None
+
+    def feed(self, line):
+        self.lines.append(line)
+        for job in self.jobs:
+            if job.key in line:
+                self.current = job
+                break
+        for job in [self.current] if self.current else self.jobs:
+            job.scanner.feed(line)
+            job.last_line = time.monotonic()
+
+    @property
+    def stdout(self):
+        return "".join(self.lines)
+
+    def steps(self, total):
+        # Per-job steps are read from the jobs' scanners.
+        return {}
+
+
+class AudiverisBatcher:
+    """
+    Groups the images submitted within AUDIVERIS_BATCH_WINDOW_MS of the
+    first one (up to AUDIVERIS_BATCH_MAX_SIZE) into a single Audiveris run,
+    so the JVM starts once per batch instead of once per image.
+    """
+
+    def __init__(self, app, window, max_size):
+        self.app = app
+        self.window = window
+        self.max_size = max_size
+        self._queue = queue.Queue()
+        threading.Thread(target=self._collect, name="audiveris-batcher", daemon=True).start()
+
+    def submit(self, image_path, output_dir, timeout, on_step=None):
+
+        """
+        Transcribes an image in the next batch and waits for it.
+
+        Returns:
+            The image's subprocess.CompletedProcess (see run_process), with
+            only its own output, fatal marker and steps, and its share of the
+            batch's CPU time. Its MXL is moved into `output_dir`.
+
+        Raises:
+            subprocess.TimeoutExpired: If the batch takes longer than
+                `timeout` seconds and this image was not transcribed by
+                then. Like a run of its own, an image never waits for more
+                than `timeout` (after the batching window), however many
+                images are batched with it.
+        """
+
+        job = BatchJob(image_path, output_dir, on_step)
+        self._queue.put((job, timeout))
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _collect(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            threading.Thread(target=self._run, args=(batch,), name="audiveris-batch", daemon=True).start()
+
+    def _run(self, batch):
+        jobs = [job for job, _ in batch]
+        try:
+            with self.app.app_context():
+                if len(jobs) == 1:
+                    self._run_one(jobs[0], batch[0][1])
+                else:
+                    self._run_batch(jobs, min(timeout for _, timeout in batch))
+        except BaseException as e:
+            for job in jobs:
+                job.error = e
+        finally:
+            for job in jobs:
+                job.done.set()
+
+    def _run_one(self, job, timeout):
+        # A lone image runs as usual, and is stopped at its first fatal marker.
+        args = ["-batch", "-export", "-output", job.output_dir, "--", job.image_path]
+        job.result = run_audiveris(args, timeout, on_step=job.scanner.on_step)
+
+    def _run_batch(self, jobs, timeout):
+        batch_dir = join(current_app.config.get("AUDIVERIS_OUTPUT"), "batches", secrets.token_hex(8))
+        inputs_dir = join(batch_dir, "inputs")
+        os.makedirs(inputs_dir)
+        try:
+            # Inputs are linked under unique names, so jobs' outputs and log lines cannot collide.
+            inputs = []
+            for job in jobs:
+                input_path = join(inputs_dir, f"{job.key}{job.extension}")
+                os.symlink(os.path.abspath(job.image_path), input_path)
+                inputs.append(input_path)
+
+            current_app.logger.info(f"Running one Audiveris process for a batch of {len(jobs)} images")
+            scanner = BatchScanner(jobs)
+            args = ["-batch", "-export", "-output", batch_dir, "--", *inputs]
+            try:
+                result = run_audiveris(args, timeout, scanner=scanner)
+            except subprocess.TimeoutExpired as e:
+                if getattr(e, "usage", None) is None or scanner.current is None:
+                    raise
+                # Books are transcribed in order: the ones before the current book are done and keep their score.
+                finished = jobs[:jobs.index(scanner.current)]
+                current_app.logger.warning(f"Audiveris batch timed out after {timeout} seconds, "
+                                           f"{len(finished)} of {len(jobs)} images transcribed")
+                for job in jobs[len(finished):]:
+                    job.error = e
+                jobs = finished
+                # Audiveris was done with the finished books when it was killed.
+                result = subprocess.CompletedProcess(e.cmd, 0)
+                result.usage = e.usage
+
+            usage = {**result.usage, "cpu_seconds": round(result.usage["cpu_seconds"] / len(inputs), 3)}
+            for job in jobs:
+                self._collect_output(job, batch_dir)
+                job.result = subprocess.CompletedProcess(result.args, result.returncode, stdout=job.scanner.stdout)
+                job.result.fatal = job.scanner.fatal
+                job.result.steps = job.scanner.steps(job.last_line - job.scanner.started)
+                job.result.usage = usage
+        finally:
+            shutil.rmtree(batch_dir, ignore_errors=True)
+
+    def _collect_output(self, job, batch_dir):
+        """Moves a job's MXL, if any, where a run of its own would have written it."""
+        os.makedirs(job.output_dir, exist_ok=True)
+        try:
+            shutil.move(join(batch_dir, f"{job.key}.mxl"), join(job.output_dir, f"{job.stem}.mxl"))
+        except FileNotFoundError:
+            pass
+
+
+def get_batcher():
+    """
+    Returns this process' batcher, creating it on first use.
+    Returns None when batching is disabled (AUDIVERIS_BATCH_WINDOW_MS=0).
+    """
+    global _batcher, _batcher_pid
+
+    window = current_app.config.get("AUDIVERIS_BATCH_WINDOW_MS", 0) / 1000
+    max_size = current_app.config.get("AUDIVERIS_BATCH_MAX_SIZE", 1)
+    if window <= 0 or max_size <= 1:
+        return None
+
+    # Threads do not survive a fork: every gunicorn worker starts its own.
+    with _batcher_lock:
+        if _batcher_pid != os.getpid():
+            _batcher = AudiverisBatcher(current_app._get_current_object(), window, max_size)
+            _batcher_pid = os.getpid()
+    return _batcher
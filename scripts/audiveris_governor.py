@@ -0,0 +1,222 @@
+import os
+import time
+import fcntl
+import shutil
+import threading
+import subprocess
+from os.path import join
+from contextlib import contextmanager
+from flask import current_app
+
+# Native memory of an Audiveris JVM besides its heap (metaspace, code cache, threads, buffers), in MB.
+JVM_OVERHEAD_MB = 384
+# A job gets at least this heap and this many CPUs when the number of slots is derived.
+MIN_HEAP_MB = 1024
+MIN_CPUS_PER_JOB = 2
+
+# How often (seconds) a job waiting for a slot tries again.
+SLOT_POLL_INTERVAL = 0.2
+
+_plan = None
+_plan_pid = None
+_plan_lock = threading.Lock()
+
+
+def available_cpus():
+    """CPUs this process may run on, within the container's CPU quota (cgroup v2 or v1)."""
+    cpus = len(os.sched_getaffinity(0))
+    quota = None
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            limit, period = f.read().split()
+            if limit != "max":
+                quota = int(limit) / int(period)
+    except (FileNotFoundError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f, open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as g:
+                limit, period = int(f.read()), int(g.read())
+                if limit > 0:
+                    quota = limit / period
+        except (FileNotFoundError, ValueError):
+            pass
+    if quota is not None:
+        cpus = min(cpus, max(1, int(quota)))
+    return cpus
+
+
+def available_memory_mb():
+    """Memory of the host, or of the container when its cgroup (v2 or v1) sets a lower limit, in MB."""
+    with open("/proc/meminfo") as f:
+        memory = next(int(line.split()[1]) * 1024 for line in f if line.startswith("MemTotal:"))
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                limit = f.read().strip()
+            if limit != "max":
+                memory = min(memory, int(limit))
+            break
+        except (FileNotFoundError, ValueError):
+            continue
+    return memory // (1024 * 1024)
+
+
+def make_plan(cpus, memory_mb, slots=0, memory_fraction=0.75, max_heap_mb=4096):
+
+    """
+    Splits the CPUs and the Audiveris share of the memory between
+    concurrent Audiveris jobs.
+
+    Args:
+        cpus: Available CPUs.
+        memory_mb: Available memory, in MB.
+        slots: Jobs at a time on the host (0 = as many as fit with
+            MIN_CPUS_PER_JOB CPUs and a MIN_HEAP_MB heap each, at least 1).
+        memory_fraction: Share of the memory for the Audiveris JVMs.
+        max_heap_mb: Largest heap of a job.
+
+    Returns:
+        dict: slots, cpus_per_job, heap_mb (the -Xmx of each JVM) and the
+        CPU set of each slot (cpu_sets), for pinning.
+    """
+
+    budget_mb = int(memory_mb * memory_fraction)
+    if slots <= 0:
+        slots = max(1, min(cpus // MIN_CPUS_PER_JOB, budget_mb // (MIN_HEAP_MB + JVM_OVERHEAD_MB)))
+
+    cpus_per_job = max(1, cpus // slots)
+    heap_mb = max(256, min(max_heap_mb, budget_mb // slots - JVM_OVERHEAD_MB))
+
+    # Slot i runs on its own CPUs while there are enough; beyond that, slots share them round-robin.
+    cpu_ids = sorted(os.sched_getaffinity(0))[:cpus]
+    cpu_sets = [
+        sorted({cpu_ids[(index * cpus_per_job + offset) % len(cpu_ids)] for offset in range(cpus_per_job)})
+        for index in range(slots)
+    ]
+    return {"slots": slots, "cpus_per_job": cpus_per_job, "heap_mb": heap_mb, "cpu_sets": cpu_sets}
+
+
+def get_plan():
+    """Returns the plan of this host, derived once per (forked) worker from the config and the resources."""
+    global _plan, _plan_pid
+    with _plan_lock:
+        if _plan_pid != os.getpid():
+            config = current_app.config
+            cpus, memory_mb = available_cpus(), available_memory_mb()
+            _plan = make_plan(
+                cpus,
+                memory_mb,
+                slots=config.get("AUDIVERIS_SLOTS", 0),
+                memory_fraction=config.get("AUDIVERIS_MEMORY_FRACTION", 0.75),
+                max_heap_mb=config.get("AUDIVERIS_MAX_HEAP_MB", 4096),
+            )
+            _plan_pid = os.getpid()
+            current_app.logger.info(
+                f"Audiveris governor: {cpus} CPUs, {memory_mb} MB -> {_plan['slots']} jobs at a time, "
+                f"{_plan['cpus_per_job']} CPUs and -Xmx{_plan['heap_mb']}m each"
+            )
+        return _plan
+
+
+def jvm_options(plan):
+    """JVM options that size a job's heap and threads (GC, JIT, Audiveris' own pools) to its slot."""
+    return " ".join([
+        f"-Xmx{plan['heap_mb']}m",
+        f"-XX:ActiveProcessorCount={plan['cpus_per_job']}",
+        # A job that runs out of heap fails at once instead of thrashing in GC.
+        "-XX:+ExitOnOutOfMemoryError",
+    ])
+
+
+class Slot:
+    """
+    A claimed Audiveris slot: how to start a job's process within it.
+
+    Its CPUs, niceness and limits are set by prlimit, taskset and nice
+    (util-linux and coreutils), which exec the Audiveris launcher: no
+    Python runs in the child between fork and exec, which is unsafe in a
+    threaded process. Limits whose tool is missing are skipped.
+    """
+
+    def __init__(self, index, plan, nice, pin_cpus, cpu_seconds):
+        self.index = index
+        self.cpus = plan["cpu_sets"][index] if pin_cpus else None
+        self.jvm_options = jvm_options(plan)
+        self.nice = nice
+        self.cpu_seconds = cpu_seconds
+
+    def environment(self, env=None):
+        """The job's environment, with the slot's JVM options before any set by the operator (which win)."""
+        env = dict(os.environ if env is None else env)
+        env["JAVA_OPTS"] = f"{self.jvm_options} {env.get('JAVA_OPTS', '')}".strip()
+        return env
+
+    def command(self, command):
+        """The job's command, run within the slot's limits, CPUs and niceness."""
+        limits = ["--core=0"] + ([f"--cpu={self.cpu_seconds}"] if self.cpu_seconds else [])
+        prefix = [
+            ("prlimit", limits),
+            ("taskset", ["-c", ",".join(str(cpu) for cpu in self.cpus)] if self.cpus else None),
+            ("nice", ["-n", str(self.nice)] if self.nice else None),
+        ]
+        wrapped = []
+        for tool, args in prefix:
+            if args is None:
+                continue
+            path = shutil.which(tool)
+            if path is None:
+                _warn_missing(tool)
+                continue
+            wrapped += [path, *args]
+        return [*wrapped, *command]
+
+
+_warned = set()
+
+
+def _warn_missing(tool):
+    if tool not in _warned:
+        _warned.add(tool)
+        current_app.logger.warning(f"Audiveris governor: {tool} not found, its limits are not applied.")
+
+
+@contextmanager
+def slot(timeout):
+
+    """
+    Claims one of the host's Audiveris slots for a job that runs for up to
+    `timeout` seconds, waiting as long for one. Slots are lock files in AUDIVERIS_SLOTS_DIR,
+    so the cap holds across every gunicorn worker and job thread.
+
+    Raises:
+        subprocess.TimeoutExpired: If no slot frees up in time.
+    """
+
+    plan = get_plan()
+    slots_dir = current_app.config.get("AUDIVERIS_SLOTS_DIR")
+    os.makedirs(slots_dir, exist_ok=True)
+
+    deadline = time.monotonic() + timeout
+    while True:
+        for index in range(plan["slots"]):
+            lock = open(join(slots_dir, f"slot-{index}.lock"), "w")
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock.close()
+                continue
+            try:
+                # The CPU time limit backs the wall-clock timeout up, should the kill fail.
+                yield Slot(
+                    index,
+                    plan,
+                    nice=current_app.config.get("AUDIVERIS_NICE", 0),
+                    pin_cpus=current_app.config.get("AUDIVERIS_PIN_CPUS", True),
+                    cpu_seconds=2 * timeout * plan["cpus_per_job"],
+                )
+            finally:
+                lock.close()
+            return
+
+        if time.monotonic() > deadline:
+            raise subprocess.TimeoutExpired("audiveris slot", timeout)
+        time.sleep(SLOT_POLL_INTERVAL)
@@ -0,0 +1,370 @@
+import os
+import re
+import time
+import queue
+import signal
+import subprocess
+import threading
+from os.path import join
+from pathlib import Path
+from flask import current_app
+from scripts import audiveris_governor
+from utils.Exceptions import ScoreQualityError, ScoreStructureError, ScoreTooLargeImageError
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# Output that means the transcription has failed, checked in this order.
+FATAL_MARKERS = (
+    ("java.lang.NullPointerException", ScoreStructureError),
+    ("try 300 DPI", ScoreQualityError),
+    ("Too large image", ScoreTooLargeImageError),
+)
+
+# The OMR steps Audiveris goes through for every sheet, in order.
+STEPS = ("LOAD", "BINARY", "SCALE", "GRID", "HEADERS", "STEM_SEEDS", "BEAMS", "LEDGERS", "HEADS", "STEMS",
+         "REDUCTION", "CUE_BEAMS", "TEXTS", "MEASURES", "CHORDS", "CURVES", "SYMBOLS", "LINKS", "RHYTHMS", "PAGE")
+STEP_PATTERN = re.compile(r"\b(" + "|".join(STEPS) + r")\b")
+
+# How often (seconds) a running process is checked for exit, fatal output and timeout.
+POLL_INTERVAL = 0.1
+
+
+class OutputScanner:
+    """
+    Reads Audiveris output as it is printed: keeps it, notes the first fatal
+    marker, and timestamps the first line that mentions each OMR step (and
+    calls on_step(step) then).
+    """
+
+    def __init__(self, on_step=None):
+        self.started = time.monotonic()
+        self.lines = []
+        self.fatal = None
+        self.step_times = {}
+        self.on_step = on_step
+
+    def feed(self, line):
+        self.lines.append(line)
+        if self.fatal is None:
+            for marker, _ in FATAL_MARKERS:
+                if marker in line:
+                    self.fatal = marker
+                    break
+        for step in STEP_PATTERN.findall(line):
+            if step not in self.step_times:
+                self.step_times[step] = time.monotonic() - self.started
+                if self.on_step:
+                    self.on_step(step)
+
+    @property
+    def stdout(self):
+        return "".join(self.lines)
+
+    def steps(self, total):
+        """Seconds spent in each step seen, up to the next step (or the end of the run, `total`)."""
+        seen = sorted(self.step_times.items(), key=lambda item: item[1])
+        ends = [started for _, started in seen[1:]] + [total]
+        return {step: round(end - started, 3) for (step, started), end in zip(seen, ends)}
+
+
+def _reap(process, block=False):
+    """
+    Collects the exit status of a process with wait4, which also returns its
+    resource usage. Returns the usage, or None while the process runs.
+    """
+    pid, status, usage = os.wait4(process.pid, 0 if block else os.WNOHANG)
+    if pid == 0:
+        return None
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return usage
+
+
+def _kill(process):
+    # The launcher is a shell script that starts the JVM: kill its whole process group.
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    return _reap(process, block=True)
+
+
+def _usage(rusage):
+    # ru_maxrss is in KB on Linux
+    return {"peak_rss_mb": round(rusage.ru_maxrss / 1024, 1), "cpu_seconds": round(rusage.ru_utime + rusage.ru_stime, 3)}
+
+
+def run_process(command, timeout, env=None, on_step=None, slot=None, scanner=None, jvm_options=None):
+
+    """
+    Runs an Audiveris command, reading its output (stdout and stderr) line by
+    line as it is printed. The process is killed as soon as a FATAL_MARKERS
+    line appears, instead of letting it run until it exits or times out.
+    `on_step(step)` is called, from the reading thread, as each OMR step starts.
+    With a governor `slot`, the process runs with its JVM options, CPUs,
+    niceness and limits. A `scanner` (with OutputScanner's interface)
+    replaces the default one, e.g. to split the output of a batch run.
+    `jvm_options` are added to the JVM's JAVA_OPTS.
+
+    Returns:
+        subprocess.CompletedProcess, with three extra attributes: `fatal`,
+        the marker that stopped the run (or None), `steps`, the seconds spent
+        in each OMR step, and `usage`, the peak RSS (MB) and CPU time
+        (seconds) of the process.
+
+    Raises:
+        subprocess.TimeoutExpired: If the job takes longer than `timeout`.
+            Its `usage` is that of the killed process.
+    """
+
+    scanner = scanner or OutputScanner(on_step)
+    if jvm_options:
+        env = dict(os.environ if env is None else env)
+        env["JAVA_OPTS"] = f"{env.get('JAVA_OPTS', '')} {jvm_options}".strip()
+    popen_command = command
+    if slot is not None:
+        env = slot.environment(env)
+        popen_command = slot.command(command)
+    process = subprocess.Popen(popen_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+                               errors="replace", env=env, start_new_session=True)
+
+    def read():
+        for line in process.stdout:
+            scanner.feed(line)
+
+    reader = threading.Thread(target=read, name="audiveris-output", daemon=True)
+    reader.start()
+
+    usage = None
+    try:
+        while True:
+            usage = _reap(process)
+            if usage is not None:
+                break
+            if scanner.fatal:
+                current_app.logger.warning(f"Audiveris printed '{scanner.fatal}', stopping it early.")
+                usage = _kill(process)
+                break
+            if time.monotonic() - scanner.started > timeout:
+                usage = _kill(process)
+                reader.join(timeout=1)
+                error = subprocess.TimeoutExpired(command, timeout, output=scanner.stdout)
+                error.usage = _usage(usage)
+                raise error
+            # Returns early when the output ends, which is usually when the process exits.
+            reader.join(timeout=POLL_INTERVAL)
+            if not reader.is_alive():
+                time.sleep(POLL_INTERVAL)
+    except BaseException:
+        if process.returncode is None:
+            _kill(process)
+        raise
+    finally:
+        reader.join(timeout=5)
+        process.stdout.close()
+
+    result = subprocess.CompletedProcess(command, process.returncode, stdout=scanner.stdout)
+    result.fatal = scanner.fatal
+    result.steps = scanner.steps(time.monotonic() - scanner.started)
+    result.usage = _usage(usage)
+    return result
+
+
+class AudiverisWorker:
+    """
+    A reusable Audiveris slot.
+
+    The Audiveris CLI has no resident/server mode, so a worker cannot keep one
+    JVM alive between jobs. Instead each worker owns a JVM class-data-sharing
+    archive (AppCDS) that the JVM creates on the first run and maps on every
+    following run, which removes most of the JVM startup and class loading cost.
+    """
+
+    def __init__(self, worker_id, audiveris_path, archive_dir, max_jobs):
+        self.worker_id = worker_id
+        self.audiveris_path = audiveris_path
+        self.archive_dir = archive_dir
+        self.max_jobs = max_jobs
+        self.jobs_done = 0
+        self.generation = 0
+        self.healthy = False
+
+    @property
+    def archive_path(self):
+        return join(self.archive_dir, f"worker-{os.getpid()}-{self.worker_id}.jsa")
+
+    def environment(self):
+        """Environment for the Audiveris launcher with this worker's JVM options."""
+        env = os.environ.copy()
+        jvm_options = f"-XX:SharedArchiveFile={self.archive_path} -XX:+AutoCreateSharedArchive"
+        env['AUDIVERIS_OPTS'] = f"{env.get('AUDIVERIS_OPTS', '')} {jvm_options}".strip()
+        return env
+
+    def check_health(self):
+        """A worker is healthy while the launcher is executable and its archive dir is writable."""
+        self.healthy = (
+            os.path.isfile(self.audiveris_path)
+            and os.access(self.audiveris_path, os.X_OK)
+            and os.access(self.archive_dir, os.W_OK)
+        )
+        return self.healthy
+
+    def recycle(self):
+        """Drop the worker's archive so the next run rebuilds it from scratch."""
+        try:
+            os.remove(self.archive_path)
+        except FileNotFoundError:
+            pass
+        self.jobs_done = 0
+        self.generation += 1
+        current_app.logger.info(f"Audiveris worker {self.worker_id} recycled (generation {self.generation})")
+
+    def run(self, args, timeout, on_step=None, slot=None, scanner=None, jvm_options=None):
+        """
+        Runs one Audiveris job on this worker.
+
+        Args:
+            args: Audiveris CLI arguments (without the executable).
+            timeout: Seconds before the process is killed.
+            on_step: Called with each OMR step as it starts.
+            slot: The governor slot the job runs in, if any.
+            scanner: Reads the job's output instead of an OutputScanner.
+            jvm_options: Extra JVM options of this job.
+
+        Returns:
+            The subprocess.CompletedProcess of the run (see run_process).
+        """
+        command = [self.audiveris_path, *args]
+        try:
+            return run_process(command, timeout, env=self.environment(), on_step=on_step, slot=slot, scanner=scanner,
+                               jvm_options=jvm_options)
+        except OSError:
+            self.healthy = False
+            raise
+        finally:
+            self.jobs_done += 1
+            if self.max_jobs and self.jobs_done >= self.max_jobs:
+                self.recycle()
+
+
+class AudiverisPool:
+    """A fixed-size pool of Audiveris workers. Jobs go to whichever worker is idle."""
+
+    def __init__(self, size, audiveris_path, archive_dir, max_jobs):
+        Path(archive_dir).mkdir(parents=True, exist_ok=True)
+        self.size = size
+        self.audiveris_path = audiveris_path
+        self.archive_dir = archive_dir
+        self.max_jobs = max_jobs
+        self._idle = queue.Queue()
+        self._next_id = 0
+        self._healthy = 0
+        self._lock = threading.Lock()
+        for _ in range(size):
+            worker = self._new_worker()
+            if worker.check_health():
+                self._healthy += 1
+                self._idle.put(worker)
+
+    def _new_worker(self):
+        self._next_id += 1
+        return AudiverisWorker(self._next_id, self.audiveris_path, self.archive_dir, self.max_jobs)
+
+    def healthy_workers(self):
+        """Number of healthy workers, busy or idle."""
+        return self._healthy
+
+    def run(self, args, timeout, wait=True, on_step=None, slot=None, scanner=None, jvm_options=None, wait_timeout=None):
+        """
+        Runs a job on the first idle worker, waiting up to `wait_timeout`
+        (by default `timeout`) seconds for one, or not at all when `wait` is
+        False.
+
+        Returns:
+            The subprocess.CompletedProcess of the run, or None if no healthy
+            worker is available (the caller falls back to one-shot mode).
+        """
+        try:
+            worker = self._idle.get(timeout=timeout if wait_timeout is None else wait_timeout) if wait else self._idle.get_nowait()
+        except queue.Empty:
+            return None
+
+        try:
+            return worker.run(args, timeout, on_step, slot, scanner, jvm_options)
+        finally:
+            if not worker.check_health():
+                current_app.logger.warning(f"Audiveris worker {worker.worker_id} failed its health check, replacing it.")
+                with self._lock:
+                    worker = self._new_worker()
+                    if not worker.check_health():
+                        self._healthy -= 1
+            if worker.healthy:
+                self._idle.put(worker)
+
+
+def get_audiveris_pool():
+    """
+    Returns this process' Audiveris pool, creating it on first use.
+    Returns None when the pool is disabled (AUDIVERIS_POOL_SIZE=0).
+    """
+    global _pool
+
+    size = current_app.config.get("AUDIVERIS_POOL_SIZE", 0)
+    if size <= 0:
+        return None
+
+    # The pool is created lazily so every gunicorn worker gets its own after fork.
+    with _pool_lock:
+        if _pool is None:
+            _pool = AudiverisPool(
+                size=size,
+                audiveris_path=current_app.config.get("AUDIVERIS_PATH"),
+                archive_dir=current_app.config.get("AUDIVERIS_WORKERS_DIR"),
+                max_jobs=current_app.config.get("AUDIVERIS_POOL_MAX_JOBS", 0),
+            )
+            current_app.logger.info(f"Audiveris pool started with {_pool.healthy_workers()}/{size} healthy workers")
+    return _pool
+
+
+def run_audiveris(args, timeout, wait=True, on_step=None, scanner=None, jvm_options=None):
+    """
+    Runs Audiveris with the given arguments, on the pool if it is enabled and
+    healthy, otherwise as a one-shot process. With `wait=False` a busy pool
+    also falls back to a one-shot process instead of queueing the job.
+    `on_step(step)` is called as each OMR step starts, unless a `scanner`
+    reads the output instead (see run_process). `jvm_options` are added to
+    the JVM's options, e.g. to record it with Java Flight Recorder.
+
+    With AUDIVERIS_GOVERNOR, the job first claims one of the host's
+    Audiveris slots (see audiveris_governor), which caps the JVMs running
+    at a time and sizes each one to its share of the CPUs and memory.
+
+    The waits for a slot and for an idle worker share one `timeout`
+    between them; the run itself then gets its own.
+
+    Raises:
+        subprocess.TimeoutExpired: If the job takes longer than `timeout`,
+            or waits longer than that for a slot.
+    """
+    deadline = time.monotonic() + timeout
+    if not current_app.config.get("AUDIVERIS_GOVERNOR"):
+        return _run_audiveris(args, timeout, wait, on_step, None, scanner, jvm_options, deadline)
+
+    with audiveris_governor.slot(timeout) as slot:
+        return _run_audiveris(args, timeout, wait, on_step, slot, scanner, jvm_options, deadline)
+
+
+def _run_audiveris(args, timeout, wait, on_step, slot, scanner, jvm_options, deadline):
+    pool = get_audiveris_pool()
+
+    if pool is not None and pool.healthy_workers() > 0:
+        # Only the time the slot left is spent waiting for a worker.
+        wait_timeout = max(0, deadline - time.monotonic())
+        result = pool.run(args, timeout, wait=wait, on_step=on_step, slot=slot, scanner=scanner, jvm_options=jvm_options,
+                          wait_timeout=wait_timeout)
+        if result is not None:
+            return result
+        current_app.logger.warning("No idle Audiveris worker available, falling back to one-shot mode.")
+
+    command = [current_app.config.get("AUDIVERIS_PATH"), *args]
+    return run_process(command, timeout, on_step=on_step, slot=slot, scanner=scanner, jvm_options=jvm_options)
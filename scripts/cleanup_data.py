@@ -13,6 +13,16 @@ def clean_data():
   for path in paths:
     cleanup_directory(path)
 
+def cleanup_job(_uuid, keep_mxl=False):
+  """
+    Removes the intermediate files of one job (its Audiveris output, and
+    its MXL directory unless keep_mxl), leaving the files of other jobs in
+    flight alone.
+  """
+  folders = ("AUDIVERIS_OUTPUT",) if keep_mxl else ("AUDIVERIS_OUTPUT", "MXL_FOLDER")
+  for folder in folders:
+    shutil.rmtree(os.path.join(current_app.config.get(folder), _uuid), ignore_errors=True)
+
 def cleanup_directory(dir):
   
   for filename in os.listdir(dir):
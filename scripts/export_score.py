@@ -0,0 +1,91 @@
+import os
+import zipfile
+import tempfile
+from os.path import basename, dirname, join, splitext
+from xml.etree import ElementTree
+from flask import current_app
+from werkzeug.utils import secure_filename
+from utils import metrics
+
+# Formats derived from a job's stored MXL: format -> (file extension, mimetype).
+# "mxl" (the MXL itself) and "midi" (the MIDI of the upload) are served as stored.
+EXPORT_FORMATS = {
+    "musicxml": ("musicxml", "application/vnd.recordare.musicxml+xml"),
+    "midi-parts": ("midi.zip", "application/zip"),
+    "braille": ("txt", "text/plain"),
+}
+
+
+def export_path(mxl_path, fmt):
+    """Where the export of an MXL to `fmt` is cached: next to the MXL, so it expires with it."""
+    extension, _ = EXPORT_FORMATS[fmt]
+    return join(dirname(mxl_path), "exports", fmt, f"{splitext(basename(mxl_path))[0]}.{extension}")
+
+
+def export_score(mxl_path, fmt):
+
+    """
+    Converts a stored MXL to another format, once: later calls return the
+    cached file. Only the MXL is read, Audiveris never runs again.
+
+    Args:
+        mxl_path: Path to the MXL of a job.
+        fmt: A key of EXPORT_FORMATS.
+
+    Returns:
+        The path of the exported file.
+    """
+
+    output_path = export_path(mxl_path, fmt)
+    if os.path.exists(output_path):
+        return output_path
+
+    os.makedirs(dirname(output_path), exist_ok=True)
+    # Write next to the cached file, then publish it atomically.
+    fd, tmp_path = tempfile.mkstemp(dir=dirname(output_path), suffix=".tmp")
+    os.close(fd)
+    try:
+        with metrics.timed(f"export.{fmt}"):
+            WRITERS[fmt](mxl_path, tmp_path)
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    current_app.logger.info(f"Exported {basename(mxl_path)} to {fmt}: {output_path}")
+    return output_path
+
+
+def _write_musicxml(mxl_path, output_path):
+    """Extracts the uncompressed MusicXML of an MXL, without parsing the score."""
+    with zipfile.ZipFile(mxl_path) as archive:
+        container = ElementTree.fromstring(archive.read("META-INF/container.xml"))
+        rootfile = container.find(".//rootfile")
+        with open(output_path, "wb") as f:
+            f.write(archive.read(rootfile.get("full-path")))
+
+
+def _write_midi_parts(mxl_path, output_path):
+    """Writes a zip with one MIDI file per part of the score."""
+    from music21 import converter
+
+    score = converter.parse(mxl_path)
+    with zipfile.ZipFile(output_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for number, part in enumerate(score.parts, start=1):
+            name = secure_filename(part.partName or "") or f"Part_{number}"
+            midi_path = part.write("midi", fp=f"{output_path}.part.mid")
+            archive.write(midi_path, f"{number:02d}_{name}.mid")
+            os.remove(midi_path)
+
+
+def _write_braille(mxl_path, output_path):
+    from music21 import converter
+
+    converter.parse(mxl_path).write("braille", fp=output_path)
+
+
+WRITERS = {
+    "musicxml": _write_musicxml,
+    "midi-parts": _write_midi_parts,
+    "braille": _write_braille,
+}
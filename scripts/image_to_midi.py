@@ -2,8 +2,9 @@ from scripts.mxl_to_midi import mxl_to_midi
 from scripts.image_to_mxl import image_to_mxl
 import traceback
 from flask import current_app
+from utils import progress
 
-def image_to_midi(image_path, _uuid): 
+def image_to_midi(image_path, _uuid, report=None): 
 
   """
     Converts a IMAGE file into a MIDI file.
@@ -14,6 +15,8 @@ def image_to_midi(image_path, _uuid):
     Args: 
       image_path: Path to the PNG file.
       _uuid: Unique upload identifier
+      report: Optional dict filled with per-page results of multi-page PDFs,
+        and the path of the kept MXL under "mxl"
 
     Returns:
       The path of the generated midi file
@@ -22,8 +25,11 @@ def image_to_midi(image_path, _uuid):
 
   try: 
 
-    xml_path = image_to_mxl(image_path, _uuid)
+    xml_path = image_to_mxl(image_path, _uuid, report)
+    if report is not None:
+      report["mxl"] = xml_path
     midi_path = mxl_to_midi(xml_path, _uuid)
+    progress.emit(_uuid, progress.MIDI)
     return midi_path
 
   except Exception as e:
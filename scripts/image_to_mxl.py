@@ -5,16 +5,29 @@ from pathlib import Path
 import shutil
 from flask import current_app
 from scripts.svg_to_png import convert_svg_to_png
-from utils.Exceptions import ScoreQualityError, ScoreStructureError, ScoreTooLargeImageError, AudiverisTimeoutError
+from scripts.audiveris_pool import run_audiveris, FATAL_MARKERS
+from scripts.audiveris_batch import get_batcher
+from scripts.pdf_pages import count_pages, split_pages, merge_mxl
+from concurrent.futures import ThreadPoolExecutor
+from utils.Exceptions import ScoreStructureError, AudiverisTimeoutError
+from utils import metrics
+from utils import progress
+from utils import profiling
 
-def image_to_mxl(image_path, _uuid):
+def image_to_mxl(image_path, _uuid, report=None):
 
     """
     Converts a image file of a musical score to a MXL file using Audiveris.
 
+    Multi-page PDFs are split into pages that are transcribed in parallel
+    and merged back, in page order, into a single MXL.
+
     Args:
         image_path: Path to the input image.
         _uuid: Unique upload identifier
+        report: Optional dict that receives the per-page results of a PDF
+            under the "pages" key, and the preprocessing result of an image
+            under the "preprocessing" key.
         
     Returns:
         The path of the generated MXL file. 
@@ -22,6 +35,7 @@ def image_to_mxl(image_path, _uuid):
     """
 
     current_app.logger.info("\n\nStarting image_to_mxl()...")
+    emit = progress.emitter(_uuid)
 
     # Check if the file exists
     image_file = Path(image_path)
@@ -35,7 +49,9 @@ def image_to_mxl(image_path, _uuid):
 
     if extension == '.svg':
         png_path = join(image_file.parent.resolve(), f'{filename}.png')
-        convert_svg_to_png(image_path, png_path)
+        with metrics.timed("svg_to_png"):
+            convert_svg_to_png(image_path, png_path)
+        emit(progress.RASTERIZED, dpi=current_app.config.get("SVG_DPI", 300))
         image_path = png_path
         image_file = Path(png_path)
 
@@ -45,13 +61,104 @@ def image_to_mxl(image_path, _uuid):
     if not os.path.exists(audiveris_path):
         raise FileNotFoundError(f"Audiveris path not found at: {audiveris_path}")
 
-    # Construct the Audiveris command.
     base_audiveris_dir = current_app.config.get("AUDIVERIS_OUTPUT")
     audiberis_output_dir = os.path.join(base_audiveris_dir, _uuid)
     Path(audiberis_output_dir).mkdir(parents=True, exist_ok=True)
 
-    command = [
-      audiveris_path,
+    mxl_output_dir = join(current_app.config.get("MXL_FOLDER"), _uuid)
+
+    if current_app.config.get("PREPROCESS_IMAGES") and extension != '.pdf':
+        prepared_path = prepare_image(image_path, audiberis_output_dir, report)
+        if prepared_path != image_path:
+            emit(progress.PREPROCESSED)
+        image_path = prepared_path
+
+    if extension == '.pdf' and count_pages(image_path) > 1:
+        audiveris_mxl_path = transcribe_pages(image_path, audiberis_output_dir, report, emit, _uuid)
+    else:
+        emit(progress.OMR)
+        audiveris_mxl_path = transcribe(image_path, audiberis_output_dir, on_step=lambda step: emit(progress.OMR, step=step),
+                                        jvm_options=profiling.jvm_options(_uuid, "audiveris"))
+
+    # Copy the generated MXL file into MXL_FOLDER/uuid/file_name.mxl
+    current_app.logger.info(f"Copying the MXL file into {mxl_output_dir} directory")
+    os.makedirs(mxl_output_dir)
+    final_mxl_path = join(mxl_output_dir, f"{filename}.mxl")
+    shutil.copy(audiveris_mxl_path, final_mxl_path)
+    emit(progress.MXL)
+
+    current_app.logger.info(f"MXL file saved correctly in: {final_mxl_path}")
+    current_app.logger.info("Finished image_to_mxl() successfully...") 
+        
+    return final_mxl_path
+
+
+def prepare_image(image_path, audiberis_output_dir, report=None):
+
+    """
+    Runs the preprocessing stage on an image before Audiveris reads it.
+
+    The prepared image keeps the original file name, in the job's Audiveris
+    directory. If preprocessing fails, the original image is used.
+
+    Returns:
+        The path of the image to transcribe.
+    """
+
+    # Preprocessing is off by default, so NumPy and the stage are only loaded once it runs.
+    from scripts.preprocess_image import preprocess_image
+
+    filename = os.path.splitext(os.path.basename(image_path))[0]
+    prepared_path = join(audiberis_output_dir, "input", f"{filename}.png")
+
+    try:
+        with metrics.timed("preprocess"):
+            result = preprocess_image(
+                image_path,
+                prepared_path,
+                target_interline=current_app.config.get("PREPROCESS_INTERLINE", 20),
+                max_skew=current_app.config.get("PREPROCESS_MAX_SKEW", 5.0),
+            )
+    except Exception as e:
+        current_app.logger.warning(f"Preprocessing failed, using the original image: {e}")
+        return image_path
+
+    before, after = result["before"], result["after"]
+    pixels = (after[0] * after[1]) / (before[0] * before[1])
+    current_app.logger.info(
+        f"Preprocessed {before[0]}x{before[1]} -> {after[0]}x{after[1]} ({pixels:.0%} of the pixels), "
+        f"interline {result['interline']}, skew {result['skew']} deg, in {result['seconds']}s"
+    )
+    if report is not None:
+        report["preprocessing"] = result
+
+    return prepared_path
+
+
+def transcribe(image_path, audiberis_output_dir, wait=True, on_step=None, jvm_options=None):
+
+    """
+    Runs Audiveris on a single input file.
+
+    Args:
+        image_path: Path to the image or PDF to transcribe.
+        audiberis_output_dir: Directory where Audiveris writes its output.
+        wait: Wait for an idle pooled worker (or join the next batch, when
+            batching is enabled) instead of starting a one-shot process.
+        on_step: Called with each OMR step as Audiveris starts it.
+        jvm_options: Extra options of the Audiveris JVM (a run with its own
+            options is never batched).
+
+    Returns:
+        The path of the MXL file generated by Audiveris.
+
+    """
+
+    filename = os.path.splitext(os.path.basename(image_path))[0]
+    audiveris_path = current_app.config.get("AUDIVERIS_PATH")
+
+    # Construct the Audiveris command.
+    args = [
       "-batch",
       "-export", 
       "-output",
@@ -60,55 +167,119 @@ def image_to_mxl(image_path, _uuid):
       image_path
     ]
 
-    mxl_output_dir = join(current_app.config.get("MXL_FOLDER"), _uuid)
+    timeout = current_app.config.get("AUDIVERIS_TIMEOUT", 180)
 
     # Execute the command.
-    current_app.logger.info(f"Running audiveris process: {' '.join(command)}")
+    current_app.logger.info(f"Running audiveris process: {audiveris_path} {' '.join(args)}")
+    batcher = get_batcher() if wait and not jvm_options else None
     try:
-        result = subprocess.run(command, capture_output=True, text=True, timeout=180)
+        with metrics.timed("audiveris"):
+            if batcher is not None:
+                result = batcher.submit(image_path, audiberis_output_dir, timeout, on_step=on_step)
+            else:
+                result = run_audiveris(args, timeout, wait=wait, on_step=on_step, jvm_options=jvm_options)
     except subprocess.TimeoutExpired as e:
-        current_app.logger.error(f"Audiveris process timed out after 180 seconds for file: {image_path}")
+        current_app.logger.error(f"Audiveris process timed out after {timeout} seconds for file: {image_path}")
         raise AudiverisTimeoutError("Audiveris took too long to process the file. Please try with a simpler or smaller score, or try again later.")
 
-    if result.returncode != 0:
+    if result.steps:
+        current_app.logger.info("Audiveris steps: " + ", ".join(f"{step} {seconds}s" for step, seconds in result.steps.items()))
+        for step, seconds in result.steps.items():
+            metrics.observe(f"audiveris.{step.lower()}", seconds)
+
+    current_app.logger.info(f"Audiveris used {result.usage['cpu_seconds']}s of CPU, peak RSS {result.usage['peak_rss_mb']} MB")
+    metrics.observe_usage("audiveris", result.usage["cpu_seconds"], result.usage["peak_rss_mb"])
+
+    if result.returncode != 0 and not result.fatal:
         current_app.logger.error("Command failed!")
         current_app.logger.error(f"Return code: {result.returncode}")
         current_app.logger.error(result.stdout)
 
     checkCorrectExport(result.stdout)
 
-    # Copy the generated MXL file into MXL_FOLDER/uuid/file_name.mxl
     audiveris_mxl_path = join(audiberis_output_dir, f"{filename}.mxl")
 
-    if os.path.exists(audiveris_mxl_path):
-        current_app.logger.info(f"Copying the MXL file into {mxl_output_dir} directory")
-        os.makedirs(mxl_output_dir)
-        final_mxl_path = join(mxl_output_dir, f"{filename}.mxl")
-        shutil.copy(audiveris_mxl_path, final_mxl_path)
-
-        current_app.logger.info(f"MXL file saved correctly in: {final_mxl_path}")
-        current_app.logger.info("Finished image_to_mxl() successfully...") 
-            
-        return final_mxl_path
-    else:
+    if not os.path.exists(audiveris_mxl_path):
         raise Exception(f"Could not find generated MXL file in {audiveris_mxl_path}")
 
+    return audiveris_mxl_path
 
 
-def checkCorrectExport(stdout):
+def transcribe_pages(pdf_path, audiberis_output_dir, report=None, emit=None, _uuid=None):
+
+    """
+    Transcribes the pages of a PDF in parallel and merges them into one MXL.
 
-    java_exception = "java.lang.NullPointerException"
-    low_resolution = "try 300 DPI"
-    too_large_image = "Too large image"
+    A page that fails is reported in report["pages"] and left out of the
+    merged score. The job only fails, with the first page's error, when
+    no page could be transcribed. `emit` records the OMR progress of each
+    page (see utils.progress.emitter). The pages of a profiled job `_uuid`
+    are recorded one by one (see utils.profiling).
 
-    if java_exception in stdout:
-        raise ScoreStructureError()
+    Returns:
+        The path of the merged MXL file.
+
+    """
+
+    app = current_app._get_current_object()
+    pages_dir = join(audiberis_output_dir, "pages")
+    page_paths = split_pages(pdf_path, pages_dir)
+    current_app.logger.info(f"Transcribing {len(page_paths)} PDF pages in parallel")
+    emit = emit or (lambda stage, **fields: None)
+    emit(progress.OMR, pages=len(page_paths))
+
+    def transcribe_page(number, page_path):
+        with app.app_context():
+            # Extra pages start one-shot processes instead of queueing behind the pool.
+            return transcribe(page_path, pages_dir, wait=False,
+                              on_step=lambda step: emit(progress.OMR, step=step, page=number),
+                              jvm_options=profiling.jvm_options(_uuid, f"audiveris-page-{number}"))
+
+    max_workers = current_app.config.get("PDF_PAGE_WORKERS") or os.cpu_count()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(transcribe_page, number, page_path) for number, page_path in enumerate(page_paths, start=1)]
+
+    pages = []
+    page_mxl_paths = []
+    errors = []
+    for number, future in enumerate(futures, start=1):
+        try:
+            page_mxl_paths.append(future.result())
+            pages.append({"page": number, "status": "done"})
+        except Exception as e:
+            current_app.logger.error(f"Page {number} failed: {type(e).__name__} {e}")
+            pages.append({"page": number, "status": "failed", "error_type": type(e).__name__})
+            errors.append(e)
+
+    if report is not None:
+        report["pages"] = pages
+
+    if not page_mxl_paths:
+        raise errors[0]
+
+    # The job goes on without these pages, so their errors are counted here.
+    for error in errors:
+        metrics.count_exception(error)
+
+    filename = os.path.splitext(os.path.basename(pdf_path))[0]
+    merged_path = join(audiberis_output_dir, f"{filename}.mxl")
+    skipped = merge_mxl(page_mxl_paths, merged_path)
+
+    # Pages whose part layout does not match the first page are left out.
+    done_pages = [page for page in pages if page["status"] == "done"]
+    for index in skipped:
+        done_pages[index].update(status="failed", error_type=ScoreStructureError.__name__)
+
+    return merged_path
+
+
+def checkCorrectExport(stdout):
 
-    if low_resolution in stdout:
-        raise ScoreQualityError()
-    
-    if too_large_image in stdout:
-        raise ScoreTooLargeImageError()
+    # java.lang.NullPointerException -> ScoreStructureError, "try 300 DPI" -> ScoreQualityError,
+    # "Too large image" -> ScoreTooLargeImageError
+    for marker, error in FATAL_MARKERS:
+        if marker in stdout:
+            raise error()
 
         
 
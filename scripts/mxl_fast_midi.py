@@ -0,0 +1,404 @@
+"""
+Streaming MusicXML -> MIDI engine.
+
+Reads the score inside an MXL archive with ElementTree.iterparse, one
+measure at a time, and writes the MIDI events directly instead of building
+a music21 object graph. It reproduces music21's MIDI output for the notes
+it supports (tracks, pitches, onsets, durations, programs, tempos and
+dynamics). Constructs that music21 realizes differently (repeats and jumps,
+chord symbols, cue notes, percussion, transposing instruments) raise
+UnsupportedMusicXMLError so the caller can fall back to music21.
+"""
+import struct
+import zipfile
+from fractions import Fraction
+import xml.etree.ElementTree as ET
+from utils.Exceptions import UnsupportedMusicXMLError
+
+TICKS_PER_QUARTER = 10080  # Same resolution as music21
+DEFAULT_TEMPO = 120
+DEFAULT_VELOCITY = 90
+
+STEP_SEMITONES = {"C": 0, "D": 2, "E": 4, "F": 5, "G": 7, "A": 9, "B": 11}
+
+# MIDI velocity music21 realizes for each dynamic mark.
+DYNAMIC_VELOCITY = {
+    "pppp": 18, "ppp": 27, "pp": 45, "p": 63, "mp": 81, "mf": 99,
+    "f": 126, "ff": 127, "fff": 127, "ffff": 127,
+    "sf": 127, "fp": 127, "sfz": 126, "fz": 126, "sffz": 127, "n": 0,
+}
+
+# Playback instructions that music21 expands when writing MIDI.
+JUMP_ATTRIBUTES = ("dacapo", "dalsegno", "segno", "coda", "tocoda", "fine")
+
+
+class _Part:
+    """Parsing state of one <part>."""
+
+    def __init__(self, program):
+        self.program = program
+        self.divisions = 1
+        self.position = Fraction(0)
+        self.velocity = DEFAULT_VELOCITY
+        # Events of each staff: one track per staff, like music21's PartStaff split.
+        self.staves = {}
+
+
+class _Event:
+    """A note, chord or rest. Pitches are (spelling, midi number) pairs."""
+
+    __slots__ = ("onset", "duration", "velocity", "pitches", "ties", "grace")
+
+    def __init__(self, onset, duration, velocity, grace=False):
+        self.onset = onset
+        self.duration = duration
+        self.velocity = velocity
+        self.grace = grace
+        self.pitches = []
+        self.ties = []
+
+    @property
+    def tie(self):
+        """Tie of the event; a chord has the tie of its first tied member, as in music21."""
+        return next((tie for tie in self.ties if tie), None)
+
+
+def _unsupported(construct):
+    raise UnsupportedMusicXMLError(f"The fast MIDI engine does not support {construct}.")
+
+
+def _rootfile(archive):
+    container = ET.fromstring(archive.read("META-INF/container.xml"))
+    for element in container.iter():
+        if element.tag.endswith("rootfile"):
+            return element.get("full-path")
+    raise ValueError("MXL archive has no rootfile.")
+
+
+def _pitch(note):
+    pitch = note.find("pitch")
+    try:
+        step, octave = pitch.findtext("step"), int(pitch.findtext("octave"))
+        alter = round(float(pitch.findtext("alter", "0")))
+        midi = (octave + 1) * 12 + STEP_SEMITONES[step] + alter
+    except (AttributeError, KeyError, TypeError, ValueError):
+        _unsupported("notes without a readable pitch")
+    if not 0 <= midi <= 127:
+        _unsupported(f"pitches outside the MIDI range (note number {midi})")
+    return (step, alter, octave), midi
+
+
+def _tie_type(note):
+    """Tie type of a <note>: a stop and a start together make a "continue"."""
+    types = {tie.get("type") for tie in note.findall("tie")}
+    if not types:
+        return None
+    if len(types) == 1:
+        return types.pop()
+    return "continue" if types == {"start", "stop"} else "start"
+
+
+def _tied_to_last(event, last, last_connected):
+    """music21's end-of-tie test (Stream.stripTies with matchByPitch=True)."""
+    if len(event.pitches) == 1 and event.tie == "stop":
+        return True
+    if last is None or not last_connected or not event.pitches:
+        return False
+    if len(event.pitches) == 1 and len(last.pitches) == 1:
+        return event.pitches[0][0] == last.pitches[0][0]
+    if len(event.pitches) > 1:
+        if len(event.pitches) != len(last.pitches):
+            return False
+        return all(a[0][0] == b[0][0] and a[1] == b[1] for a, b in zip(last.pitches, event.pitches))
+    return False
+
+
+def _strip_ties(events):
+
+    """
+    Merges tied events the way music21 does before writing MIDI.
+
+    music21 walks the notes and rests of a staff in offset order (voices
+    interleaved) and only joins a tie to the event right before it, so a
+    tie across voices is left open. Grace notes take part in the walk (they
+    sort before the other notes at their offset) but have no duration.
+    Following the same walk keeps both engines note-for-note equal.
+    """
+
+    events = sorted(events, key=lambda event: (event.onset, not event.grace))
+    connected = []
+    for i, event in enumerate(events):
+        last = events[i - 1] if i > 0 else None
+        last_connected = i > 0 and (i - 1) in connected
+        end_match = None
+        tie = event.tie
+
+        if tie == "start":
+            if not last_connected:
+                connected = [i]
+            else:
+                connected.append(i)
+            end_match = False
+        elif tie == "continue":
+            if not connected:
+                connected.append(i)
+            elif _tied_to_last(event, last, last_connected):
+                connected.append(i)
+            else:
+                connected = [i]
+            end_match = False
+
+        if end_match is None:
+            end_match = _tied_to_last(event, last, last_connected)
+
+        if end_match:
+            connected.append(i)
+            if len(connected) < 2:
+                connected = []
+                continue
+            first = events[connected[0]]
+            for index in connected[1:]:
+                first.duration += events[index].duration
+                events[index].duration = 0
+                events[index].grace = False
+            first.ties = []
+            connected = []
+
+    return [event for event in events if event.duration > 0 or event.grace]
+
+
+def _quarter_bpm(metronome):
+    """Tempo of a <metronome> mark in quarter notes per minute."""
+    beat_unit = {"whole": 4, "half": 2, "quarter": 1, "eighth": Fraction(1, 2), "16th": Fraction(1, 4)}
+    unit = beat_unit.get(metronome.findtext("beat-unit"))
+    if unit is None or metronome.findtext("per-minute") is None:
+        _unsupported("this metronome mark")
+    dots = len(metronome.findall("beat-unit-dot"))
+    unit = unit * (2 - Fraction(1, 2 ** dots))
+    return float(metronome.findtext("per-minute")) * float(unit)
+
+
+def _read_measure(measure, part, tempos, time_signatures):
+    """Adds the notes of one <measure> to its part and returns the measure end."""
+
+    measure_start = part.position
+    measure_end = part.position
+    last_event = None
+
+    for element in measure:
+        tag = element.tag
+
+        if tag == "attributes":
+            if element.findtext("divisions"):
+                part.divisions = int(element.findtext("divisions"))
+            if element.find("transpose") is not None:
+                _unsupported("transposing instruments")
+            time = element.find("time")
+            if time is not None and time.findtext("beats"):
+                time_signatures.append((part.position, time.findtext("beats"), time.findtext("beat-type")))
+
+        elif tag == "note":
+            if element.find("cue") is not None:
+                _unsupported("cue notes")
+            if element.find("unpitched") is not None:
+                _unsupported("unpitched percussion")
+
+            grace = element.find("grace") is not None
+            duration = Fraction(0 if grace else int(element.findtext("duration", "0")), part.divisions)
+            if element.find("chord") is not None and last_event is not None:
+                if element.find("rest") is None:
+                    last_event.pitches.append(_pitch(element))
+                    last_event.ties.append(_tie_type(element))
+                continue
+
+            onset = part.position
+            part.position += duration
+            staff = element.findtext("staff", "1")
+            last_event = _Event(onset, duration, part.velocity, grace)
+            if element.find("rest") is None:
+                last_event.pitches.append(_pitch(element))
+                last_event.ties.append(_tie_type(element))
+            part.staves.setdefault(staff, []).append(last_event)
+
+        elif tag == "backup":
+            part.position -= Fraction(int(element.findtext("duration")), part.divisions)
+
+        elif tag == "forward":
+            part.position += Fraction(int(element.findtext("duration")), part.divisions)
+
+        elif tag == "direction":
+            # A direction can sit after the current position, and music21
+            # counts it in the length of the measure.
+            position = part.position + Fraction(int(element.findtext("offset", "0")), part.divisions)
+            measure_end = max(measure_end, position)
+            for dynamics in element.iter("dynamics"):
+                for mark in dynamics:
+                    part.velocity = DYNAMIC_VELOCITY.get(mark.tag, DEFAULT_VELOCITY)
+            sound = element.find("sound")
+            metronome = element.find("direction-type/metronome")
+            if sound is not None and sound.get("tempo"):
+                tempos.append((position, float(sound.get("tempo"))))
+            elif metronome is not None:
+                tempos.append((position, _quarter_bpm(metronome)))
+            if sound is not None and any(sound.get(name) for name in JUMP_ATTRIBUTES):
+                _unsupported("jumps (da capo, segno, coda)")
+
+        elif tag == "sound":
+            if element.get("tempo"):
+                tempos.append((part.position, float(element.get("tempo"))))
+            if any(element.get(name) for name in JUMP_ATTRIBUTES):
+                _unsupported("jumps (da capo, segno, coda)")
+
+        elif tag == "harmony":
+            # music21 realizes chord symbols as notes.
+            _unsupported("chord symbols")
+
+        elif tag == "barline":
+            if element.find("repeat") is not None or element.find("ending") is not None:
+                _unsupported("repeats")
+
+        measure_end = max(measure_end, part.position)
+
+    return max(measure_end, measure_start)
+
+
+def read_score(mxl_path):
+
+    """
+    Reads the notes of a compressed MusicXML file, one measure at a time.
+
+    Returns:
+        tuple: (tracks, tempos, time_signatures) where tracks is a list of
+        (program, notes) and every note is [onset, duration, pitch, velocity]
+        with onset and duration in quarter notes.
+    """
+
+    parts = []
+    programs = {}
+    tempos = []
+    time_signatures = []
+    current = None
+    current_program = None
+
+    with zipfile.ZipFile(mxl_path) as archive:
+        with archive.open(_rootfile(archive)) as score:
+            for event, element in ET.iterparse(score, events=("start", "end")):
+                tag = element.tag
+
+                if event == "start":
+                    if tag == "score-timewise":
+                        _unsupported("timewise scores")
+                    if tag == "part" and current is None:
+                        current = _Part(programs.get(element.get("id"), 0))
+                    continue
+
+                if tag == "midi-program" and current is None:
+                    current_program = int(element.text) - 1
+                elif tag == "score-part":
+                    programs[element.get("id")] = current_program or 0
+                    current_program = None
+                elif tag == "measure" and current is not None:
+                    current.position = _read_measure(element, current, tempos, time_signatures)
+                    # Drop the parsed measure so memory stays flat on long scores.
+                    element.clear()
+                elif tag == "part" and current is not None:
+                    parts.append(current)
+                    current = None
+                    element.clear()
+
+    tracks = []
+    for part in parts:
+        for staff in sorted(part.staves, key=int):
+            notes = [
+                [event.onset, event.duration, midi, event.velocity]
+                for event in _strip_ties(part.staves[staff])
+                for _, midi in event.pitches
+            ]
+            tracks.append((part.program, notes))
+    return tracks, tempos, time_signatures
+
+
+def _variable_length(value):
+    data = [value & 0x7F]
+    value >>= 7
+    while value:
+        data.append((value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(reversed(data))
+
+
+def _ticks(quarters):
+    return int(round(quarters * TICKS_PER_QUARTER))
+
+
+def _track_chunk(events):
+    """Builds an MTrk chunk from (tick, order, bytes) events."""
+    data = bytearray()
+    last_tick = 0
+    for tick, _, event in sorted(events, key=lambda e: (e[0], e[1])):
+        data += _variable_length(tick - last_tick) + event
+        last_tick = tick
+    data += _variable_length(0) + b"\xff\x2f\x00"
+    return b"MTrk" + struct.pack(">I", len(data)) + bytes(data)
+
+
+def _conductor_track(tempos, time_signatures):
+    events = []
+    # Every part repeats the tempo marks, keep one per position.
+    tempos = sorted(dict(tempos).items())
+    if not tempos or tempos[0][0] > 0:
+        tempos = [(Fraction(0), DEFAULT_TEMPO)] + tempos
+    for onset, bpm in tempos:
+        microseconds = int(round(60000000 / bpm))
+        events.append((_ticks(onset), 0, b"\xff\x51\x03" + microseconds.to_bytes(3, "big")))
+    for onset, beats, beat_type in time_signatures[:1]:
+        try:
+            denominator = int(beat_type).bit_length() - 1
+            events.append((_ticks(onset), 1, bytes([0xFF, 0x58, 0x04, int(beats), denominator, 24, 8])))
+        except (TypeError, ValueError):
+            pass  # Compound or symbolic time signatures are not written
+    return _track_chunk(events)
+
+
+def _note_track(program, notes, channel):
+    events = [
+        (0, 0, b"\xff\x03\x00"),
+        (0, 1, bytes([0xC0 | channel, program & 0x7F])),
+    ]
+    for onset, duration, pitch, velocity in notes:
+        start = _ticks(onset)
+        # Note-offs sort before note-ons on the same tick, as in music21, which
+        # also writes grace notes this way, with no duration.
+        events.append((start, 3, bytes([0x90 | channel, pitch, velocity])))
+        events.append((start + _ticks(duration), 2, bytes([0x80 | channel, pitch, 0])))
+    return _track_chunk(events)
+
+
+def mxl_to_midi_fast(mxl_path, midi_path):
+
+    """
+    Converts a MXL file into a MIDI file without music21.
+
+    Args:
+        mxl_path: Path to the input MXL.
+        midi_path: Path of the MIDI file to write.
+
+    Raises:
+        UnsupportedMusicXMLError: If the score uses a construct this engine
+            does not support. Nothing is written in that case.
+    """
+
+    tracks, tempos, time_signatures = read_score(mxl_path)
+
+    chunks = [_conductor_track(tempos, time_signatures)]
+    for index, (program, notes) in enumerate(tracks):
+        # Channel 10 (index 9) is reserved for percussion.
+        channel = index % 15
+        if channel >= 9:
+            channel += 1
+        chunks.append(_note_track(program, notes, channel))
+
+    header = b"MThd" + struct.pack(">IHHH", 6, 1, len(chunks), TICKS_PER_QUARTER)
+    with open(midi_path, "wb") as f:
+        f.write(header + b"".join(chunks))
+    return midi_path
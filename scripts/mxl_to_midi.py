@@ -3,12 +3,18 @@ from pathlib import Path
 from os.path import join
 import os
 from flask import current_app
+from scripts.mxl_fast_midi import mxl_to_midi_fast
+from utils.Exceptions import UnsupportedMusicXMLError
+from utils import metrics
 
 def mxl_to_midi(mxl_path, _uuid): 
 
   """
     Converts a MXL file into a MIDI file.
 
+    With MIDI_ENGINE=fast the streaming engine is tried first, and music21
+    is only used for scores it does not support.
+
     Args:
       mxl_path: Path to the input MXL.
       _uuid: Unique upload identifier
@@ -29,15 +35,30 @@ def mxl_to_midi(mxl_path, _uuid):
   if not mxl_file.exists(): 
     raise FileNotFoundError(f'{mxl_path} does not exist.')
 
+  mxl_filename_base = mxl_file.stem
+  midi_file_path = join(midi_output_dir, f'{mxl_filename_base}.midi')
+
+  if current_app.config.get("MIDI_ENGINE") == "fast":
+    try:
+      current_app.logger.info(f"Converting the MXL file with the fast engine: {mxl_path}")
+      with metrics.timed("fast_midi"):
+        mxl_to_midi_fast(mxl_path, midi_file_path)
+      current_app.logger.info(f"Midi file saved in: {midi_file_path}")
+      current_app.logger.info("Finished mxl_to_midi() successfully...")
+      return midi_file_path
+    except UnsupportedMusicXMLError as e:
+      metrics.count_exception(e)
+      current_app.logger.info(f"{e} Falling back to music21.")
+
   # Load the XML file
   current_app.logger.info(f"Parsing the MXL file: {mxl_path}")
-  score = converter.parse(mxl_path)
+  with metrics.timed("parse_mxl"):
+    score = converter.parse(mxl_path)
 
   # Save the MIDI file
   current_app.logger.info("Saving the MIDI file.")
-  mxl_filename_base = mxl_file.stem
-  midi_file_path = join(midi_output_dir, f'{mxl_filename_base}.midi')
-  score.write('midi', fp=midi_file_path)
+  with metrics.timed("write_midi"):
+    score.write('midi', fp=midi_file_path)
     
   current_app.logger.info(f"Midi file saved in: {midi_file_path}")
   current_app.logger.info("Finished mxl_to_midi() successfully...")
@@ -0,0 +1,116 @@
+import zipfile
+import xml.etree.ElementTree as ET
+from os.path import join
+from pathlib import Path
+from pypdf import PdfReader, PdfWriter
+from pypdf.errors import PdfReadError
+
+CONTAINER_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<container>
+  <rootfiles>
+    <rootfile full-path="{name}" media-type="application/vnd.recordare.musicxml+xml"/>
+  </rootfiles>
+</container>
+"""
+
+
+def count_pages(pdf_path):
+  """
+    Returns the number of pages of a PDF, or 1 if pypdf cannot read it
+    (Audiveris then gets the whole document, as before).
+  """
+  try:
+    return len(PdfReader(pdf_path).pages)
+  except PdfReadError:
+    return 1
+
+
+def split_pages(pdf_path, output_dir):
+
+  """
+    Splits a PDF into one single-page PDF per page.
+
+    Args:
+      pdf_path: Path to the input PDF.
+      output_dir: Directory where the pages are written.
+
+    Returns:
+      The paths of the page PDFs, in page order.
+  """
+
+  Path(output_dir).mkdir(parents=True, exist_ok=True)
+  reader = PdfReader(pdf_path)
+  page_paths = []
+
+  for number, page in enumerate(reader.pages, start=1):
+    writer = PdfWriter()
+    writer.add_page(page)
+    page_path = join(output_dir, f"page-{number:03d}.pdf")
+    with open(page_path, "wb") as f:
+      writer.write(f)
+    page_paths.append(page_path)
+
+  return page_paths
+
+
+def read_mxl(mxl_path):
+  """Returns the root element of the score inside a compressed MusicXML file."""
+  with zipfile.ZipFile(mxl_path) as archive:
+    container = ET.fromstring(archive.read("META-INF/container.xml"))
+    rootfile = next(el for el in container.iter() if el.tag.endswith("rootfile"))
+    return ET.fromstring(archive.read(rootfile.get("full-path")))
+
+
+def write_mxl(root, mxl_path):
+  """Writes a score element as a compressed MusicXML file."""
+  name = f"{Path(mxl_path).stem}.xml"
+  with zipfile.ZipFile(mxl_path, "w", zipfile.ZIP_DEFLATED) as archive:
+    archive.writestr("mimetype", "application/vnd.recordare.musicxml", compress_type=zipfile.ZIP_STORED)
+    archive.writestr("META-INF/container.xml", CONTAINER_XML.format(name=name))
+    archive.writestr(name, ET.tostring(root, encoding="unicode", xml_declaration=True))
+
+
+def merge_mxl(mxl_paths, output_path):
+
+  """
+    Stitches per-page MXL files into one score, in the given order.
+
+    The measures of each page are appended to the matching part of the
+    first page and renumbered, with a page break at the start of every
+    page. Pages whose parts do not match the first page are skipped.
+
+    Args:
+      mxl_paths: Paths of the page MXL files, in page order.
+      output_path: Path of the merged MXL file.
+
+    Returns:
+      The indexes (in mxl_paths) of the skipped pages.
+  """
+
+  score = read_mxl(mxl_paths[0])
+  parts = score.findall("part")
+  part_ids = [part.get("id") for part in parts]
+  skipped = []
+
+  for index, mxl_path in enumerate(mxl_paths[1:], start=1):
+    page_parts = read_mxl(mxl_path).findall("part")
+    if [part.get("id") for part in page_parts] != part_ids:
+      skipped.append(index)
+      continue
+
+    for part, page_part in zip(parts, page_parts):
+      measures = page_part.findall("measure")
+      if measures:
+        page_break = measures[0].find("print")
+        if page_break is None:
+          page_break = ET.Element("print")
+          measures[0].insert(0, page_break)
+        page_break.set("new-page", "yes")
+      part.extend(measures)
+
+  for part in parts:
+    for number, measure in enumerate(part.findall("measure"), start=1):
+      measure.set("number", str(number))
+
+  write_mxl(score, output_path)
+  return skipped
@@ -0,0 +1,138 @@
+import time
+import numpy as np
+from pathlib import Path
+from PIL import Image, ImageOps
+
+# Bounds of the resampling factor applied to reach the target interline.
+MIN_SCALE = 0.25
+MAX_SCALE = 4.0
+
+# Largest side of the image used to estimate the skew.
+SKEW_SAMPLE_SIZE = 1500
+SKEW_STEP = 0.1  # degrees
+
+# Interlines (pixels) that can be measured, and the share of the sampled
+# line-to-line distances the most frequent one must have to be trusted.
+MIN_INTERLINE = 4
+MAX_INTERLINE = 200
+MIN_INTERLINE_SHARE = 0.05
+
+
+def otsu_threshold(gray):
+  """Returns the gray level that best separates ink from paper (Otsu's method)."""
+  hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+  omega = np.cumsum(hist) / gray.size
+  mu = np.cumsum(hist * np.arange(256)) / gray.size
+  with np.errstate(divide="ignore", invalid="ignore"):
+    between_variance = (mu[-1] * omega - mu) ** 2 / (omega * (1 - omega))
+  return int(np.nanargmax(between_variance))
+
+
+def crop_margins(ink, padding):
+  """Crops an ink mask to the bounding box of its ink plus some padding."""
+  rows = np.flatnonzero(ink.any(axis=1))
+  cols = np.flatnonzero(ink.any(axis=0))
+  if rows.size == 0:
+    return ink
+  top, bottom = max(rows[0] - padding, 0), min(rows[-1] + padding + 1, ink.shape[0])
+  left, right = max(cols[0] - padding, 0), min(cols[-1] + padding + 1, ink.shape[1])
+  return ink[top:bottom, left:right]
+
+
+def skew_angle(ink, max_skew):
+  """
+    Estimates the rotation (degrees, counter-clockwise) that makes the staff
+    lines horizontal: the angle whose row projection of the ink is sharpest.
+    Whole degrees are tried first, then tenths around the best one.
+  """
+  step = -(-max(ink.shape) // SKEW_SAMPLE_SIZE)
+  ys, xs = np.nonzero(ink[::step, ::step])
+  if ys.size == 0:
+    return 0.0
+
+  def sharpness(angle):
+    rows = np.round(ys - xs * np.tan(np.radians(angle))).astype(np.int64)
+    return np.square(np.bincount(rows - rows.min()), dtype=np.float64).sum()
+
+  coarse = np.arange(-np.floor(max_skew), np.floor(max_skew) + 1)
+  best = max(coarse, key=sharpness)
+  fine = np.arange(best - 1, best + 1 + SKEW_STEP / 2, SKEW_STEP)
+  best = max(fine[np.abs(fine) <= max_skew], key=sharpness)
+  return round(float(best), 2) + 0.0
+
+
+def interline(ink):
+  """
+    Measures the staff interline in pixels, or None if the image has no clear
+    staves. Like Audiveris, it takes the most frequent distance between the
+    starts of two consecutive vertical ink runs.
+  """
+  step = max(1, ink.shape[1] // 400)
+  columns = np.pad(ink[:, ::step].T, ((0, 0), (1, 0)))
+  column, start = np.nonzero(np.diff(columns.astype(np.int8), axis=1) == 1)
+  same_column = column[1:] == column[:-1]
+  distances = (start[1:] - start[:-1])[same_column]
+  distances = distances[(distances >= MIN_INTERLINE) & (distances <= MAX_INTERLINE)]
+  if distances.size == 0:
+    return None
+
+  counts = np.bincount(distances)
+  mode = int(counts.argmax())
+  if counts[mode] < MIN_INTERLINE_SHARE * distances.size:
+    return None
+  return mode
+
+
+def preprocess_image(image_path, output_path, target_interline=20, max_skew=5.0, max_side=7000):
+
+  """
+    Prepares a score image for Audiveris: grayscale and binarize, crop the
+    margins, deskew, and resample so the staff interline is target_interline
+    pixels.
+
+    Args:
+      image_path: Path to the input image.
+      output_path: Path of the prepared PNG.
+      target_interline: Interline (pixels) the image is resampled to.
+      max_skew: Largest rotation (degrees) corrected, 0 disables deskewing.
+      max_side: Largest side (pixels) of the prepared image.
+
+    Returns:
+      dict: Before/after sizes, the measured interline and skew, and the
+      seconds it took.
+  """
+
+  started = time.perf_counter()
+
+  with Image.open(image_path) as image:
+    before = image.size
+    gray = np.asarray(ImageOps.exif_transpose(image).convert("L"))
+
+  ink = gray <= otsu_threshold(gray)
+  ink = crop_margins(ink, padding=max(8, max(ink.shape) // 100))
+
+  angle = skew_angle(ink, max_skew) if max_skew > 0 else 0.0
+  measured_interline = interline(ink)
+
+  prepared = Image.fromarray(np.where(ink, 0, 255).astype(np.uint8))
+  if abs(angle) >= SKEW_STEP:
+    prepared = prepared.rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor=255)
+
+  scale = 1.0
+  if measured_interline:
+    scale = min(max(target_interline / measured_interline, MIN_SCALE), MAX_SCALE, max_side / max(prepared.size))
+    if abs(scale - 1) > 0.05:
+      size = (round(prepared.width * scale), round(prepared.height * scale))
+      prepared = prepared.resize(size, resample=Image.LANCZOS)
+
+  Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+  prepared.save(output_path)
+
+  return {
+    "before": list(before),
+    "after": list(prepared.size),
+    "interline": measured_interline,
+    "skew": angle,
+    "scale": round(scale, 3),
+    "seconds": round(time.perf_counter() - started, 3),
+  }
@@ -0,0 +1,87 @@
+from flask import current_app
+from utils import metrics
+
+# Limits of the render options.
+MIN_TEMPO, MAX_TEMPO = 20, 400
+MAX_TRANSPOSE = 24
+
+
+def parse_options(args):
+
+    """
+    Reads the render options of a request.
+
+    Args:
+        args: The query string (request.args).
+
+    Returns:
+        dict with any of: "tempo" (BPM), "program" (General MIDI program,
+        0-127), "transpose" (semitones) and "drop" (1-based part numbers).
+
+    Raises:
+        ValueError: With the message for the client, if an option is invalid.
+    """
+
+    options = {}
+    try:
+        if args.get("tempo"):
+            options["tempo"] = float(args["tempo"])
+        if args.get("program"):
+            options["program"] = int(args["program"])
+        if args.get("transpose"):
+            options["transpose"] = int(args["transpose"])
+        if args.get("drop"):
+            options["drop"] = sorted({int(part) for part in args["drop"].split(",")})
+    except ValueError:
+        raise ValueError("tempo must be a number, and program, transpose and drop (comma-separated) integers.")
+
+    if "tempo" in options and not MIN_TEMPO <= options["tempo"] <= MAX_TEMPO:
+        raise ValueError(f"tempo must be between {MIN_TEMPO} and {MAX_TEMPO} BPM.")
+    if "program" in options and not 0 <= options["program"] <= 127:
+        raise ValueError("program must be a General MIDI program, between 0 and 127.")
+    if "transpose" in options and abs(options["transpose"]) > MAX_TRANSPOSE:
+        raise ValueError(f"transpose must be between -{MAX_TRANSPOSE} and {MAX_TRANSPOSE} semitones.")
+    return options
+
+
+def render_midi(score, options):
+
+    """
+    Applies render options to a music21 score (in place) and writes it as MIDI.
+
+    Returns:
+        The MIDI file, as bytes.
+
+    Raises:
+        ValueError: If `drop` names a part the score does not have, or every part.
+    """
+
+    from music21 import instrument, midi, tempo
+
+    parts = list(score.parts)
+    drop = options.get("drop", [])
+    if any(not 1 <= number <= len(parts) for number in drop):
+        raise ValueError(f"The score has {len(parts)} parts: drop must be between 1 and {len(parts)}.")
+    if len(drop) == len(parts):
+        raise ValueError("drop cannot remove every part of the score.")
+    for number in drop:
+        score.remove(parts[number - 1])
+
+    with metrics.timed("render.options"):
+        if "transpose" in options:
+            score.transpose(options["transpose"], inPlace=True)
+
+        if "tempo" in options:
+            for mark in list(score.recurse().getElementsByClass(tempo.MetronomeMark)):
+                mark.activeSite.remove(mark)
+            score.parts[0].insert(0, tempo.MetronomeMark(number=options["tempo"]))
+
+        if "program" in options:
+            for part in score.parts:
+                for existing in list(part.recurse().getElementsByClass(instrument.Instrument)):
+                    existing.activeSite.remove(existing)
+                part.insert(0, instrument.instrumentFromMidiProgram(options["program"]))
+
+    current_app.logger.info(f"Rendering MIDI with {options}")
+    with metrics.timed("render.write_midi"):
+        return midi.translate.music21ObjectToMidiFile(score).writestr()
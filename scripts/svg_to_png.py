@@ -1,12 +1,166 @@
-import cairosvg
-from os.path import basename
+import os
+import shutil
+import tempfile
+import threading
+import multiprocessing
+from os.path import basename, join
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from flask import current_app
+from utils.Exceptions import RasterizationError
+from utils.result_cache import hash_file
+from utils.validation import ALLOWED_PIXELS, HEAD_SIZE, svg_size
 
-def convert_svg_to_png(input_svg, output_png):
+# CSS pixels per inch: CairoSVG renders one SVG px (or 1/96 in) as one PNG pixel.
+CSS_DPI = 96
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _render(input_svg, output_png, scale):
+    # Runs in the render processes. Only SVG uploads need cairo, so it is not loaded at startup.
+    import cairosvg
+    cairosvg.svg2png(url=input_svg, write_to=output_png, scale=scale, background_color='white')
+
+
+def _get_pool():
+    global _pool, _pool_pid
+    # Created lazily so each gunicorn worker starts its own processes after fork.
+    with _pool_lock:
+        if _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(
+                max_workers=current_app.config.get("SVG_RENDER_WORKERS", 1),
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _reset_pool(kill=False):
+    """Drops the pool (killing its processes if kill) so the next render starts a new one."""
+    global _pool_pid
+    with _pool_lock:
+        pool, _pool_pid = _pool, None
+    if kill:
+        # A render past its timeout would otherwise hold its process forever.
+        for process in list((getattr(pool, "_processes", None) or {}).values()):
+            process.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _submit(*args):
+    try:
+        return _get_pool().submit(_render, *args)
+    except BrokenProcessPool:
+        # Broken by an earlier render: start a new pool for this one.
+        _reset_pool()
+        return _get_pool().submit(_render, *args)
+
+
+def _cache_path(input_svg, dpi):
+    with open(input_svg, "rb") as f:
+        digest = hash_file(f)
+    cache_dir = current_app.config.get("RASTER_CACHE_FOLDER")
+    os.makedirs(cache_dir, exist_ok=True)
+    return join(cache_dir, f"{digest}-{dpi}.png")
+
+
+def _place(cached_png, output_png):
+    """Puts a cached PNG at output_png, as a hard link when possible."""
+    if os.path.exists(output_png):
+        os.remove(output_png)
+    try:
+        os.link(cached_png, output_png)
+    except OSError:
+        shutil.copyfile(cached_png, output_png)
+
+
+def convert_svg_to_png(input_svg, output_png, dpi=None):
+
+    """
+    Rasterizes an SVG score at a DPI suited to OMR (SVG_DPI by default).
+
+    Renders run in a pool of SVG_RENDER_WORKERS processes (0 = in this
+    process), so a large SVG does not hold the request worker's GIL. The
+    PNG is cached in RASTER_CACHE_FOLDER by the SVG's SHA-256 and the DPI.
+
+    SVGs are assumed to be drawn at 96 DPI (CSS pixels), but a large one
+    is rendered at a lower DPI, so the PNG stays within the ALLOWED_PIXELS
+    of raster uploads.
+
+    Raises:
+        RasterizationError: If the SVG cannot be rendered, or takes longer
+            than SVG_RENDER_TIMEOUT seconds.
+    """
+
+    dpi = dpi or current_app.config.get("SVG_DPI", 300)
+    input_name = basename(input_svg)
+    output_name = basename(output_png)
+
+    cached_png = _cache_path(input_svg, dpi)
+    if os.path.exists(cached_png):
+        os.utime(cached_png)
+        _place(cached_png, output_png)
+        current_app.logger.info(f"Reused the {dpi} DPI rendering of {input_name} as {output_name}")
+        return output_png
+
+    # Render next to the cache entry, then publish it atomically.
+    fd, tmp_png = tempfile.mkstemp(dir=os.path.dirname(cached_png), suffix=".tmp")
+    os.close(fd)
     try:
-        input_name = basename(input_svg)
-        output_name = basename(output_png)
-        cairosvg.svg2png(url=input_svg, write_to=output_png, background_color='white')
-        current_app.logger.info(f"Successfully converted {input_name} to {output_name}")
+        scale = render_scale(input_svg, dpi)
+        workers = current_app.config.get("SVG_RENDER_WORKERS", 1)
+        if workers > 0:
+            future = _submit(input_svg, tmp_png, scale)
+            future.result(timeout=current_app.config.get("SVG_RENDER_TIMEOUT", 60))
+        else:
+            _render(input_svg, tmp_png, scale)
+        if os.path.getsize(tmp_png) == 0:
+            raise RasterizationError(f"Rendering {input_name} produced an empty PNG")
+        os.replace(tmp_png, cached_png)
+    except FutureTimeoutError:
+        _reset_pool(kill=True)
+        raise RasterizationError(f"Rendering {input_name} took longer than {current_app.config.get('SVG_RENDER_TIMEOUT', 60)}s")
+    except BrokenProcessPool as e:
+        _reset_pool()
+        raise RasterizationError(f"The SVG render process died rendering {input_name}") from e
+    except RasterizationError:
+        raise
     except Exception as e:
-        current_app.logger.error(f"An error occurred: {e}")
+        raise RasterizationError(f"Could not render {input_name}: {e}") from e
+    finally:
+        if os.path.exists(tmp_png):
+            os.remove(tmp_png)
+
+    _place(cached_png, output_png)
+    current_app.logger.info(f"Successfully converted {input_name} to {output_name} at {dpi} DPI")
+    evict()
+    return output_png
+
+
+def render_scale(input_svg, dpi):
+    """Scale of the CSS pixels of an SVG rendered at `dpi`, lowered so neither side exceeds ALLOWED_PIXELS."""
+    scale = dpi / CSS_DPI
+    with open(input_svg, "rb") as f:
+        size = svg_size(f.read(HEAD_SIZE))
+    if size and max(size) * scale > ALLOWED_PIXELS:
+        scale = ALLOWED_PIXELS / max(size)
+        current_app.logger.info(f"Rendering {basename(input_svg)} ({size[0]:.0f}x{size[1]:.0f}) at {scale * CSS_DPI:.0f} DPI")
+    return scale
+
+
+def evict():
+    """Drops the least recently used renderings beyond RASTER_CACHE_MAX_ENTRIES."""
+    max_entries = current_app.config.get("RASTER_CACHE_MAX_ENTRIES", 0)
+    cache_dir = current_app.config.get("RASTER_CACHE_FOLDER")
+    if max_entries <= 0:
+        return
+
+    entries = sorted((item.stat().st_mtime, item.path) for item in os.scandir(cache_dir) if item.name.endswith(".png"))
+    for _, path in entries[:max(len(entries) - max_entries, 0)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
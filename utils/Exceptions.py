@@ -17,4 +17,20 @@ class ScoreTooLargeImageError(Exception):
 
 class AudiverisTimeoutError(Exception):
   """Raised when Audiveris times out processing a file."""
+  pass
+
+class JobQueueFullError(Exception):
+  """Raised when the local job queue has no room for another conversion."""
+  pass
+
+class AdmissionRejectedError(Exception):
+  """Raised when the estimated backlog has no room for another conversion. Holds the seconds to wait."""
+  pass
+
+class RasterizationError(Exception):
+  """Raised when an SVG score cannot be rendered to PNG."""
+  pass
+
+class UnsupportedMusicXMLError(Exception):
+  """Raised when the fast MIDI engine meets a MusicXML construct it does not support."""
   pass
\ No newline at end of file
@@ -0,0 +1,132 @@
+import os
+import json
+import math
+import time
+import fcntl
+import tempfile
+from contextlib import contextmanager
+from flask import current_app
+from utils.Exceptions import AdmissionRejectedError
+from utils.processes import is_alive, start_time
+
+# Entries older than this are dropped, in case their job never released them.
+STALE_AGE = 3600
+
+
+def estimate_cost(file, report):
+
+    """
+    Estimates the seconds of conversion work of a validated upload, from
+    what validate_file read (its report): the pixel count of an image, the
+    page count of a PDF, and one page for an SVG.
+    """
+
+    config = current_app.config
+    per_page = config.get("ADMISSION_SECONDS_PER_PAGE", 45)
+
+    if report.get("mime_type") == "application/pdf":
+        from scripts.pdf_pages import count_pages
+        pages = count_pages(file.stream)
+        file.stream.seek(0)
+        return float(pages * per_page)
+
+    if "width" in report:
+        megapixels = report["width"] * report["height"] / 1e6
+        return round(config.get("ADMISSION_SECONDS_PER_JOB", 10) + config.get("ADMISSION_SECONDS_PER_MPIXEL", 4) * megapixels, 1)
+
+    # SVGs are rendered at SVG_DPI, about the size of a scanned page.
+    return float(per_page)
+
+
+@contextmanager
+def _ledger():
+    """
+    Holds the host-wide ledger of admitted jobs, {job_id: entry}, and saves
+    it on exit. Entries of dead workers (a worker killed mid-request never
+    releases its jobs) and stale entries are dropped. Workers are told
+    apart by pid and start time, since a restarted container reuses pids.
+    """
+    path = current_app.config.get("ADMISSION_LEDGER")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(f"{path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(path) as f:
+                jobs = json.load(f)
+        except (FileNotFoundError, ValueError):
+            jobs = {}
+
+        now = time.time()
+        jobs = {
+            job_id: entry for job_id, entry in jobs.items()
+            if now - entry["admitted_at"] < STALE_AGE and is_alive(entry["pid"], entry.get("started"))
+        }
+        yield jobs
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w") as tmp:
+            json.dump(jobs, tmp)
+        os.replace(tmp_path, path)
+
+
+def admit(job_id, client, cost):
+
+    """
+    Admits a job of `cost` estimated seconds from `client` into the
+    host-wide backlog, or rejects it.
+
+    A job is rejected when it would take the backlog over
+    ADMISSION_MAX_BACKLOG, or its client over its fair share of it: the
+    budget split evenly between the clients with jobs in flight. A job
+    that would wait behind nothing is always admitted, however large.
+
+    Raises:
+        AdmissionRejectedError: With the seconds to wait before retrying,
+            the rejected excess drained by ADMISSION_CAPACITY parallel
+            conversions.
+    """
+
+    budget = current_app.config.get("ADMISSION_MAX_BACKLOG", 900)
+    capacity = max(current_app.config.get("ADMISSION_CAPACITY", 3), 1)
+
+    with _ledger() as jobs:
+        backlog = 0.0
+        clients = {}
+        for entry in jobs.values():
+            backlog += entry["cost"]
+            clients[entry["client"]] = clients.get(entry["client"], 0.0) + entry["cost"]
+
+        client_backlog = clients.get(client, 0.0)
+        fair_share = budget / len(set(clients) | {client})
+
+        excess = 0.0
+        if backlog > 0:
+            excess = max(excess, backlog + cost - budget)
+        if client_backlog > 0:
+            excess = max(excess, client_backlog + cost - fair_share)
+        if excess > 0:
+            raise AdmissionRejectedError(max(1, math.ceil(excess / capacity)))
+
+        jobs[job_id] = {
+            "client": client, "cost": cost, "admitted_at": time.time(), "pid": os.getpid(), "started": start_time(os.getpid())
+        }
+
+    current_app.logger.info(f"Admitted job {job_id} ({cost}s estimated, backlog {backlog + cost:.0f}s/{budget}s)")
+
+
+def release(job_id):
+    """Removes a finished (or abandoned) job from the backlog."""
+    if not current_app.config.get("ADMISSION_CONTROL"):
+        return
+    with _ledger() as jobs:
+        jobs.pop(job_id, None)
+
+
+def stats():
+    """Returns the estimated backlog, in seconds, in total and per client."""
+    with _ledger() as jobs:
+        clients = {}
+        for entry in jobs.values():
+            clients[entry["client"]] = round(clients.get(entry["client"], 0.0) + entry["cost"], 1)
+    return {"jobs": len(jobs), "backlog": round(sum(clients.values()), 1), "clients": clients}
@@ -0,0 +1,285 @@
+import os
+import time
+import fcntl
+import shutil
+import sqlite3
+import threading
+from os.path import join
+from collections import OrderedDict
+from contextlib import contextmanager
+from flask import current_app
+from utils.result_cache import hash_file
+from utils.uploads import remove_stale
+from utils import progress
+from utils import jobs
+
+# Folders whose <uuid> directories are kept after a conversion and expired by the janitor.
+ARTIFACT_FOLDERS = ("UPLOAD_FOLDER", "MIDI_FOLDER", "MXL_FOLDER", "PROFILE_FOLDER")
+
+# Artifacts younger than this are never evicted for space: their job may still be running.
+MIN_AGE = 3600
+
+# Manifest entries kept in memory per worker; results never change once written.
+MANIFEST_CACHE_SIZE = 1024
+
+_janitor = None
+_janitor_pid = None
+_janitor_lock = threading.Lock()
+
+_manifests = OrderedDict()
+_manifests_lock = threading.Lock()
+
+
+@contextmanager
+def _open_index():
+    """Opens the artifact index, creating it (and indexing existing artifacts) on first use."""
+    index_path = current_app.config.get("ARTIFACT_INDEX")
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    connection = sqlite3.connect(index_path, timeout=30, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+
+    with open(f"{index_path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        exists = connection.execute("SELECT name FROM sqlite_master WHERE name = 'artifacts'").fetchone()
+        if not exists:
+            connection.execute("""
+                CREATE TABLE artifacts (
+                    folder TEXT NOT NULL,
+                    uuid TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (folder, uuid)
+                )
+            """)
+            connection.execute("CREATE INDEX artifacts_created_at ON artifacts (created_at)")
+            connection.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value REAL NOT NULL)")
+            _index_existing(connection)
+        # The file manifest of each artifact (served by the download endpoints)
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                folder TEXT NOT NULL,
+                uuid TEXT NOT NULL,
+                name TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                mtime REAL NOT NULL,
+                PRIMARY KEY (folder, uuid)
+            )
+        """)
+
+    try:
+        yield connection
+    finally:
+        connection.close()
+
+
+def _index_existing(connection):
+    """Adds the artifacts written before the index existed, aged by their mtime."""
+    for folder in ARTIFACT_FOLDERS:
+        base_dir = current_app.config.get(folder)
+        if not os.path.isdir(base_dir):
+            continue
+        for item in os.scandir(base_dir):
+            if item.is_dir():
+                connection.execute(
+                    "INSERT OR IGNORE INTO artifacts VALUES (?, ?, ?, ?)",
+                    (folder, item.name, _directory_size(item.path), item.stat().st_mtime),
+                )
+
+
+def _directory_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+def register(folder, _uuid):
+    """
+    Records (or updates the size of) the <folder>/<uuid> directory of a job,
+    so the janitor can expire it later without scanning the folders.
+
+    Args:
+        folder: Config key of the folder, e.g. "UPLOAD_FOLDER".
+        _uuid: Unique upload identifier
+    """
+    path = join(current_app.config.get(folder), _uuid)
+    if not os.path.isdir(path):
+        return
+    with _open_index() as connection:
+        connection.execute(
+            "INSERT INTO artifacts VALUES (?, ?, ?, ?) ON CONFLICT (folder, uuid) DO UPDATE SET size = excluded.size",
+            (folder, _uuid, _directory_size(path), time.time()),
+        )
+    start_janitor()
+
+
+def remove(folder, _uuid):
+    """Deletes the <folder>/<uuid> directory of a job and its index entries."""
+    shutil.rmtree(join(current_app.config.get(folder), _uuid), ignore_errors=True)
+    with _open_index() as connection:
+        _delete(connection, folder, _uuid)
+
+
+def _delete(connection, folder, _uuid):
+    connection.execute("DELETE FROM artifacts WHERE folder = ? AND uuid = ?", (folder, _uuid))
+    connection.execute("DELETE FROM files WHERE folder = ? AND uuid = ?", (folder, _uuid))
+    forget_file(folder, _uuid)
+
+
+def record_file(folder, _uuid, path, sha256=None):
+
+    """
+    Writes the manifest entry of the file a job serves from <folder>/<uuid>.
+
+    Args:
+        folder: Config key of the folder, e.g. "MIDI_FOLDER".
+        _uuid: Unique upload identifier
+        path: Path of the file.
+        sha256: Digest of the file, if already known.
+
+    Returns:
+        dict: The entry: name, size, sha256 and mtime.
+    """
+
+    if sha256 is None:
+        with open(path, "rb") as f:
+            sha256 = hash_file(f)
+    stat = os.stat(path)
+    entry = {"name": os.path.basename(path), "size": stat.st_size, "sha256": sha256, "mtime": stat.st_mtime}
+
+    with _open_index() as connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+            (folder, _uuid, entry["name"], entry["size"], entry["sha256"], entry["mtime"]),
+        )
+    _remember(folder, _uuid, entry)
+    return entry
+
+
+def manifest(folder, _uuid):
+    """Returns the manifest entry of a job's file in <folder>, or None."""
+    with _manifests_lock:
+        entry = _manifests.get((folder, _uuid))
+        if entry is not None:
+            _manifests.move_to_end((folder, _uuid))
+            return entry
+
+    with _open_index() as connection:
+        row = connection.execute(
+            "SELECT name, size, sha256, mtime FROM files WHERE folder = ? AND uuid = ?", (folder, _uuid)
+        ).fetchone()
+    if row is None:
+        return None
+
+    entry = dict(zip(("name", "size", "sha256", "mtime"), row))
+    _remember(folder, _uuid, entry)
+    return entry
+
+
+def _remember(folder, _uuid, entry):
+    with _manifests_lock:
+        _manifests[(folder, _uuid)] = entry
+        _manifests.move_to_end((folder, _uuid))
+        while len(_manifests) > MANIFEST_CACHE_SIZE:
+            _manifests.popitem(last=False)
+
+
+def forget_file(folder, _uuid):
+    """Drops a manifest entry from this worker's memory (its file was removed)."""
+    with _manifests_lock:
+        _manifests.pop((folder, _uuid), None)
+
+
+def sweep():
+
+    """
+    Removes the artifacts older than ARTIFACT_TTL, then the oldest ones
+    until the indexed total fits in ARTIFACT_MAX_BYTES, the staged
+    uploads of requests that never finished, and the expired records and
+    progress event logs of jobs.
+
+    Only one process on the host sweeps at a time, at most once per
+    JANITOR_INTERVAL.
+
+    Returns:
+        The number of removed artifacts, or None if the sweep was skipped.
+    """
+
+    ttl = current_app.config.get("ARTIFACT_TTL", 0)
+    max_bytes = current_app.config.get("ARTIFACT_MAX_BYTES", 0)
+    interval = current_app.config.get("JANITOR_INTERVAL", 600)
+    index_path = current_app.config.get("ARTIFACT_INDEX")
+    now = time.time()
+
+    with _open_index() as connection, open(f"{index_path}.janitor.lock", "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+
+        last_sweep = connection.execute("SELECT value FROM meta WHERE key = 'last_sweep'").fetchone()
+        if last_sweep and now - last_sweep[0] < interval:
+            return None
+        connection.execute("INSERT OR REPLACE INTO meta VALUES ('last_sweep', ?)", (now,))
+
+        expired = []
+        if ttl > 0:
+            expired = connection.execute(
+                "SELECT folder, uuid, size FROM artifacts WHERE created_at < ?", (now - ttl,)
+            ).fetchall()
+
+        over_budget = []
+        if max_bytes > 0:
+            expired_bytes = sum(size for _, _, size in expired)
+            total = (connection.execute("SELECT COALESCE(SUM(size), 0) FROM artifacts").fetchone()[0]) - expired_bytes
+            if total > max_bytes:
+                rows = connection.execute(
+                    "SELECT folder, uuid, size FROM artifacts WHERE created_at >= ? AND created_at < ? ORDER BY created_at",
+                    (now - ttl if ttl > 0 else 0, now - MIN_AGE),
+                ).fetchall()
+                for folder, _uuid, size in rows:
+                    if total <= max_bytes:
+                        break
+                    over_budget.append((folder, _uuid, size))
+                    total -= size
+
+        for folder, _uuid, _ in expired + over_budget:
+            shutil.rmtree(join(current_app.config.get(folder), _uuid), ignore_errors=True)
+            _delete(connection, folder, _uuid)
+
+    remove_stale(current_app.config.get("UPLOAD_STAGING_FOLDER"))
+    progress.remove_expired(ttl)
+    jobs.remove_expired(ttl)
+
+    removed = len(expired) + len(over_budget)
+    if removed:
+        current_app.logger.info(f"Janitor removed {len(expired)} expired and {len(over_budget)} over-budget artifacts")
+    return removed
+
+
+def start_janitor():
+    """Starts this process' janitor thread, once per (forked) worker."""
+    global _janitor, _janitor_pid
+    with _janitor_lock:
+        if _janitor_pid == os.getpid():
+            return
+        app = current_app._get_current_object()
+        _janitor = threading.Thread(target=_run_janitor, args=(app,), name="artifact-janitor", daemon=True)
+        _janitor.start()
+        _janitor_pid = os.getpid()
+
+
+def _run_janitor(app):
+    with app.app_context():
+        interval = app.config.get("JANITOR_INTERVAL", 600)
+        while True:
+            try:
+                sweep()
+            except Exception as e:
+                app.logger.error(f"Janitor sweep failed: {e}")
+            time.sleep(interval)
@@ -0,0 +1,130 @@
+import os
+import zlib
+import json
+import zipfile
+import tempfile
+from os.path import join
+from flask import current_app
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.utils import secure_filename
+from utils.uploads import UploadStream
+from utils.validation import MAX_FILE_SIZE
+
+CHUNK_SIZE = 64 * 1024
+
+# The archive of a batch's MIDI files is kept in memory up to this size, then on disk.
+SPOOL_SIZE = 16 * 1024 * 1024
+
+TOO_LARGE_ERROR = f"File size exceeds maximum allowed size ({MAX_FILE_SIZE//1024//1024}MB)"
+
+# A member with a bad CRC or a corrupt stream, or one that is encrypted or uses an unsupported compression.
+MEMBER_ERRORS = (zipfile.BadZipFile, zlib.error, EOFError, RuntimeError, NotImplementedError)
+
+
+def is_zip(file):
+    return secure_filename(file.filename).lower().endswith(".zip")
+
+
+def _members(archive):
+    """The files of a zip archive, without directories and macOS/hidden entries."""
+    return [
+        info for info in archive.infolist()
+        if not info.is_dir()
+        and not info.filename.startswith("__MACOSX/")
+        and not os.path.basename(info.filename).startswith(".")
+    ]
+
+
+def count_files(files):
+    """
+    Returns the number of scores in a batch, counting the members of zip archives.
+
+    Raises:
+        zipfile.BadZipFile: If an archive cannot be read.
+    """
+    count = 0
+    for file in files:
+        if is_zip(file):
+            with zipfile.ZipFile(file.stream) as archive:
+                count += len(_members(archive))
+            file.stream.seek(0)
+        else:
+            count += 1
+    return count
+
+
+def expand(files):
+    """
+    Yields the scores of a batch in order: the uploaded files, with each zip
+    archive replaced by its members.
+
+    Members are streamed into UploadStreams, so they are measured, hashed and
+    sniffed like a direct upload and never held in memory. A member that is
+    too large or cannot be read is yielded as a (filename, error) tuple
+    instead.
+    """
+    staging_dir = current_app.config["UPLOAD_STAGING_FOLDER"]
+    for file in files:
+        if not is_zip(file):
+            yield file
+            continue
+
+        with zipfile.ZipFile(file.stream) as archive:
+            for info in _members(archive):
+                filename = os.path.basename(info.filename)
+                if info.file_size > MAX_FILE_SIZE:
+                    yield filename, TOO_LARGE_ERROR
+                    continue
+
+                stream = UploadStream(staging_dir)
+                try:
+                    with archive.open(info) as member:
+                        for chunk in iter(lambda: member.read(CHUNK_SIZE), b""):
+                            stream.write(chunk)
+                except RequestEntityTooLarge:
+                    # The archive declared a smaller size than the content.
+                    stream.close()
+                    yield filename, TOO_LARGE_ERROR
+                    continue
+                except MEMBER_ERRORS:
+                    stream.close()
+                    yield filename, f"Could not read {filename} from the zip archive."
+                    continue
+                stream.seek(0)
+                yield FileStorage(stream, filename=filename)
+
+
+def zip_results(results):
+    """
+    Packs the MIDI files of a batch's converted scores, and the results
+    themselves as results.json, into one zip archive.
+
+    Returns:
+        A file object positioned at the start of the archive.
+    """
+    archive_file = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    names = set()
+
+    with zipfile.ZipFile(archive_file, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for result in results:
+            if result.get("status") != 200:
+                continue
+            midi_path = join(current_app.config.get("MIDI_FOLDER"), result["file_uuid"], result["midi_filename"])
+            if not os.path.exists(midi_path):
+                continue
+
+            # Different uploads can share a file name.
+            stem, extension = os.path.splitext(result["midi_filename"])
+            name, copy = result["midi_filename"], 1
+            while name in names:
+                copy += 1
+                name = f"{stem} ({copy}){extension}"
+            names.add(name)
+            result["zip_filename"] = name
+            archive.write(midi_path, name)
+
+        archive.writestr("results.json", json.dumps(results, indent=4))
+
+    archive_file.seek(0)
+    return archive_file
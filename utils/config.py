@@ -9,7 +9,7 @@ def configure_logging(app):
     
     try:
         # Ensure log directory exists
-        log_dir = os.path.join(app.root_path, 'logs')
+        log_dir = os.path.join(app.root_path, os.getenv('LOG_FOLDER', 'logs'))
         try:
             os.makedirs(log_dir, exist_ok=True)
         except Exception as e:
@@ -1,159 +1,243 @@
 import os
-import threading
-import mimetypes
+import time
+import html
+import queue
+import atexit
 import base64
-import tempfile # Para crear archivos temporales para la conversión de SVG a PNG
+import threading
 from flask import current_app
 
-# Brevo (Sendinblue) SDK
-import sib_api_v3_sdk
-from sib_api_v3_sdk.rest import ApiException
+# The Brevo (Sendinblue) SDK is imported by the dispatcher thread: it is only
+# needed when notifications are enabled, so workers do not pay for it at startup.
 
-# Intenta importar cairosvg para la conversión. Si no está disponible, la conversión fallará y se registrará.
-try:
-    import cairosvg
-    CAIROSVG_AVAILABLE = True
-except ImportError:
-    CAIROSVG_AVAILABLE = False
-    # No es necesario current_app.logger aquí, ya que esto es a nivel de módulo.
-    # El logger se usará más tarde si se intenta una conversión.
+SENDER_NAME = "Score-to-Midi Notifier"
+
+# What happens to a notification when the queue is full.
+DROP_OLDEST = "drop_oldest"
+DROP_NEW = "drop_new"
+
+# Notifications sent in one digest email at most.
+DIGEST_MAX_NOTIFICATIONS = 50
+
+# Seconds a worker waits at exit for its queued notifications.
+SHUTDOWN_TIMEOUT = 5
+
+_dispatcher = None
+_dispatcher_pid = None
+_dispatcher_lock = threading.Lock()
+
+
+class EmailDispatcher:
 
-def _configure_brevo_api():
-    """
-    Configures and returns the Brevo API client instance.
-    Se asegura de que la clave API esté presente.
-    """
-    configuration = sib_api_v3_sdk.Configuration()
-    api_key = os.getenv('BREVO_API_KEY')
-    if not api_key:
-        current_app.logger.error("BREVO_API_KEY is not set in environment variables. Brevo API cannot be configured.")
-        return None
-    configuration.api_key['api-key'] = api_key
-    return sib_api_v3_sdk.TransactionalEmailsApi(sib_api_v3_sdk.ApiClient(configuration))
-
-def _send_email_via_brevo_sync(app_context, subject, html_content_body, attachment_path_original=None):
     """
-    Synchronous function to send an email via Brevo API.
-    This function is intended to be run in a separate thread.
-    Utiliza el contexto de la aplicación Flask para logging y configuración.
-    Convierte SVG a PNG para adjuntar si es necesario.
+    Sends the email notifications of a worker process from one background
+    thread, through one reused Brevo client (and its HTTP connections).
+
+    Notifications wait in a bounded queue. When it is full, the oldest
+    queued one (drop_oldest) or the new one (drop_new) is dropped, so a
+    burst of uploads never piles up threads or memory. With a digest
+    interval, the notifications that arrive within it are sent together in
+    one email.
     """
-    with app_context:
-        api_instance = _configure_brevo_api()
-        if not api_instance:
-            current_app.logger.error("Brevo API instance could not be configured. Email not sent.")
-            return
 
+    def __init__(self, app, queue_size=100, overflow=DROP_OLDEST, digest_interval=0, max_attachment_bytes=5 * 1024 * 1024):
+        self.app = app
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.overflow = overflow
+        self.digest_interval = digest_interval
+        self.max_attachment_bytes = max_attachment_bytes
+        self.stats = {"queued": 0, "sent": 0, "dropped": 0, "failed": 0}
+        self._api = None
+        self._stats_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="email-dispatcher", daemon=True)
+        self._thread.start()
+
+    def _count(self, counter, value=1):
+        with self._stats_lock:
+            self.stats[counter] += value
+
+    def submit(self, subject, body, attachment_path=None):
+        """Queues a notification without blocking. Returns False if it was dropped."""
+        notification = {"subject": subject, "body": body, "attachment_path": attachment_path}
+        try:
+            self.queue.put_nowait(notification)
+        except queue.Full:
+            if self.overflow != DROP_OLDEST or not self._drop_oldest():
+                self._count("dropped")
+                self.app.logger.warning(f"Email queue is full, dropped notification: {subject}")
+                return False
+            try:
+                self.queue.put_nowait(notification)
+            except queue.Full:
+                self._count("dropped")
+                return False
+        self._count("queued")
+        return True
+
+    def _drop_oldest(self):
+        try:
+            dropped = self.queue.get_nowait()
+        except queue.Empty:
+            return False
+        self.queue.task_done()
+        self._count("dropped")
+        self.app.logger.warning(f"Email queue is full, dropped notification: {dropped['subject']}")
+        return True
+
+    def flush(self, timeout=None):
+        """Waits until every queued notification was sent (or failed). Returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        if self.digest_interval > 0:
+            deadline = time.monotonic() + self.digest_interval
+            while len(batch) < DIGEST_MAX_NOTIFICATIONS:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+        return batch
+
+    def _run(self):
+        with self.app.app_context():
+            while True:
+                batch = self._next_batch()
+                try:
+                    self._send(batch)
+                except Exception as e:
+                    self._count("failed", len(batch))
+                    current_app.logger.error(f"An unexpected error occurred sending email via Brevo: {e}")
+                finally:
+                    for _ in batch:
+                        self.queue.task_done()
+
+    def _client(self):
+        """The Brevo API instance, created once. BREVO_API_HOST points it to another endpoint (e.g. a local fake)."""
+        if self._api is None:
+            import sib_api_v3_sdk
+
+            api_key = os.getenv('BREVO_API_KEY')
+            if not api_key:
+                current_app.logger.error("BREVO_API_KEY is not set in environment variables. Brevo API cannot be configured.")
+                return None
+            configuration = sib_api_v3_sdk.Configuration()
+            configuration.api_key['api-key'] = api_key
+            if os.getenv('BREVO_API_HOST'):
+                configuration.host = os.getenv('BREVO_API_HOST')
+            self._api = sib_api_v3_sdk.TransactionalEmailsApi(sib_api_v3_sdk.ApiClient(configuration))
+        return self._api
+
+    def _attachment(self, path):
+        """
+        Returns the Brevo attachment of an uploaded score, or None.
+
+        SVG scores are attached as the PNG the pipeline already rendered next
+        to them. Files over max_attachment_bytes are left out.
+        """
+        import sib_api_v3_sdk
+
+        if not path:
+            return None
+        if path.lower().endswith('.svg'):
+            png_path = f"{os.path.splitext(path)[0]}.png"
+            if not os.path.exists(png_path):
+                current_app.logger.warning(f"No PNG rendering of '{os.path.basename(path)}' found. Email will be sent without this attachment.")
+                return None
+            path = png_path
+
+        try:
+            if os.path.getsize(path) > self.max_attachment_bytes:
+                current_app.logger.warning(f"Attachment '{os.path.basename(path)}' is larger than {self.max_attachment_bytes} bytes. Email will be sent without it.")
+                return None
+            with open(path, 'rb') as f:
+                content = base64.b64encode(f.read()).decode('utf-8')
+        except FileNotFoundError:
+            current_app.logger.error(f"Attachment file not found at path: {path}. Sending email without attachment.")
+            return None
+
+        return sib_api_v3_sdk.SendSmtpEmailAttachment(name=os.path.basename(path), content=content)
+
+    def _send(self, batch):
+        import sib_api_v3_sdk
+        from sib_api_v3_sdk.rest import ApiException
+
+        api_instance = self._client()
         sender_email = os.getenv('BREVO_SENDER_EMAIL')
         personal_email = os.getenv('MY_PERSONAL_EMAIL')
 
-        if not sender_email:
-            current_app.logger.error("BREVO_SENDER_EMAIL is not set. Email not sent.")
-            return
-        if not personal_email:
-            current_app.logger.error("MY_PERSONAL_EMAIL is not set. Email not sent.")
+        if not api_instance or not sender_email or not personal_email:
+            current_app.logger.error("Brevo is not configured (BREVO_API_KEY, BREVO_SENDER_EMAIL, MY_PERSONAL_EMAIL). Email not sent.")
+            self._count("failed", len(batch))
             return
 
-        sender = sib_api_v3_sdk.SendSmtpEmailSender(name="Score-to-Midi Notifier", email=sender_email)
-        to = [sib_api_v3_sdk.SendSmtpEmailTo(email=personal_email)]
-
-        brevo_attachments = []
-        path_to_attach_for_api = None
-        filename_for_api_attachment = None
-        temp_png_path = None # Para la limpieza del archivo PNG temporal
-
-        if attachment_path_original:
-            original_filename = os.path.basename(attachment_path_original)
-            
-            if original_filename.lower().endswith('.svg'):
-                if CAIROSVG_AVAILABLE:
-                    current_app.logger.info(f"SVG attachment '{original_filename}' detected. Attempting conversion to PNG.")
-                    try:
-                        # Crear un archivo temporal para la salida PNG
-                        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as temp_png_file:
-                            temp_png_path = temp_png_file.name
-                        
-                        # Convertir SVG a PNG
-                        cairosvg.svg2png(url=attachment_path_original, write_to=temp_png_path, background_color='white')
-                        
-                        path_to_attach_for_api = temp_png_path
-                        filename_for_api_attachment = os.path.splitext(original_filename)[0] + ".png"
-                        current_app.logger.info(f"SVG '{original_filename}' converted to PNG '{filename_for_api_attachment}' for attachment.")
-                    except Exception as e_convert:
-                        current_app.logger.error(f"Failed to convert SVG '{original_filename}' to PNG: {e_convert}. Email will be sent without this attachment.")
-                        # No adjuntar si la conversión falla. temp_png_path se limpiará si se creó.
-                        if temp_png_path and os.path.exists(temp_png_path):
-                            os.remove(temp_png_path) # Limpieza inmediata si la conversión falla
-                        temp_png_path = None # Asegurarse de que no se intente limpiar de nuevo
-                else:
-                    current_app.logger.warning(f"SVG attachment '{original_filename}' found, but cairosvg library is not available. Cannot convert to PNG. Email will be sent without this attachment.")
-            else:
-                # Para formatos no SVG, usar el archivo original
-                path_to_attach_for_api = attachment_path_original
-                filename_for_api_attachment = original_filename
-
-            if path_to_attach_for_api and filename_for_api_attachment:
-                try:
-                    with open(path_to_attach_for_api, 'rb') as f:
-                        file_data = f.read()
-                    encoded_content = base64.b64encode(file_data).decode('utf-8')
-                    
-                    brevo_attachments.append(sib_api_v3_sdk.SendSmtpEmailAttachment(
-                        name=filename_for_api_attachment, 
-                        content=encoded_content
-                    ))
-                    current_app.logger.info(f"Attachment '{filename_for_api_attachment}' prepared for Brevo email.")
-                except FileNotFoundError:
-                    current_app.logger.error(f"Attachment file not found at path: {path_to_attach_for_api}. Sending email without attachment.")
-                except Exception as e_attach:
-                    current_app.logger.error(f"Error preparing attachment '{filename_for_api_attachment}' for Brevo: {e_attach}. Sending email without attachment.")
-        
-        # Construye el objeto del email transaccional
+        if len(batch) == 1:
+            subject, html_content = batch[0]["subject"], batch[0]["body"]
+        else:
+            subject = f"[🎵 DIGEST] {len(batch)} notifications"
+            html_content = "".join(f"<h3>{html.escape(n['subject'])}</h3><p>{n['body']}</p>" for n in batch)
+
+        # A digest attaches each file once.
+        paths = dict.fromkeys(n["attachment_path"] for n in batch if n["attachment_path"])
+        attachments = [a for a in (self._attachment(path) for path in paths) if a]
+
         send_smtp_email = sib_api_v3_sdk.SendSmtpEmail(
-            sender=sender,
-            to=to,
+            sender=sib_api_v3_sdk.SendSmtpEmailSender(name=SENDER_NAME, email=sender_email),
+            to=[sib_api_v3_sdk.SendSmtpEmailTo(email=personal_email)],
             subject=subject,
-            html_content=html_content_body,
-            attachment=brevo_attachments if brevo_attachments else None
+            html_content=html_content,
+            attachment=attachments or None
         )
 
         try:
             current_app.logger.info(f"Attempting to send email via Brevo to {personal_email} with subject: '{subject}'")
             api_response = api_instance.send_transac_email(send_smtp_email)
-            current_app.logger.info(f"Brevo email sent successfully! Message ID: {api_response.message_id if hasattr(api_response, 'message_id') else 'N/A'}")
+            self._count("sent", len(batch))
+            current_app.logger.info(f"Brevo email sent successfully! Message ID: {getattr(api_response, 'message_id', 'N/A')}")
         except ApiException as e:
+            self._count("failed", len(batch))
             current_app.logger.error(f"Brevo API Exception when sending email: Status {e.status}, Reason {e.reason}")
             current_app.logger.error(f"Brevo API Exception body: {e.body}")
-        except Exception as e_general:
-            current_app.logger.error(f"An unexpected error occurred sending email via Brevo: {e_general}")
-        finally:
-            # Limpieza del archivo PNG temporal si se creó y usó para el adjunto
-            if temp_png_path and path_to_attach_for_api == temp_png_path and os.path.exists(temp_png_path):
-                try:
-                    os.remove(temp_png_path)
-                    current_app.logger.info(f"Temporary PNG file '{temp_png_path}' deleted.")
-                except Exception as e_cleanup:
-                    current_app.logger.error(f"Error deleting temporary PNG file '{temp_png_path}': {e_cleanup}")
+
+
+def get_dispatcher():
+    """Returns this process' dispatcher, started once per (forked) worker."""
+    global _dispatcher, _dispatcher_pid
+    with _dispatcher_lock:
+        if _dispatcher_pid != os.getpid():
+            app = current_app._get_current_object()
+            _dispatcher = EmailDispatcher(
+                app,
+                queue_size=app.config.get("EMAIL_QUEUE_SIZE", 100),
+                overflow=app.config.get("EMAIL_OVERFLOW", DROP_OLDEST),
+                digest_interval=app.config.get("EMAIL_DIGEST_INTERVAL", 0),
+                max_attachment_bytes=app.config.get("EMAIL_MAX_ATTACHMENT_BYTES", 5 * 1024 * 1024),
+            )
+            _dispatcher_pid = os.getpid()
+            atexit.register(_dispatcher.flush, SHUTDOWN_TIMEOUT)
+        return _dispatcher
 
 
 def send_email_notification(subject, body, attachment_path=None):
     """
     Public function to be called from app.py.
-    Sends an email notification using Brevo API in a separate thread
-    to avoid blocking the main Flask request.
+    Queues an email notification for the dispatcher thread, so it never
+    blocks the Flask request.
     The 'body' parameter is used as html_content for the email.
     """
     if not os.getenv('BREVO_API_KEY'):
         current_app.logger.warning("BREVO_API_KEY not found, skipping email notification.")
         return
-    
-    try:
-        app_context = current_app.app_context()
-        # El argumento 'body' se pasa como 'html_content_body' a la función síncrona
-        # 'attachment_path' se pasa como 'attachment_path_original'
-        thread = threading.Thread(target=_send_email_via_brevo_sync, args=(app_context, subject, body, attachment_path))
-        thread.daemon = True
-        thread.start()
-        current_app.logger.info("Brevo email sending task initiated in a background thread.")
-    except Exception as e:
-        current_app.logger.error(f"An error occurred when attempting to send email via Brevo in a separate thread: {e}")
+
+    if get_dispatcher().submit(subject, body, attachment_path):
+        current_app.logger.info("Brevo email queued for the dispatcher thread.")
@@ -0,0 +1,153 @@
+import os
+import time
+import sqlite3
+import numpy as np
+from os.path import join
+from contextlib import closing
+from PIL import Image, ImageOps
+from flask import current_app
+
+# The image is reduced to SAMPLE_SIZE x SAMPLE_SIZE and the lowest HASH_SIZE x HASH_SIZE
+# frequencies of its DCT make the fingerprint: one bit each, set when above their median.
+SAMPLE_SIZE = 64
+HASH_SIZE = 16
+HASH_BITS = HASH_SIZE * HASH_SIZE
+
+# The fingerprint is indexed in BANDS bands of BAND_BITS bits. Two fingerprints less than BANDS
+# bits apart have at least one band in common, so only uploads sharing a band are compared.
+BANDS = 32
+BAND_BITS = HASH_BITS // BANDS
+
+# Largest side of the image the ink is looked for in, and the gray level below which a pixel is ink.
+CROP_SAMPLE_SIZE = 1024
+INK_LEVEL = 200
+
+_DCT = np.cos(np.pi * np.outer(np.arange(HASH_SIZE), 2 * np.arange(SAMPLE_SIZE) + 1) / (2 * SAMPLE_SIZE))
+
+
+def image_fingerprint(file):
+
+    """
+    Returns the perceptual fingerprint of a raster image, as a hex string,
+    or None for an image without ink (blank pages would all look alike).
+
+    The image is decoded at a reduced size (JPEGs are downscaled while
+    decoding), cropped to its ink, so margins and borders do not count, and
+    reduced to its lowest frequencies. The same page exported or
+    photographed again, at another size or compression, gets a fingerprint
+    a few bits away from the first one.
+
+    Args:
+        file: The file from request.files (its pointer is reset afterwards).
+    """
+
+    file.seek(0)
+    with Image.open(file) as img:
+        img.draft("L", (CROP_SAMPLE_SIZE, CROP_SAMPLE_SIZE))
+        gray = ImageOps.autocontrast(img.convert("L"))
+    file.seek(0)
+
+    gray.thumbnail((CROP_SAMPLE_SIZE, CROP_SAMPLE_SIZE))
+    box = gray.point(lambda level: 255 if level < INK_LEVEL else 0).getbbox()
+    if box is None:
+        return None
+    gray = gray.crop(box)
+
+    pixels = np.asarray(gray.resize((SAMPLE_SIZE, SAMPLE_SIZE), Image.Resampling.BOX), dtype=np.float64)
+    frequencies = (_DCT @ pixels @ _DCT.T).ravel()
+    # The first coefficient is the mean brightness, which says nothing about the content.
+    bits = frequencies > np.median(frequencies[1:])
+    return f"{int(''.join('1' if bit else '0' for bit in bits), 2):0{HASH_BITS // 4}x}"
+
+
+def similarity(a, b):
+    """Share of the bits two fingerprints have in common, from 0 to 1."""
+    return 1 - (int(a, 16) ^ int(b, 16)).bit_count() / HASH_BITS
+
+
+def _bands(fingerprint):
+    value = int(fingerprint, 16)
+    mask = (1 << BAND_BITS) - 1
+    return [(band << BAND_BITS) | ((value >> (band * BAND_BITS)) & mask) for band in range(BANDS)]
+
+
+def _connect():
+    index_path = join(current_app.config.get("RESULT_CACHE_FOLDER"), "fingerprints.sqlite3")
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    connection = sqlite3.connect(index_path, timeout=30, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS fingerprints (
+            digest TEXT PRIMARY KEY,
+            fingerprint TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+    """)
+    # One row per band of each fingerprint: the band number and its bits, in one integer.
+    connection.execute("CREATE TABLE IF NOT EXISTS bands (bucket INTEGER NOT NULL, digest TEXT NOT NULL)")
+    connection.execute("CREATE INDEX IF NOT EXISTS bands_bucket ON bands (bucket)")
+    connection.execute("CREATE INDEX IF NOT EXISTS bands_digest ON bands (digest)")
+    connection.execute("CREATE INDEX IF NOT EXISTS fingerprints_created_at ON fingerprints (created_at)")
+    return connection
+
+
+def add(digest, fingerprint):
+    """
+    Indexes the fingerprint of a converted upload under its content digest (the key
+    of its result cache entry), then drops the fingerprints beyond
+    RESULT_CACHE_MAX_AGE and RESULT_CACHE_MAX_ENTRIES.
+    """
+    max_age = current_app.config.get("RESULT_CACHE_MAX_AGE", 0)
+    max_entries = current_app.config.get("RESULT_CACHE_MAX_ENTRIES", 0)
+
+    with closing(_connect()) as connection:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute("DELETE FROM bands WHERE digest = ?", (digest,))
+            connection.execute("INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?)", (digest, fingerprint, time.time()))
+            connection.executemany("INSERT INTO bands VALUES (?, ?)", [(bucket, digest) for bucket in _bands(fingerprint)])
+
+            conditions, params = [], []
+            if max_age > 0:
+                conditions.append("created_at < ?")
+                params.append(time.time() - max_age)
+            if max_entries > 0:
+                conditions.append("digest NOT IN (SELECT digest FROM fingerprints ORDER BY created_at DESC LIMIT ?)")
+                params.append(max_entries)
+            if conditions:
+                stale = " OR ".join(conditions)
+                connection.execute(f"DELETE FROM bands WHERE digest IN (SELECT digest FROM fingerprints WHERE {stale})", params)
+                connection.execute(f"DELETE FROM fingerprints WHERE {stale}", params)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+
+def lookup(fingerprint, min_similarity):
+
+    """
+    Finds the indexed uploads that look like a fingerprint.
+
+    Only uploads sharing a band with it are compared, so matches more than
+    BANDS - 1 bits away may be missed.
+
+    Returns:
+        list of (digest, similarity), at least `min_similarity`, most similar first.
+    """
+
+    buckets = _bands(fingerprint)
+    with closing(_connect()) as connection:
+        candidates = connection.execute(f"""
+            SELECT fingerprints.digest, fingerprints.fingerprint FROM fingerprints
+            WHERE digest IN (SELECT digest FROM bands WHERE bucket IN ({', '.join('?' * len(buckets))}))
+        """, buckets).fetchall()
+
+    matches = [(digest, similarity(fingerprint, other)) for digest, other in candidates]
+    return sorted((match for match in matches if match[1] >= min_similarity), key=lambda match: -match[1])
+
+
+def count():
+    """Number of indexed fingerprints."""
+    with closing(_connect()) as connection:
+        return connection.execute("SELECT COUNT(*) FROM fingerprints").fetchone()[0]
@@ -0,0 +1,132 @@
+import os
+import json
+import time
+import threading
+import tempfile
+from os.path import join
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from utils.Exceptions import JobQueueFullError
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending = 0
+
+
+def _job_path(job_id):
+  return join(current_app.config.get("JOBS_FOLDER"), f"{job_id}.json")
+
+
+def write_job(job_id, **fields):
+  """
+    Creates or updates the status record of a job.
+
+    Records are small JSON files in JOBS_FOLDER, so every gunicorn worker
+    on the host can answer /api/jobs/<id> without an external broker.
+  """
+
+  path = _job_path(job_id)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  record = read_job(job_id) or {"job_id": job_id, "created_at": time.time()}
+  record.update(fields)
+  record["updated_at"] = time.time()
+
+  # Write to a temporary file first so readers never see a partial record.
+  fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+  with os.fdopen(fd, "w") as tmp:
+    json.dump(record, tmp)
+  os.replace(tmp_path, path)
+  return record
+
+
+def read_job(job_id):
+  """Returns the status record of a job, or None if it does not exist or has expired (see remove_expired)."""
+  try:
+    with open(_job_path(job_id)) as f:
+      record = json.load(f)
+  except FileNotFoundError:
+    return None
+
+  # The janitor only sweeps every JANITOR_INTERVAL: an expired record is gone already.
+  ttl = current_app.config.get("ARTIFACT_TTL", 0)
+  if ttl > 0 and time.time() - record["updated_at"] > ttl:
+    return None
+  return record
+
+
+def remove_expired(max_age):
+  """Deletes the job records last updated more than `max_age` seconds ago, like their uploads. Returns how many."""
+  directory = current_app.config.get("JOBS_FOLDER")
+  if max_age <= 0 or not os.path.isdir(directory):
+    return 0
+  removed = 0
+  for item in os.scandir(directory):
+    if item.name.endswith(".json") and time.time() - item.stat().st_mtime > max_age:
+      try:
+        os.remove(item.path)
+        removed += 1
+      except FileNotFoundError:
+        pass
+  return removed
+
+
+def _get_executor():
+  global _executor
+  # Created lazily so each gunicorn worker starts its own threads after fork.
+  with _executor_lock:
+    if _executor is None:
+      _executor = ThreadPoolExecutor(
+        max_workers=current_app.config.get("JOB_WORKERS", 2),
+        thread_name_prefix="conversion-job"
+      )
+  return _executor
+
+
+def submit_job(job_id, fn, *args):
+  """
+    Queues `fn(*args)` on the local worker pool and tracks it as a job.
+
+    `fn` must return a (response_dict, status_code) tuple, like the
+    synchronous upload. A 200 status marks the job as done and stores the
+    response; any other status marks it as failed with the mapped error.
+
+    Raises:
+      JobQueueFullError: If JOB_QUEUE_SIZE jobs are already waiting or running.
+  """
+
+  global _pending
+
+  app = current_app._get_current_object()
+  max_pending = app.config.get("JOB_QUEUE_SIZE", 10)
+
+  with _executor_lock:
+    if _pending >= max_pending:
+      raise JobQueueFullError()
+    _pending += 1
+
+  record = write_job(job_id, state=QUEUED)
+
+  def run():
+    global _pending
+    with app.app_context():
+      try:
+        write_job(job_id, state=RUNNING, started_at=time.time())
+        response, status = fn(*args)
+        if status == 200:
+          write_job(job_id, state=DONE, finished_at=time.time(), **response)
+        else:
+          write_job(job_id, state=FAILED, finished_at=time.time(), **response)
+      except Exception as e:
+        current_app.logger.error(f"Job {job_id} crashed: {e}")
+        write_job(job_id, state=FAILED, finished_at=time.time(), error="There has been an unexpected error in the conversion. Please, try again.")
+      finally:
+        with _executor_lock:
+          _pending -= 1
+
+  _get_executor().submit(run)
+  return record
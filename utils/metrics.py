@@ -0,0 +1,176 @@
+import os
+import json
+import time
+import inspect
+import tempfile
+import threading
+from os.path import join
+from contextlib import contextmanager
+from flask import current_app, g, has_request_context
+from utils import Exceptions
+
+# Upper bounds (seconds) of the stage duration histogram buckets.
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Upper bounds (MB) of the peak memory histogram buckets.
+MEMORY_BUCKETS = (128, 256, 512, 1024, 1536, 2048, 3072, 4096, 6144, 8192)
+
+STAGE_METRIC = "score_to_midi_stage_duration_seconds"
+EXCEPTION_METRIC = "score_to_midi_exceptions_total"
+
+# Histograms by state key: metric name, help text and buckets.
+HISTOGRAMS = {
+    "stages": (STAGE_METRIC, "Time spent in each stage of the conversion pipeline.", BUCKETS),
+    "cpu": ("score_to_midi_cpu_seconds", "CPU time (user + system) of the subprocess of each run of a stage.", BUCKETS),
+    "memory": ("score_to_midi_peak_rss_megabytes", "Peak resident memory of the subprocess of each run of a stage.", MEMORY_BUCKETS),
+}
+
+# Exported at 0 before they are first raised, so rate() works from the start.
+KNOWN_EXCEPTIONS = [name for name, cls in inspect.getmembers(Exceptions, inspect.isclass) if issubclass(cls, Exception)]
+
+_lock = threading.Lock()
+_state = None
+_state_pid = None
+
+
+def _metrics_dir():
+    metrics_dir = current_app.config.get("METRICS_FOLDER")
+    os.makedirs(metrics_dir, exist_ok=True)
+    return metrics_dir
+
+
+def _load_state():
+    """
+    Returns the metrics of this process. A file left with the same pid by
+    a dead worker is continued, so the host-wide totals never go down.
+    """
+    global _state, _state_pid
+    if _state_pid != os.getpid():
+        try:
+            with open(join(_metrics_dir(), f"{os.getpid()}.json")) as f:
+                _state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            _state = {"stages": {}, "exceptions": {}}
+        _state_pid = os.getpid()
+    return _state
+
+
+def _save_state(state):
+    path = join(_metrics_dir(), f"{os.getpid()}.json")
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "w") as tmp:
+        json.dump(state, tmp)
+    os.replace(tmp_path, path)
+
+
+def _add(state, kind, stage, value):
+    buckets = HISTOGRAMS[kind][2]
+    histogram = state.setdefault(kind, {}).setdefault(stage, {"buckets": [0] * len(buckets), "sum": 0.0, "count": 0})
+    for index, bound in enumerate(buckets):
+        if value <= bound:
+            histogram["buckets"][index] += 1
+    histogram["sum"] += value
+    histogram["count"] += 1
+
+
+def observe(stage, seconds):
+    """Adds the duration of one run of a pipeline stage to its histogram."""
+    with _lock:
+        state = _load_state()
+        _add(state, "stages", stage, seconds)
+        _save_state(state)
+
+
+def observe_usage(stage, cpu_seconds, peak_rss_mb):
+    """Adds the CPU time and peak memory of the subprocess of one run of a stage to their histograms."""
+    with _lock:
+        state = _load_state()
+        _add(state, "cpu", stage, cpu_seconds)
+        _add(state, "memory", stage, peak_rss_mb)
+        _save_state(state)
+
+
+@contextmanager
+def timed(stage):
+    """
+    Times the enclosed block as one run of a stage, whether it succeeds or
+    raises. Stages timed while serving a request also go in its
+    Server-Timing header (see server_timing).
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        observe(stage, seconds)
+        if has_request_context():
+            timings = g.setdefault("server_timing", {})
+            timings[stage] = timings.get(stage, 0) + seconds
+
+
+def server_timing(total):
+    """
+    Returns the Server-Timing header of the current request: the time spent
+    in each stage timed while serving it, and `total` (seconds) as "total".
+    """
+    timings = {**g.get("server_timing", {}), "total": total}
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
+
+
+def count_exception(exception):
+    """Counts a raised exception by class name."""
+    with _lock:
+        state = _load_state()
+        name = type(exception).__name__
+        state["exceptions"][name] = state["exceptions"].get(name, 0) + 1
+        _save_state(state)
+
+
+def _aggregate():
+    """Sums the metrics of every process that wrote to METRICS_FOLDER."""
+    histograms = {kind: {} for kind in HISTOGRAMS}
+    exceptions = dict.fromkeys(KNOWN_EXCEPTIONS, 0)
+
+    for item in os.scandir(_metrics_dir()):
+        if not item.name.endswith(".json"):
+            continue
+        try:
+            with open(item.path) as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            continue
+
+        for kind, (_, _, buckets) in HISTOGRAMS.items():
+            for stage, histogram in state.get(kind, {}).items():
+                total = histograms[kind].setdefault(stage, {"buckets": [0] * len(buckets), "sum": 0.0, "count": 0})
+                total["buckets"] = [a + b for a, b in zip(total["buckets"], histogram["buckets"])]
+                total["sum"] += histogram["sum"]
+                total["count"] += histogram["count"]
+        for name, value in state["exceptions"].items():
+            exceptions[name] = exceptions.get(name, 0) + value
+
+    return histograms, exceptions
+
+
+def render():
+    """Returns the metrics of all gunicorn workers in the Prometheus text format."""
+    histograms, exceptions = _aggregate()
+
+    lines = []
+    for kind, (metric, help_text, buckets) in HISTOGRAMS.items():
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} histogram"]
+        for stage, histogram in sorted(histograms[kind].items()):
+            for bound, value in zip(buckets, histogram["buckets"]):
+                lines.append(f'{metric}_bucket{{stage="{stage}",le="{bound}"}} {value}')
+            lines.append(f'{metric}_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}')
+            lines.append(f'{metric}_sum{{stage="{stage}"}} {histogram["sum"]}')
+            lines.append(f'{metric}_count{{stage="{stage}"}} {histogram["count"]}')
+
+    lines += [
+        f"# HELP {EXCEPTION_METRIC} Exceptions raised by the conversion pipeline, by class.",
+        f"# TYPE {EXCEPTION_METRIC} counter",
+    ]
+    for name, value in sorted(exceptions.items()):
+        lines.append(f'{EXCEPTION_METRIC}{{exception="{name}"}} {value}')
+
+    return "\n".join(lines) + "\n"
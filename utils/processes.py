@@ -0,0 +1,29 @@
+import os
+
+
+def start_time(pid):
+    """
+    Returns when a process started, in clock ticks since boot, or None if
+    it cannot be read. With its pid, it tells a process apart from a later
+    one that reused the pid, e.g. a gunicorn worker of a restarted container.
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # The command name (field 2) may contain spaces and parentheses; starttime is the 22nd field.
+            return int(f.read().rsplit(")", 1)[1].split()[19])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def is_alive(pid, started=None):
+    """Whether the process `pid` is running and, given its start_time(), is still the same process."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    if started is None:
+        return True
+    current = start_time(pid)
+    return current is None or current == started
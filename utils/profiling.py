@@ -0,0 +1,187 @@
+import os
+import sys
+import json
+import time
+import shutil
+import threading
+from os.path import join
+from collections import Counter
+from contextlib import contextmanager
+from flask import current_app
+from utils import artifacts
+from utils import progress
+
+# Functions listed in a profile summary, by the time sampled in their own code.
+TOP_FUNCTIONS = 30
+
+_requested = set()
+_active = {}
+_lock = threading.Lock()
+
+
+class Sampler:
+    """Samples the stack of one thread every `interval` seconds, with sys._current_frames()."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+
+def request(_uuid):
+    """Profiles the conversion of a job even when PROFILE_CONVERSIONS is off, e.g. for an upload sent with profile=true."""
+    with _lock:
+        _requested.add(_uuid)
+
+
+def jvm_options(_uuid, name):
+    """
+    JVM options that record the Audiveris run of a profiled job with Java
+    Flight Recorder, as <name>.jfr in its profile directory. The recording's
+    repository is kept there too, so a JVM killed on timeout (which cannot
+    dump the recording) still leaves its chunks. None for other jobs.
+    """
+    with _lock:
+        profile_dir = _active.get(_uuid)
+    if profile_dir is None:
+        return None
+    settings = current_app.config.get("PROFILE_JFR_SETTINGS", "profile")
+    return (f"-XX:StartFlightRecording=filename={join(profile_dir, name)}.jfr,settings={settings},dumponexit=true "
+            f"-XX:FlightRecorderOptions=repository={join(profile_dir, 'jfr-repository')}")
+
+
+@contextmanager
+def profiled(_uuid):
+
+    """
+    Profiles the enclosed conversion of a job, when PROFILE_CONVERSIONS is
+    on or the job was request()ed.
+
+    The calling thread is sampled every PROFILE_INTERVAL_MS, and the
+    Audiveris JVMs of the job run under Java Flight Recorder (see
+    jvm_options). When the conversion takes PROFILE_SLOW_SECONDS or more,
+    both are kept in PROFILE_FOLDER/<uuid>: python.folded (collapsed
+    stacks, for flame graph tools), summary.json (time by module and
+    function, and the stage events of async jobs, OMR steps included) and the
+    .jfr recordings. A request()ed job keeps its Python profile anyway.
+    Profiles expire like the uploads, and only the latest
+    PROFILE_MAX_ENTRIES are kept.
+    """
+
+    with _lock:
+        requested = _uuid in _requested
+        _requested.discard(_uuid)
+    if not requested and not current_app.config.get("PROFILE_CONVERSIONS"):
+        yield
+        return
+
+    profile_dir = join(current_app.config.get("PROFILE_FOLDER"), _uuid)
+    os.makedirs(profile_dir, exist_ok=True)
+    sampler = Sampler(threading.get_ident(), current_app.config.get("PROFILE_INTERVAL_MS", 10) / 1000)
+    with _lock:
+        _active[_uuid] = profile_dir
+    started = time.monotonic()
+    sampler.start()
+
+    try:
+        yield
+    finally:
+        sampler.stop()
+        seconds = time.monotonic() - started
+        with _lock:
+            _active.pop(_uuid, None)
+
+        slow = seconds >= current_app.config.get("PROFILE_SLOW_SECONDS", 60)
+        if not slow:
+            for item in os.scandir(profile_dir):
+                if item.name.endswith(".jfr") or item.name == "jfr-repository":
+                    shutil.rmtree(item.path) if item.is_dir() else os.remove(item.path)
+
+        if slow or requested:
+            _save(_uuid, profile_dir, sampler, seconds)
+            artifacts.register("PROFILE_FOLDER", _uuid)
+            current_app.logger.info(f"Profile of the {seconds:.1f}s conversion of {_uuid} saved in {profile_dir}")
+            _prune()
+        else:
+            shutil.rmtree(profile_dir, ignore_errors=True)
+
+
+def _save(_uuid, profile_dir, sampler, seconds):
+    with open(join(profile_dir, "python.folded"), "w") as f:
+        for stack, count in sampler.stacks.most_common():
+            f.write(f"{';'.join(stack)} {count}\n")
+
+    modules = Counter()
+    self_samples = Counter()
+    total_samples = Counter()
+    for stack, count in sampler.stacks.items():
+        modules[_module(stack)] += count
+        self_samples[stack[-1]] += count
+        for function in set(stack):
+            total_samples[function] += count
+
+    interval = sampler.interval
+    summary = {
+        "job_id": _uuid,
+        "seconds": round(seconds, 3),
+        "interval": interval,
+        "samples": sum(sampler.stacks.values()),
+        "modules": {module: round(count * interval, 3) for module, count in modules.most_common()},
+        "functions": [
+            {"function": function, "self": round(self_samples[function] * interval, 3), "total": round(total_samples[function] * interval, 3)}
+            for function, _ in self_samples.most_common(TOP_FUNCTIONS)
+        ],
+        "events": _events(_uuid),
+        "jfr": sorted(item.name for item in os.scandir(profile_dir) if item.name.endswith(".jfr")),
+    }
+    with open(join(profile_dir, "summary.json"), "w") as f:
+        json.dump(summary, f, indent=2)
+
+
+def _module(stack):
+    """Where a sample's time goes: music21, else the innermost module of the app, else "other"."""
+    for function in reversed(stack):
+        module = function.split(":", 1)[0]
+        if module.split(".", 1)[0] == "music21":
+            return "music21"
+    for function in reversed(stack):
+        module = function.split(":", 1)[0]
+        if module.startswith(("scripts.", "utils.")) and module != __name__:
+            return module
+    return "other"
+
+
+def _events(_uuid):
+    """The job's stage events (see utils.progress), in seconds since the first one."""
+    events = progress.read(_uuid)
+    first = events[0]["at"] if events else 0
+    return [{**event, "at": round(event["at"] - first, 3)} for event in events]
+
+
+def _prune():
+    """Removes the oldest profiles beyond PROFILE_MAX_ENTRIES."""
+    max_entries = current_app.config.get("PROFILE_MAX_ENTRIES", 0)
+    if max_entries <= 0:
+        return
+    profiles = sorted((item.stat().st_mtime, item.name) for item in os.scandir(current_app.config.get("PROFILE_FOLDER")) if item.is_dir())
+    for _, _uuid in profiles[:max(len(profiles) - max_entries, 0)]:
+        artifacts.remove("PROFILE_FOLDER", _uuid)
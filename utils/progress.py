@@ -0,0 +1,145 @@
+import os
+import json
+import time
+from os.path import join
+from flask import current_app
+
+# Stages of a conversion, in pipeline order. "omr" is emitted once when
+# Audiveris starts and once per OMR step (with "step", and "page" for PDFs).
+SAVED = "saved"
+RASTERIZED = "rasterized"
+PREPROCESSED = "preprocessed"
+OMR = "omr"
+MXL = "mxl"
+MIDI = "midi"
+DONE = "done"
+FAILED = "failed"
+
+TERMINAL = (DONE, FAILED)
+
+# How often (seconds) a stream checks for new events, and sends a comment to keep idle proxies from closing it.
+POLL_INTERVAL = 0.5
+HEARTBEAT_INTERVAL = 15
+
+
+def _events_path(job_id):
+    return join(current_app.config.get("JOBS_FOLDER"), f"{job_id}.events")
+
+
+def start(job_id):
+    """
+    Creates the event log of a job that can be followed on
+    /api/jobs/<id>/events. Jobs without one (synchronous uploads, which
+    nobody can stream) record nothing.
+    """
+    path = _events_path(job_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "a").close()
+
+
+def emitter(job_id):
+    """
+    Returns a function that records the stage events of a job:
+    emit(stage, **fields), a no-op unless the job was start()ed. It does
+    not need an app context, so it can be called from the threads that
+    read Audiveris output.
+    """
+    path = _events_path(job_id)
+
+    def emit(stage, **fields):
+        event = {"stage": stage, "at": round(time.time(), 3), **fields}
+        # One write in append mode: concurrent emitters never interleave their lines.
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+        except FileNotFoundError:
+            return
+        try:
+            os.write(fd, (json.dumps(event) + "\n").encode())
+        finally:
+            os.close(fd)
+
+    return emit
+
+
+def emit(job_id, stage, **fields):
+    """Records a stage event of a job (see emitter)."""
+    emitter(job_id)(stage, **fields)
+
+
+def has_events(job_id):
+    return os.path.exists(_events_path(job_id))
+
+
+def read(job_id):
+    """Returns the events recorded for a job so far, oldest first (none if it has no event log)."""
+    try:
+        with open(_events_path(job_id)) as f:
+            # A line without its newline is still being written.
+            return [json.loads(line) for line in f if line.endswith("\n")]
+    except FileNotFoundError:
+        return []
+
+
+def remove_expired(max_age):
+    """Deletes the event logs older than `max_age` seconds, like the uploads they belong to. Returns how many."""
+    directory = current_app.config.get("JOBS_FOLDER")
+    if max_age <= 0 or not os.path.isdir(directory):
+        return 0
+    removed = 0
+    for item in os.scandir(directory):
+        if item.name.endswith(".events") and time.time() - item.stat().st_mtime > max_age:
+            try:
+                os.remove(item.path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
+
+def stream(job_id, last_event_id=0, max_duration=300, retry=2000):
+
+    """
+    Yields the events of a job in the Server-Sent Events format, as they are
+    recorded, from the one after `last_event_id` (the line number of the
+    last event the client received).
+
+    The stream ends after the "done" or "failed" event, or after
+    `max_duration` seconds; the client then reconnects (after `retry`
+    milliseconds) with its Last-Event-ID and continues where it left off.
+    """
+
+    path = _events_path(job_id)
+
+    def generate():
+        yield f"retry: {retry}\n\n"
+        started = last_sent = time.monotonic()
+        event_id = 0
+        offset = 0
+        partial = ""
+
+        while time.monotonic() - started < max_duration:
+            try:
+                with open(path) as f:
+                    f.seek(offset)
+                    data = f.read()
+                    offset = f.tell()
+            except FileNotFoundError:
+                data = ""
+
+            lines = (partial + data).split("\n")
+            partial = lines.pop()
+            for line in lines:
+                event_id += 1
+                event = json.loads(line)
+                if event_id > last_event_id:
+                    yield f"id: {event_id}\nevent: {event['stage']}\ndata: {line}\n\n"
+                    last_sent = time.monotonic()
+                if event["stage"] in TERMINAL:
+                    return
+
+            if time.monotonic() - last_sent >= HEARTBEAT_INTERVAL:
+                yield ": keep-alive\n\n"
+                last_sent = time.monotonic()
+            time.sleep(POLL_INTERVAL)
+
+    return generate()
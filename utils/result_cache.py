@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import fcntl
+import hashlib
+import tempfile
+from os.path import join
+from contextlib import contextmanager
+from flask import current_app
+
+CHUNK_SIZE = 64 * 1024
+
+
+def hash_file(file):
+    """
+    Returns the SHA-256 hex digest of an uploaded file's content.
+
+    Args:
+        file: The file from request.files (its pointer is reset afterwards).
+    """
+    digest = hashlib.sha256()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def _cache_dir():
+    cache_dir = current_app.config.get("RESULT_CACHE_FOLDER")
+    os.makedirs(join(cache_dir, "locks"), exist_ok=True)
+    return cache_dir
+
+
+def _entry_path(digest):
+    return join(_cache_dir(), f"{digest}.json")
+
+
+def _write_json(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "w") as tmp:
+        json.dump(data, tmp)
+    os.replace(tmp_path, path)
+
+
+def _is_expired(created_at):
+    max_age = current_app.config.get("RESULT_CACHE_MAX_AGE", 0)
+    return max_age > 0 and time.time() - created_at > max_age
+
+
+def record(counter):
+    """Increments the "hits", "near_duplicates" (suggested) or "misses" counter shared by every worker on the host."""
+    stats_path = join(_cache_dir(), "stats.json")
+    with open(join(_cache_dir(), "locks", "stats.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(stats_path) as f:
+                stats = json.load(f)
+        except (FileNotFoundError, ValueError):
+            stats = {}
+        stats[counter] = stats.get(counter, 0) + 1
+        _write_json(stats_path, stats)
+
+
+def lookup(digest):
+    """
+    Returns the cached conversion for a content digest, or None.
+
+    An entry is only returned while its MIDI file still exists, so results
+    removed from disk are treated as misses.
+    """
+    try:
+        with open(_entry_path(digest)) as f:
+            entry = json.load(f)
+    except (FileNotFoundError, ValueError):
+        entry = None
+
+    if entry is not None:
+        midi_path = join(current_app.config.get("MIDI_FOLDER"), entry["file_uuid"], entry["midi_filename"])
+        if _is_expired(entry["created_at"]) or not os.path.exists(midi_path):
+            _remove_entry(digest)
+            entry = None
+
+    return entry
+
+
+def store(digest, response_dict):
+    """Caches a successful conversion under its content digest and applies the eviction policy."""
+    entry = {
+        "file_uuid": response_dict["file_uuid"],
+        "original_filename": response_dict["original_filename"],
+        "midi_filename": response_dict["midi_filename"],
+        "created_at": time.time(),
+    }
+    _write_json(_entry_path(digest), entry)
+    evict()
+
+
+def _remove_entry(digest):
+    try:
+        os.remove(_entry_path(digest))
+    except FileNotFoundError:
+        pass
+
+
+def evict():
+    """
+    Drops expired entries (RESULT_CACHE_MAX_AGE seconds), then the oldest
+    ones until at most RESULT_CACHE_MAX_ENTRIES remain.
+    """
+    max_entries = current_app.config.get("RESULT_CACHE_MAX_ENTRIES", 0)
+    entries = []
+
+    for item in os.scandir(_cache_dir()):
+        if not item.name.endswith(".json") or item.name == "stats.json":
+            continue
+        digest = item.name[:-len(".json")]
+        created_at = item.stat().st_mtime
+        if _is_expired(created_at):
+            _evict_entry(digest)
+        else:
+            entries.append((created_at, digest))
+
+    if max_entries > 0 and len(entries) > max_entries:
+        entries.sort()
+        for _, digest in entries[:len(entries) - max_entries]:
+            _evict_entry(digest)
+
+
+def _evict_entry(digest):
+    """Removes an entry and its lock file, unless a conversion of that content is in flight."""
+    lock_path = join(_cache_dir(), "locks", f"{digest}.lock")
+    try:
+        with open(lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            _remove_entry(digest)
+            os.remove(lock_path)
+    except BlockingIOError:
+        pass
+
+
+@contextmanager
+def single_flight(digest):
+    """
+    Holds the conversion lock of a content digest.
+
+    Concurrent uploads of the same content, from any worker on the host,
+    wait here until the first one finishes, and then find its result in
+    the cache instead of converting again.
+    """
+    with open(join(_cache_dir(), "locks", f"{digest}.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def stats():
+    """Returns the host-wide hit/miss counters and the number of cached results."""
+    try:
+        with open(join(_cache_dir(), "stats.json")) as f:
+            counters = json.load(f)
+    except (FileNotFoundError, ValueError):
+        counters = {}
+    counters = {"hits": 0, "near_duplicates": 0, "misses": 0, **counters}
+
+    entries = sum(1 for item in os.scandir(_cache_dir()) if item.name.endswith(".json") and item.name != "stats.json")
+    return {**counters, "entries": entries}
@@ -0,0 +1,162 @@
+import os
+import json
+import tempfile
+import threading
+from os.path import join
+from collections import OrderedDict
+from flask import current_app
+from utils.processes import is_alive
+
+# Pickles of another music21 version may not load: the version is part of the disk key.
+try:
+    from music21 import __version__ as MUSIC21_VERSION
+except ImportError:
+    MUSIC21_VERSION = "unknown"
+
+_scores = OrderedDict()
+_scores_bytes = 0
+_scores_pid = None
+_counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+_lock = threading.Lock()
+
+
+def _cache_dir():
+    cache_dir = current_app.config.get("SCORE_CACHE_FOLDER")
+    os.makedirs(join(cache_dir, "stats"), exist_ok=True)
+    return cache_dir
+
+
+def _disk_path(digest):
+    return join(_cache_dir(), f"{digest}-{MUSIC21_VERSION}.pickle")
+
+
+def _reset_after_fork():
+    global _scores, _scores_bytes, _scores_pid, _counters
+    if _scores_pid != os.getpid():
+        _scores = OrderedDict()
+        _scores_bytes = 0
+        _counters = dict.fromkeys(_counters, 0)
+        _scores_pid = os.getpid()
+
+
+def load(mxl_path, digest):
+
+    """
+    Returns the music21 score of a job's MXL, parsing it only on a miss.
+
+    Scores are cached frozen (music21's pickle format) by the MXL's
+    SHA-256: in a per-worker LRU of at most SCORE_CACHE_MAX_BYTES, then on
+    disk in SCORE_CACHE_FOLDER.
+    Every call thaws its own copy, which is cheaper than parsing (or
+    deep-copying) the score, so callers can change it freely.
+    """
+
+    global _scores_bytes
+
+    with _lock:
+        _reset_after_fork()
+        data = _scores.get(digest)
+        if data is not None:
+            _scores.move_to_end(digest)
+            _counters["memory_hits"] += 1
+
+    if data is None:
+        try:
+            with open(_disk_path(digest), "rb") as f:
+                data = f.read()
+            os.utime(_disk_path(digest))
+            counter = "disk_hits"
+        except FileNotFoundError:
+            from music21 import converter, freezeThaw
+            current_app.logger.info(f"Parsing the MXL file for the score cache: {mxl_path}")
+            # The parsed score is not used after this, so it is not copied before freezing.
+            data = freezeThaw.StreamFreezer(converter.parse(mxl_path), fastButUnsafe=True).writeStr(fmt="pickle")
+            _write_disk(digest, data)
+            counter = "misses"
+
+        max_bytes = current_app.config.get("SCORE_CACHE_MAX_BYTES", 0)
+        with _lock:
+            _counters[counter] += 1
+            if len(data) <= max_bytes and digest not in _scores:
+                _scores[digest] = data
+                _scores_bytes += len(data)
+                while _scores_bytes > max_bytes:
+                    _, evicted = _scores.popitem(last=False)
+                    _scores_bytes -= len(evicted)
+
+    _save_stats()
+    return _thaw(data)
+
+
+def _thaw(data):
+    # StreamThawer restores the sites (parent streams) of every element, which plain unpickling does not.
+    from music21 import freezeThaw
+    thawer = freezeThaw.StreamThawer()
+    thawer.openStr(data)
+    return thawer.stream
+
+
+def _write_disk(digest, data):
+    path = _disk_path(digest)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "wb") as tmp:
+        tmp.write(data)
+    os.replace(tmp_path, path)
+    evict()
+
+
+def evict():
+    """Drops the least recently used pickles beyond SCORE_CACHE_MAX_DISK_ENTRIES."""
+    max_entries = current_app.config.get("SCORE_CACHE_MAX_DISK_ENTRIES", 0)
+    if max_entries <= 0:
+        return
+
+    entries = sorted((item.stat().st_mtime, item.path) for item in os.scandir(_cache_dir()) if item.name.endswith(".pickle"))
+    for _, path in entries[:max(len(entries) - max_entries, 0)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _save_stats():
+    """Writes this worker's counters and memory use, for stats()."""
+    with _lock:
+        state = {**_counters, "memory_entries": len(_scores), "memory_bytes": _scores_bytes}
+    path = join(_cache_dir(), "stats", f"{os.getpid()}.json")
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "w") as tmp:
+        json.dump(state, tmp)
+    os.replace(tmp_path, path)
+
+
+def stats():
+    """
+    Returns the hit counters of every worker on the host, the memory held
+    by the LRUs of the running ones, and the size of the disk tier.
+    """
+    totals = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "memory_entries": 0, "memory_bytes": 0}
+    stats_dir = join(_cache_dir(), "stats")
+
+    for item in os.scandir(stats_dir):
+        if not item.name.endswith(".json"):
+            continue
+        try:
+            with open(item.path) as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            continue
+        for counter in ("memory_hits", "disk_hits", "misses"):
+            totals[counter] += state[counter]
+        if is_alive(int(item.name[:-len(".json")])):
+            totals["memory_entries"] += state["memory_entries"]
+            totals["memory_bytes"] += state["memory_bytes"]
+
+    lookups = totals["memory_hits"] + totals["disk_hits"] + totals["misses"]
+    totals["hit_rate"] = round((totals["memory_hits"] + totals["disk_hits"]) / lookups, 3) if lookups else None
+
+    pickles = [item for item in os.scandir(_cache_dir()) if item.name.endswith(".pickle")]
+    totals["disk_entries"] = len(pickles)
+    totals["disk_bytes"] = sum(item.stat().st_size for item in pickles)
+    return totals
+
@@ -0,0 +1,89 @@
+import sys
+import time
+import resource
+import importlib
+
+# Modules imported once in the gunicorn master when the app is preloaded, so
+# every worker shares them copy-on-write. Without preloading, the ones the
+# app does not import itself stay lazy (cairosvg for SVG uploads, the Brevo
+# SDK for notifications).
+PRELOAD_MODULES = ("music21", "magic", "PIL.Image", "pypdf", "cairosvg", "sib_api_v3_sdk")
+
+# Smallest score that takes music21 through parsing and MIDI translation.
+WARMUP_SCORE = """<?xml version="1.0" encoding="UTF-8"?>
+<score-partwise version="3.1">
+  <part-list><score-part id="P1"><part-name>Warm-up</part-name></score-part></part-list>
+  <part id="P1">
+    <measure number="1">
+      <attributes><divisions>1</divisions></attributes>
+      <note><pitch><step>C</step><octave>4</octave></pitch><duration>4</duration><type>whole</type></note>
+    </measure>
+  </part>
+</score-partwise>
+"""
+
+
+def memory_usage():
+    """
+    Returns the memory of the current process in MB: {"rss", "private"}.
+
+    "private" is the part not shared with other processes (the pages a
+    forked worker has written to), or None where /proc is not available.
+    """
+    usage = {"rss": None, "private": 0.0}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                field, value = line.split(":", 1)
+                if field == "Rss":
+                    usage["rss"] = int(value.split()[0]) / 1024
+                elif field in ("Private_Clean", "Private_Dirty"):
+                    usage["private"] += int(value.split()[0]) / 1024
+    except (FileNotFoundError, PermissionError):
+        # Peak RSS, in KB on Linux
+        usage = {"rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, "private": None}
+    return usage
+
+
+def format_memory(usage):
+    text = f"rss {usage['rss']:.1f} MB"
+    if usage["private"] is not None:
+        text += f", private {usage['private']:.1f} MB"
+    return text
+
+
+def import_modules(logger, modules=PRELOAD_MODULES):
+    """Imports the heavy modules not loaded yet, logging the time each one took. Missing ones are skipped."""
+    for name in modules:
+        if name in sys.modules:
+            continue
+        started = time.perf_counter()
+        try:
+            importlib.import_module(name)
+        except (ImportError, OSError) as e:
+            logger.warning(f"Could not preload {name}: {str(e).splitlines()[0]}")
+            continue
+        logger.info(f"Imported {name} in {time.perf_counter() - started:.2f}s")
+
+
+def warm_up(logger):
+
+    """
+    Fills the caches the first conversion would otherwise build: the
+    libmagic database and music21's MusicXML parser and MIDI translator.
+
+    Args:
+        logger: Logger for the timing report.
+    """
+
+    started = time.perf_counter()
+
+    import magic
+    magic.from_buffer(b"%PDF-1.4", mime=True)
+
+    from music21 import converter, midi
+    score = converter.parse(WARMUP_SCORE, format="musicxml")
+    midi_file = midi.translate.streamToMidiFile(score)
+    midi_file.writestr()
+
+    logger.info(f"Warmed up the converters in {time.perf_counter() - started:.2f}s")
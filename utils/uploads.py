@@ -0,0 +1,117 @@
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+from flask import Request, current_app
+from werkzeug.exceptions import RequestEntityTooLarge
+from utils.validation import MAX_FILE_SIZE, HEAD_SIZE
+from utils.result_cache import hash_file
+
+# Room for the multipart boundaries and form fields around the file.
+MULTIPART_OVERHEAD = 64 * 1024
+MAX_CONTENT_LENGTH = MAX_FILE_SIZE + MULTIPART_OVERHEAD
+
+# Staged files older than this belong to a request that never finished.
+STALE_AGE = 3600
+
+
+class UploadStream:
+
+    """
+    Where werkzeug writes an uploaded file while it parses the request body.
+
+    Each chunk goes straight to a staging file, and the size, SHA-256 and
+    first HEAD_SIZE bytes (for the MIME type and image dimensions) are
+    computed on the way, so the upload is never read again. The upload is
+    rejected as soon as it grows past MAX_FILE_SIZE.
+    """
+
+    def __init__(self, directory, max_size=MAX_FILE_SIZE):
+        os.makedirs(directory, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(dir=directory, suffix=".part")
+        self._file = os.fdopen(fd, "w+b")
+        self._digest = hashlib.sha256()
+        self._max_size = max_size
+        self._persisted = False
+        self.size = 0
+        self.head = b""
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self._max_size:
+            self.close()
+            raise RequestEntityTooLarge()
+        if len(self.head) < HEAD_SIZE:
+            self.head += data[:HEAD_SIZE - len(self.head)]
+        self._digest.update(data)
+        return self._file.write(data)
+
+    @property
+    def sha256(self):
+        return self._digest.hexdigest()
+
+    def persist(self, path):
+        """Moves the staged file to its final path (a rename on the same filesystem)."""
+        self._file.close()
+        try:
+            os.replace(self.path, path)
+        except OSError:
+            shutil.move(self.path, path)
+        self.path = path
+        self._persisted = True
+
+    def close(self):
+        """Closes the file and, unless it was persisted, deletes it."""
+        self._file.close()
+        if not self._persisted:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def __getattr__(self, name):
+        # read, seek, tell... of the staging file, for PIL and FileStorage.
+        return getattr(self._file, name)
+
+
+class UploadRequest(Request):
+    """
+    Request whose uploaded files are streamed to UPLOAD_STAGING_FOLDER.
+    A view can raise max_file_size (e.g. for zip archives) before reading request.files.
+    """
+
+    max_file_size = MAX_FILE_SIZE
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return UploadStream(current_app.config["UPLOAD_STAGING_FOLDER"], self.max_file_size)
+
+
+def digest(file):
+    """Returns the SHA-256 of an uploaded file, computed while it was received when possible."""
+    if isinstance(file.stream, UploadStream):
+        return file.stream.sha256
+    return hash_file(file)
+
+
+def save(file, path):
+    """Writes an uploaded file to path, moving the staged file instead of copying it when possible."""
+    if isinstance(file.stream, UploadStream):
+        file.stream.persist(path)
+    else:
+        file.save(path)
+
+
+def remove_stale(directory):
+    """Deletes the staged files left by requests that never finished (e.g. a killed worker)."""
+    if not os.path.isdir(directory):
+        return 0
+    removed = 0
+    for item in os.scandir(directory):
+        if item.name.endswith(".part") and time.time() - item.stat().st_mtime > STALE_AGE:
+            try:
+                os.remove(item.path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
@@ -1,11 +1,20 @@
+import io
 import os
+import re
 import magic
 from PIL import Image
 from werkzeug.utils import secure_filename
+from utils.fingerprint import image_fingerprint
 
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
 ALLOWED_EXTENSIONS = {".svg", ".png", ".jpg", ".jpeg", ".bmp", ".pdf"}
 ALLOWED_PIXELS = 7000
+MIME_BYTES = 2048  # Bytes libmagic looks at
+# Bytes read for the MIME type and the image header (dimensions).
+HEAD_SIZE = 64 * 1024
+# CSS pixels per unit of the absolute lengths an SVG may declare its size in.
+SVG_UNITS = {"": 1, "px": 1, "pt": 96 / 72, "pc": 16, "in": 96, "cm": 96 / 2.54, "mm": 96 / 25.4}
+SVG_ROOT = re.compile(rb"<svg\b[^>]*>", re.IGNORECASE)
 ALLOWED_MIME_TYPES = {
     'image/png', 
     'image/jpeg', 
@@ -14,12 +23,19 @@ ALLOWED_MIME_TYPES = {
     "application/pdf"
 }
 
-def validate_file(file):
+def validate_file(file, report=None, fingerprint=False):
     """
     Validates a file for size, extension, and MIME type.
+
+    Uploads received through utils.uploads.UploadStream were measured while
+    they were streamed, so only their first bytes are looked at.
     
     Args:
         file: The file from request.files
+        report: Optional dict that receives what was read: "size",
+            "mime_type", and "width"/"height" for raster images.
+        fingerprint: Also put the perceptual fingerprint of raster images
+            (see utils.fingerprint) in report["fingerprint"].
         
     Returns:
         tuple: (is_valid, error_message)
@@ -34,9 +50,15 @@ def validate_file(file):
         return False, "Invalid filename"
     
     # Check file size
-    file.seek(0, os.SEEK_END)
-    file_size = file.tell()
-    file.seek(0)  # Reset file pointer
+    stream = file.stream
+    if hasattr(stream, "head"):
+        file_size, head = stream.size, stream.head
+    else:
+        file.seek(0, os.SEEK_END)
+        file_size = file.tell()
+        file.seek(0)  # Reset file pointer
+        head = file.read(HEAD_SIZE)
+        file.seek(0)
     
     if file_size > MAX_FILE_SIZE:
         return False, f"File size exceeds maximum allowed size ({MAX_FILE_SIZE//1024//1024}MB)"
@@ -49,23 +71,83 @@ def validate_file(file):
         return False, f"File type not allowed. Accepted formats: {', '.join(ALLOWED_EXTENSIONS)}"
     
     # Check MIME type (more reliable than extension)
-    file_content = file.read(2048)  # Read first 2048 bytes for MIME detection
-    file.seek(0)  # Reset file pointer
-    
-    mime_type = magic.from_buffer(file_content, mime=True)
+    mime_type = magic.from_buffer(head[:MIME_BYTES], mime=True)
+    if report is not None:
+        report.update(size=file_size, mime_type=mime_type)
     if mime_type not in ALLOWED_MIME_TYPES:
         return False, f"File content does not match allowed types. Detected: {mime_type}"
        
     # Check image pixels ONLY for image files (not PDFs)
     if mime_type.startswith('image/') and mime_type != 'image/svg+xml' and mime_type != 'application/pdf':
         try:
-            file.seek(0)  # Reset file pointer again before opening with PIL
-            img = Image.open(file)
-            width, height = img.size
+            width, height = image_size(head, file)
+            if report is not None:
+                report.update(width=width, height=height)
             if width > ALLOWED_PIXELS or height > ALLOWED_PIXELS: 
                 return False, f"The uploaded image exceeds the maximum resolution of {ALLOWED_PIXELS}x{ALLOWED_PIXELS} pixels. Please upload a smaller image."
-            file.seek(0)  # Reset file pointer after checking
         except Exception as e:
             return False, f"Error validating image dimensions: {str(e)}"
+
+        # A valid image whose fingerprint cannot be computed is converted as usual.
+        if fingerprint and report is not None:
+            try:
+                report["fingerprint"] = image_fingerprint(file)
+            except Exception:
+                file.seek(0)
+
+    # SVGs are rendered at least at their declared size (see scripts.svg_to_png)
+    if mime_type == 'image/svg+xml':
+        size = svg_size(head)
+        if size and (size[0] > ALLOWED_PIXELS or size[1] > ALLOWED_PIXELS):
+            return False, f"The uploaded image exceeds the maximum resolution of {ALLOWED_PIXELS}x{ALLOWED_PIXELS} pixels. Please upload a smaller image."
    
-    return True, None
\ No newline at end of file
+    return True, None
+
+
+def svg_size(head):
+    """
+    Returns the (width, height) an SVG declares on its root element, in CSS
+    pixels: its width and height, or its viewBox where they are missing or
+    relative (%, em). None if it declares neither.
+    """
+    root = SVG_ROOT.search(head)
+    if root is None:
+        return None
+
+    def attribute(name):
+        match = re.search(rb"\s" + name + rb"\s*=\s*[\"']([^\"']*)[\"']", root.group())
+        return match.group(1).decode("ascii", "replace").strip() if match else None
+
+    view_box = None
+    try:
+        view_box = [float(value) for value in re.split(r"[\s,]+", attribute(b"viewBox") or "")][2:4]
+    except ValueError:
+        pass
+
+    size = []
+    for index, name in enumerate((b"width", b"height")):
+        match = re.fullmatch(r"([0-9.eE+-]+)\s*([a-z]*)", attribute(name) or "")
+        try:
+            size.append(float(match.group(1)) * SVG_UNITS[match.group(2)])
+        except (AttributeError, KeyError, ValueError):
+            if len(view_box or []) < 2:
+                return None
+            size.append(view_box[index])
+    return tuple(size)
+
+
+def image_size(head, file):
+    """
+    Returns the (width, height) of an image from its header. PIL only reads
+    the header, but a JPEG whose header does not fit in the first bytes
+    is opened from the file.
+    """
+    try:
+        with Image.open(io.BytesIO(head)) as img:
+            return img.size
+    except Exception:
+        file.seek(0)
+        with Image.open(file) as img:
+            size = img.size
+        file.seek(0)
+        return size